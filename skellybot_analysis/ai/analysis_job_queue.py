@@ -0,0 +1,216 @@
+import asyncio
+import enum
+import logging
+import os
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from skellybot_analysis.ai.clients.call_metrics import CallMetricsRecorder, get_call_metrics_recorder, UNSTAGED, \
+    CURRENT_STAGE_NAME
+from skellybot_analysis.data_models.server_models import ThreadId
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+ANALYSIS_JOB_QUEUE_FILENAME = "ai_analysis_job_queue.json"
+DEFAULT_MAX_CONCURRENT_JOBS = 32
+
+
+class JobPriority(enum.Enum):
+    RECENCY = "recency"  # threads with the most recent messages first
+    MESSAGE_COUNT = "message_count"  # busiest threads first
+    TOKEN_COUNT = "token_count"  # longest threads first
+
+
+DEFAULT_JOB_PRIORITY = JobPriority.RECENCY
+
+
+class AnalysisJobModel(BaseModel):
+    thread_id: ThreadId
+    base_text_hash: str
+    last_activity: datetime
+    message_count: int
+    token_count: int
+    estimated_prompt_tokens: int
+    estimated_completion_tokens: int
+    estimated_cost_usd: float | None = None
+
+    @property
+    def estimated_tokens(self) -> int:
+        return self.estimated_prompt_tokens + self.estimated_completion_tokens
+
+    def priority_key(self, priority: JobPriority) -> tuple:
+        """Sort key - highest priority first, ties broken by recency and then thread id (so the order is stable)"""
+        if priority == JobPriority.MESSAGE_COUNT:
+            return -self.message_count, -self.last_activity.timestamp(), self.thread_id
+        if priority == JobPriority.TOKEN_COUNT:
+            return -self.token_count, -self.last_activity.timestamp(), self.thread_id
+        return -self.last_activity.timestamp(), self.thread_id
+
+
+class AnalysisBudget(BaseModel):
+    """Spending cap for one run - `None` means no limit"""
+    max_tokens: int | None = None
+    max_cost_usd: float | None = None
+
+    @property
+    def is_limited(self) -> bool:
+        return self.max_tokens is not None or self.max_cost_usd is not None
+
+
+class PersistedJobQueueModel(BaseModel):
+    priority: JobPriority
+    saved_at: datetime
+    jobs: list[AnalysisJobModel]
+
+
+class AnalysisJobQueue:
+    """
+    Dispatches analysis jobs in priority order, at most `max_concurrent_jobs` at a time, skipping jobs that would take
+    the run over its `budget` (and dropping jobs that are over it on their own), until no pending job fits.
+    Spending is the actual token usage/cost of the calls recorded (see `call_metrics.py`) for the stage the queue runs
+    in, plus the estimates of the jobs still in flight - so retries, cache hits and map-reduce chunks are all
+    accounted for by the time a job finishes.
+    The jobs that were not dispatched (other than the dropped ones) are saved to `ai_analysis_job_queue.json` in the
+    db_path, `load_remainder` puts them at the front of the next run's queue.
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 jobs: list[AnalysisJobModel],
+                 priority: JobPriority = DEFAULT_JOB_PRIORITY,
+                 budget: AnalysisBudget | None = None,
+                 max_concurrent_jobs: int = DEFAULT_MAX_CONCURRENT_JOBS,
+                 call_metrics_recorder: CallMetricsRecorder | None = None):
+        self.queue_path = Path(db_path) / ANALYSIS_JOB_QUEUE_FILENAME
+        self.priority = priority
+        self.budget = budget or AnalysisBudget()
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.call_metrics_recorder = call_metrics_recorder or get_call_metrics_recorder()
+        self.pending = deque(self._ordered(jobs))
+        self.dispatched = 0
+        self.over_budget: list[AnalysisJobModel] = []  # jobs whose estimate alone is over the budget
+        self.budget_exhausted = False
+        self.spent_tokens = 0
+        self.spent_cost_usd = 0.0
+        self._reserved_tokens = 0
+        self._reserved_cost_usd = 0.0
+        self._records_seen = 0
+        self._stage = UNSTAGED
+        if self.budget.max_cost_usd is not None and any(job.estimated_cost_usd is None for job in jobs):
+            logger.warning("No price is known for the analysis model - the cost budget only counts priced calls")
+
+    def _ordered(self, jobs: list[AnalysisJobModel]) -> list[AnalysisJobModel]:
+        """Jobs left over from the last run (whose thread text hasn't changed since) first, in their saved order"""
+        remainder = self.load_remainder()
+        remainder_positions = {(job.thread_id, job.base_text_hash): position for position, job in enumerate(remainder)}
+        resumed = sorted((job for job in jobs if (job.thread_id, job.base_text_hash) in remainder_positions),
+                         key=lambda job: remainder_positions[(job.thread_id, job.base_text_hash)])
+        new = sorted((job for job in jobs if (job.thread_id, job.base_text_hash) not in remainder_positions),
+                     key=lambda job: job.priority_key(self.priority))
+        if resumed:
+            logger.info(f"Resuming {len(resumed)} analysis jobs left over from the last run")
+        return resumed + new
+
+    def load_remainder(self) -> list[AnalysisJobModel]:
+        if not self.queue_path.exists():
+            return []
+        try:
+            return PersistedJobQueueModel.model_validate_json(self.queue_path.read_text(encoding="utf-8")).jobs
+        except ValidationError as e:
+            logger.warning(f"Ignoring unreadable {self.queue_path.name}: {e.errors()[0]['msg']}")
+            return []
+
+    def save_remainder(self) -> None:
+        if not self.pending:
+            self.queue_path.unlink(missing_ok=True)
+            return
+        queue = PersistedJobQueueModel(priority=self.priority, saved_at=datetime.now(), jobs=list(self.pending))
+        temporary_path = self.queue_path.with_suffix(self.queue_path.suffix + ".tmp")
+        temporary_path.write_text(queue.model_dump_json(indent=2), encoding="utf-8")
+        os.replace(temporary_path, self.queue_path)
+
+    def _update_spent(self) -> None:
+        records = self.call_metrics_recorder.records
+        for record in records[self._records_seen:]:
+            if record.stage == self._stage:
+                self.spent_tokens += record.prompt_tokens + record.completion_tokens
+                self.spent_cost_usd += record.estimated_cost_usd or 0.0
+        self._records_seen = len(records)
+
+    def _exceeds_budget_alone(self, job: AnalysisJobModel) -> bool:
+        return (self.budget.max_tokens is not None and job.estimated_tokens > self.budget.max_tokens) or \
+            (self.budget.max_cost_usd is not None and (job.estimated_cost_usd or 0.0) > self.budget.max_cost_usd)
+
+    def _fits_budget(self, job: AnalysisJobModel) -> bool:
+        self._update_spent()
+        if self.budget.max_tokens is not None and \
+                self.spent_tokens + self._reserved_tokens + job.estimated_tokens > self.budget.max_tokens:
+            return False
+        if self.budget.max_cost_usd is not None and \
+                self.spent_cost_usd + self._reserved_cost_usd + (job.estimated_cost_usd or 0.0) > self.budget.max_cost_usd:
+            return False
+        return True
+
+    def _next_job(self) -> AnalysisJobModel | None:
+        """Take the first pending job that fits the budget, dropping the ones that never can"""
+        for job in list(self.pending):
+            if self._exceeds_budget_alone(job):
+                self.pending.remove(job)
+                self.over_budget.append(job)
+                logger.warning(f"Skipping the analysis of thread {job.thread_id} - its estimate "
+                               f"({job.estimated_tokens} tokens, ${job.estimated_cost_usd or 0.0:.3f}) "
+                               f"is over the whole budget")
+            elif self._fits_budget(job):
+                self.pending.remove(job)
+                return job
+        return None
+
+    async def run(self, run_job: Callable[[AnalysisJobModel], Awaitable[T]]) -> AsyncIterator[T]:
+        """Run `run_job` on the queued jobs, yielding each result as it completes"""
+        self._stage = CURRENT_STAGE_NAME.get() or UNSTAGED
+        self._records_seen = len(self.call_metrics_recorder.records)
+        running: dict[asyncio.Task, AnalysisJobModel] = {}
+        try:
+            while True:
+                while self.pending and len(running) < self.max_concurrent_jobs:
+                    job = self._next_job()
+                    if job is None:
+                        break  # nothing fits until a running job finishes (and frees its reserved estimate)
+                    self._reserved_tokens += job.estimated_tokens
+                    self._reserved_cost_usd += job.estimated_cost_usd or 0.0
+                    running[asyncio.create_task(run_job(job))] = job
+                    self.dispatched += 1
+                if not running:
+                    if self.pending:
+                        self.budget_exhausted = True
+                        logger.warning(f"Analysis budget reached ({self.spent_as_formatted_text}) - "
+                                       f"{len(self.pending)} jobs left for the next run")
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    job = running.pop(task)
+                    self._reserved_tokens -= job.estimated_tokens
+                    self._reserved_cost_usd -= job.estimated_cost_usd or 0.0
+                    yield task.result()
+        finally:
+            for task in running:
+                task.cancel()
+            # jobs that were dispatched but cancelled are picked up again by the next run anyway (they have no analysis)
+            self.save_remainder()
+            self._update_spent()
+
+    @property
+    def spent_as_formatted_text(self) -> str:
+        spent = f"{self.spent_tokens} tokens, ${self.spent_cost_usd:.3f}"
+        limits = []
+        if self.budget.max_tokens is not None:
+            limits.append(f"{self.budget.max_tokens} tokens")
+        if self.budget.max_cost_usd is not None:
+            limits.append(f"${self.budget.max_cost_usd:.2f}")
+        return f"{spent} of {' / '.join(limits)}" if limits else spent
@@ -1,132 +1,302 @@
 import asyncio
+import enum
 import logging
-from asyncio import Task
+import math
 
-from openai import LengthFinishReasonError
-import tiktoken
-
-from skellybot_analysis.ai.clients.openai_client.make_openai_json_mode_ai_request import \
-    make_openai_json_mode_ai_request
-from skellybot_analysis.ai.clients.openai_client.openai_client import MAX_TOKEN_LENGTH, DEFAULT_LLM, OPENAI_CLIENT
-from skellybot_analysis.data_models.analysis_models import AiThreadAnalysisModel
+from skellybot_analysis.ai.analysis_job_queue import AnalysisJobQueue, AnalysisJobModel, AnalysisBudget, JobPriority, \
+    DEFAULT_JOB_PRIORITY, DEFAULT_MAX_CONCURRENT_JOBS
+from skellybot_analysis.ai.clients.call_metrics import estimate_cost_usd
+from skellybot_analysis.ai.clients.llm_response_cache import get_llm_response_cache
+from skellybot_analysis.ai.tokenizer_service import get_tokenizer_service, DEFAULT_TRUNCATION_MARKER
+from skellybot_analysis.ai.clients.structured_output import StructuredOutputProvider, ResponseTruncatedError, \
+    get_structured_output_provider
+from skellybot_analysis.data_models.analysis_models import AiThreadAnalysisModel, WHOLE_THREAD
 from skellybot_analysis.df_db.dataframe_handler import DataframeHandler
+from skellybot_analysis.df_db.thread_analysis_store import ThreadAnalysisStore
 from skellybot_analysis.data_models.prompt_models import TextAnalysisPromptModel
-from skellybot_analysis.data_models.server_models import ThreadModel, ThreadId, MessageModel
+from skellybot_analysis.data_models.server_models import ThreadModel, ThreadId
 
 MIN_MESSAGE_LIMIT = 4
+MAX_LENGTH_RETRIES = 3
+RESPONSE_TOKEN_RESERVE = 900  # space reserved for the response schema and the response itself
+PROMPT_TOKEN_RESERVE = 500  # space reserved for the analysis instructions around each chunk of a long thread
+CHUNK_OVERLAP_RATIO = 0.05
+DEFAULT_MAX_CONCURRENT_CHUNK_CALLS = 4
+
+
+class LongThreadStrategy(enum.Enum):
+    TRUNCATE = "truncate"  # keep the start and the end of the thread, drop the middle
+    MAP_REDUCE = "map_reduce"  # analyze chunks of the thread, then merge the chunk analyses
+
+
+DEFAULT_LONG_THREAD_STRATEGY = LongThreadStrategy.MAP_REDUCE
 
 logger = logging.getLogger(__name__)
 
 
-async def ai_analyze_threads(dataframe_handler:DataframeHandler) -> dict[ThreadId, AiThreadAnalysisModel]:
-    """Run AI analysis on server data stored in a Parquet database"""
+async def ai_analyze_threads(dataframe_handler: DataframeHandler,
+                             force_reanalysis: bool = False,
+                             # how threads over the LLM token budget are analyzed
+                             long_thread_strategy: LongThreadStrategy = DEFAULT_LONG_THREAD_STRATEGY,
+                             max_concurrent_chunk_calls: int = DEFAULT_MAX_CONCURRENT_CHUNK_CALLS,  # per thread
+                             analysis_store: ThreadAnalysisStore | None = None,  # analyses are appended as they finish
+                             provider: StructuredOutputProvider | None = None,  # OpenAI by default
+                             job_priority: JobPriority = DEFAULT_JOB_PRIORITY,  # see `analysis_job_queue.py`
+                             budget: AnalysisBudget | None = None,  # threads over the budget are left for the next run
+                             max_concurrent_jobs: int = DEFAULT_MAX_CONCURRENT_JOBS) -> dict[ThreadId, AiThreadAnalysisModel]:
+    """
+    Analyze the threads that are new, changed or were analyzed with another provider/strategy, carrying the other
+    analyses forward. A failed thread is recorded (and retried by the next run) instead of failing the whole run.
+    """
+    provider = provider or get_structured_output_provider()
+    analysis_store = analysis_store or ThreadAnalysisStore(db_path=dataframe_handler.db_path)
     threads:list[ThreadModel] = list(dataframe_handler.threads.values())
-    messages:list[MessageModel] = list(dataframe_handler.messages.values())
-    analysis_tasks: list[Task[tuple[ThreadId, AiThreadAnalysisModel]]] = []
+    messages_by_thread = dataframe_handler.messages_by_thread
+    existing_analyses = {**dataframe_handler.thread_analyses, **analysis_store.load_analyses()}
+    previous_failures = analysis_store.load_failures()
+    carried_forward: dict[ThreadId, AiThreadAnalysisModel] = {}
+    threads_to_analyze: dict[ThreadId, tuple[ThreadModel, str]] = {}
     # Run analysis on threads
-    logger.info(f"Analyzing {len(threads)} threads")
+    logger.info(f"Analyzing {len(threads)} threads with {provider.name}")
     for thread in threads:
-        thread_messages = [message for message in messages if message.thread_id == thread.thread_id]
-        # sort messages by timestamp (oldest first)
-        thread_messages.sort(key=lambda x: x.timestamp)
-        analysis_tasks.append(asyncio.create_task(analyze_thread(thread=thread,
-                                                                 thread_messages=thread_messages)))
+        if not messages_by_thread.get(thread.thread_id):
+            logger.warning(f"Thread {thread.thread_id} ({thread.jump_url}) has no messages - skipping")
+            continue
+        thread_text = dataframe_handler.thread_text(thread.thread_id)
+        existing_analysis = existing_analyses.get(thread.thread_id)
+        if (not force_reanalysis
+                and existing_analysis is not None
+                and existing_analysis.is_analysis_of(thread_text=thread_text,
+                                                     analyzed_with=provider.name,
+                                                     long_thread_strategy=long_thread_strategy.value)):
+            carried_forward[thread.thread_id] = existing_analysis
+            continue
+        threads_to_analyze[thread.thread_id] = (thread, thread_text)
+
+    token_counts = await asyncio.to_thread(get_tokenizer_service(provider.llm_model).count_tokens_batch,
+                                           [thread_text for _, thread_text in threads_to_analyze.values()])
+    jobs = []
+    for (thread, thread_text), token_count in zip(threads_to_analyze.values(), token_counts):
+        prompt_tokens, completion_tokens = estimate_thread_analysis_tokens(thread_token_count=token_count,
+                                                                           max_input_tokens=provider.max_input_tokens,
+                                                                           long_thread_strategy=long_thread_strategy)
+        jobs.append(AnalysisJobModel(thread_id=thread.thread_id,
+                                     base_text_hash=AiThreadAnalysisModel.hash_text(thread_text),
+                                     last_activity=messages_by_thread[thread.thread_id][-1].timestamp,
+                                     message_count=len(messages_by_thread[thread.thread_id]),
+                                     token_count=token_count,
+                                     estimated_prompt_tokens=prompt_tokens,
+                                     estimated_completion_tokens=completion_tokens,
+                                     estimated_cost_usd=estimate_cost_usd(provider=provider.provider_name,
+                                                                          model=provider.llm_model,
+                                                                          prompt_tokens=prompt_tokens,
+                                                                          completion_tokens=completion_tokens)))
+    job_queue = AnalysisJobQueue(db_path=dataframe_handler.db_path,
+                                 jobs=jobs,
+                                 priority=job_priority,
+                                 budget=budget,
+                                 max_concurrent_jobs=max_concurrent_jobs)
 
-    logger.info(f"Starting AI analysis tasks on {len(analysis_tasks)} objects.")
-    results: list[tuple[ThreadId, AiThreadAnalysisModel]] = await asyncio.gather(*analysis_tasks)
-    logger.info(f"AI analysis tasks completed for {len(results)} objects.")
+    async def run_job(job: AnalysisJobModel) -> tuple[ThreadId, AiThreadAnalysisModel | None]:
+        thread, thread_text = threads_to_analyze[job.thread_id]
+        return await _analyze_and_store_thread(thread=thread,
+                                               thread_text=thread_text,
+                                               analysis_store=analysis_store,
+                                               long_thread_strategy=long_thread_strategy,
+                                               max_concurrent_chunk_calls=max_concurrent_chunk_calls,
+                                               provider=provider)
+
+    retried_failures = sum(1 for thread in threads if thread.thread_id in previous_failures
+                           and thread.thread_id not in carried_forward)
+    logger.info(f"Starting AI analysis tasks on {len(jobs)} new, changed or previously failed threads "
+                f"({retried_failures} failed last time, {len(carried_forward)} unchanged threads carried forward), "
+                f"by {job_priority.value}.")
+    analyses: dict[ThreadId, AiThreadAnalysisModel] = {}
+    failed_thread_ids: list[ThreadId] = []
+    async for thread_id, analysis in job_queue.run(run_job):
+        if analysis is None:
+            failed_thread_ids.append(thread_id)
+        else:
+            analyses[thread_id] = analysis
+        logger.debug(f"{len(analyses) + len(failed_thread_ids)}/{len(jobs)} thread analyses finished")
+    analysis_store.compact()
+    logger.info(f"AI analysis tasks completed for {len(analyses)} threads, {len(failed_thread_ids)} failed.")
+    logger.info(f"LLM response cache: {get_llm_response_cache().stats}")
+    if provider.stats_summary:
+        logger.info(f"{provider.name} usage:\n{provider.stats_summary}")
+    if budget is not None and budget.is_limited:
+        logger.info(f"Analysis spending: {job_queue.spent_as_formatted_text}")
+    if job_queue.pending:
+        logger.warning(f"{len(job_queue.pending)} threads were left unanalyzed by the budget - "
+                       f"saved to {job_queue.queue_path.name} for the next run")
+    if failed_thread_ids:
+        logger.error(f"AI analysis failed for threads {failed_thread_ids} - "
+                     f"see {analysis_store.failures_path.name}, they will be retried on the next run")
 
     logger.info("AI analysis completed!")
-    return {id: result for id, result in results}
+    return {**carried_forward, **analyses}
 
 
-async def analyze_thread(thread: ThreadModel,
-                         thread_messages: list[MessageModel]) -> tuple[ThreadId, AiThreadAnalysisModel]:
-    # Get text content based on object type
-    thread_text_to_analyze = thread.full_text(messages=thread_messages)
-
-    # Initialize tokenizer
-    encoder = tiktoken.encoding_for_model(DEFAULT_LLM)
-    tokens = encoder.encode(thread_text_to_analyze)
-
-    # Account for schema tokens and truncation message
-    MAX_ALLOWED = MAX_TOKEN_LENGTH - 900  # Reserve space for response schema
-    TRUNC_MESSAGE = "\n[Omitted for space constraints]\n"
-    truncated_tokens = len(encoder.encode(TRUNC_MESSAGE))
-
-    if len(tokens) > (MAX_ALLOWED - truncated_tokens):
-        # Calculate available space for content
-        keep_tokens = MAX_ALLOWED - truncated_tokens
-        head = tokens[:keep_tokens // 2]
-        tail = tokens[-keep_tokens // 2:]
-
-        # Rebuild text with truncation message
-        thread_text_to_analyze = (
-                encoder.decode(head) +
-                TRUNC_MESSAGE +
-                encoder.decode(tail)
-        )
+def estimate_thread_analysis_tokens(thread_token_count: int,
+                                    max_input_tokens: int,
+                                    long_thread_strategy: LongThreadStrategy = DEFAULT_LONG_THREAD_STRATEGY) -> tuple[int, int]:
+    """Rough (prompt, completion) tokens `analyze_thread` will use on a thread, for budgeting before it runs"""
+    max_allowed = max_input_tokens - RESPONSE_TOKEN_RESERVE
+    if thread_token_count <= max_allowed or long_thread_strategy == LongThreadStrategy.TRUNCATE:
+        return min(thread_token_count, max_allowed) + PROMPT_TOKEN_RESERVE, RESPONSE_TOKEN_RESERVE
+    # one request per (overlapping) chunk, then the reduce request over the chunk analyses
+    chunked_tokens = int(thread_token_count * (1 + CHUNK_OVERLAP_RATIO))
+    chunk_count = math.ceil(chunked_tokens / (max_allowed - PROMPT_TOKEN_RESERVE))
+    prompt_tokens = chunked_tokens + chunk_count * PROMPT_TOKEN_RESERVE + chunk_count * RESPONSE_TOKEN_RESERVE + PROMPT_TOKEN_RESERVE
+    return prompt_tokens, (chunk_count + 1) * RESPONSE_TOKEN_RESERVE
+
+
+async def _analyze_and_store_thread(thread: ThreadModel,
+                                    thread_text: str,
+                                    analysis_store: ThreadAnalysisStore,
+                                    **analysis_kwargs) -> tuple[ThreadId, AiThreadAnalysisModel | None]:
+    try:
+        thread_id, analysis = await analyze_thread(thread=thread, thread_text=thread_text, **analysis_kwargs)
+    except Exception as e:
+        analysis_store.append_failure(thread_id=thread.thread_id, thread_text=thread_text, error=e)
+        return thread.thread_id, None
+    analysis_store.append_analysis(analysis)
+    return thread_id, analysis
 
-        logger.warning(f"Truncated thread from {len(tokens)} to ~{len(head) + len(tail)} tokens")
 
-    # Enhance system prompt for analysis
-    analysis_prompt = (
+def _analysis_prompt(thread: ThreadModel, text_to_analyze: str, text_description: str = "the text of a chat thread") -> str:
+    return (
         f"You are currently reviewing the chat data from the {thread.server_name} Discord server extracting the content "
         f"of the conversations to provide a landscape of the topics that are being discussed. \n\n"
-        f"You are currently analyzing the text of a chat thread which occurred at this location in the server:\n\n"
+        f"You are currently analyzing {text_description} which occurred at this location in the server:\n\n"
         f"{thread.context_route.as_formatted_text}\n\n"
         f"Here is the text to analyze:\n\n"
         f"BEGIN TEXT TO ANALYZE\n\n"
-        f"{thread_text_to_analyze}\n\n"
+        f"{text_to_analyze}\n\n"
         f"END TEXT TO ANALYZE\n"
         f"Keep your answers concise and to the point, without sacrificing clarity and coverage. \n\n"
         f"Carefully consider the content of this conversation in order to provide the output prescribed by the provided JSON schema."
     )
 
-        #Run AI analysis
 
-    max_retries = 3
-    attempt = 0
-    length_warning = "\n\nWARNING: The last response exceeded length limits. Please keep your answer SHORTER while still providing complete information."
+async def _map_thread_chunks(thread: ThreadModel,
+                             provider: StructuredOutputProvider,
+                             thread_tokens: list[int],
+                             max_chunk_tokens: int,
+                             max_concurrent_chunk_calls: int) -> list[TextAnalysisPromptModel]:
+    """The 'map' half of the map-reduce analysis: analyze overlapping chunks of a long thread, in order"""
+    chunks = get_tokenizer_service(provider.llm_model).chunk_tokens(tokens=thread_tokens,
+                                                                    max_tokens=max_chunk_tokens,
+                                                                    overlap_ratio=CHUNK_OVERLAP_RATIO)
+    logger.info(f"Thread {thread.thread_id} is too long for a single request - "
+                f"analyzing it in {len(chunks)} chunks ({max_concurrent_chunk_calls} at a time)")
+    semaphore = asyncio.Semaphore(max_concurrent_chunk_calls)
 
-    try:
-        while attempt < max_retries:
-            result: TextAnalysisPromptModel = await make_openai_json_mode_ai_request(
-                client=OPENAI_CLIENT,
-                system_prompt=analysis_prompt,
+    async def analyze_chunk(chunk_number: int, chunk: str) -> TextAnalysisPromptModel:
+        async with semaphore:
+            return await provider.make_structured_request(
+                system_prompt=_analysis_prompt(thread=thread,
+                                               text_to_analyze=chunk,
+                                               text_description=f"part {chunk_number} of {len(chunks)} of a long chat thread"),
                 prompt_model=TextAnalysisPromptModel,
-                llm_model=DEFAULT_LLM
+                estimated_tokens=max_chunk_tokens + RESPONSE_TOKEN_RESERVE,
             )
 
-            logger.info(f"AI analysis completed for Thread {thread.thread_id} ({thread.jump_url}) \n\n- tile: {result.title_slug}, summary: {result.extremely_short_summary}")
-
-            return thread.thread_id, AiThreadAnalysisModel(
-                server_id=thread.server_id,
-                server_name=thread.server_name,
-                category_id=thread.category_id,
-                category_name=thread.category_name,
-                channel_id=thread.channel_id,
-                channel_name=thread.channel_name,
-                thread_id=thread.thread_id,
-                thread_name=thread.thread_name,
-                jump_url=thread.jump_url,
-                thread_owner_id=thread.owner_id,
-                analysis_prompt=analysis_prompt,
-                base_text=thread_text_to_analyze,
-                topic_areas= result.topic_areas_as_string,
-                **result.model_dump(exclude={'topic_areas'})
-            )
-        logger.error(f"Max retries exceeded for thread analysis: {thread.thread_id} ({thread.jump_url})")
-        raise ValueError("Max retries exceeded for thread analysis")
-    except LengthFinishReasonError:
-        attempt += 1
-        if attempt >= max_retries:
-            raise
-        logger.warning(
-            f"Length error detected on attempt {attempt} - {thread.thread_id} ({thread.jump_url}) - appending STFU to prompt and retrying")
-        # Append length warning to original prompt
-        analysis_prompt += f" {length_warning} (re-attempt# {attempt} of {max_retries})"
-        return None
+    return list(await asyncio.gather(*[analyze_chunk(chunk_number, chunk)
+                                       for chunk_number, chunk in enumerate(chunks, start=1)]))
+
+
+async def analyze_thread(thread: ThreadModel,
+                         thread_text: str,
+                         long_thread_strategy: LongThreadStrategy = DEFAULT_LONG_THREAD_STRATEGY,
+                         max_concurrent_chunk_calls: int = DEFAULT_MAX_CONCURRENT_CHUNK_CALLS,
+                         provider: StructuredOutputProvider | None = None) -> tuple[ThreadId, AiThreadAnalysisModel]:
+    """
+    Threads over the token budget are either truncated (the middle is dropped) or, with `LongThreadStrategy.MAP_REDUCE`,
+    split into chunks that are analyzed separately (up to `max_concurrent_chunk_calls` at a time) and then
+    merged into one analysis by a final request over the chunk analyses.
+    """
+    provider = provider or get_structured_output_provider()
+    thread_text_to_analyze = thread_text
+
+    tokenizer = get_tokenizer_service(provider.llm_model)
+    tokens = await asyncio.to_thread(tokenizer.encode, thread_text)  # tiktoken releases the GIL while encoding
+
+    MAX_ALLOWED = provider.max_input_tokens - RESPONSE_TOKEN_RESERVE  # Reserve space for response schema
+
+    analysis_prompt = None
+    applied_strategy = long_thread_strategy.value if len(tokens) > MAX_ALLOWED else WHOLE_THREAD
+    if len(tokens) > MAX_ALLOWED and long_thread_strategy == LongThreadStrategy.MAP_REDUCE:
+        chunk_analyses = await _map_thread_chunks(thread=thread,
+                                                  provider=provider,
+                                                  thread_tokens=tokens,
+                                                  max_chunk_tokens=MAX_ALLOWED - PROMPT_TOKEN_RESERVE,
+                                                  max_concurrent_chunk_calls=max_concurrent_chunk_calls)
+        # 'reduce': the final analysis is made from the (in-order) chunk analyses, the whole thread is its base text
+        merged_chunk_analyses = "\n\n".join(f"PART {chunk_number} of {len(chunk_analyses)}:\n\n{chunk_analysis.as_formatted_text}"
+                                             for chunk_number, chunk_analysis in enumerate(chunk_analyses, start=1))
+        analysis_prompt = _analysis_prompt(thread=thread,
+                                           text_to_analyze=merged_chunk_analyses,
+                                           text_description="the analyses of the consecutive parts of a long chat thread "
+                                                            "(combine them into a single analysis of the whole thread)")
+        estimated_tokens = tokenizer.count_tokens(merged_chunk_analyses) + RESPONSE_TOKEN_RESERVE
+    elif len(tokens) > MAX_ALLOWED:
+        # keep the start and the end of the thread, replace the middle with the truncation marker
+        thread_text_to_analyze = tokenizer.truncate_tokens(tokens=tokens,
+                                                           max_tokens=MAX_ALLOWED,
+                                                           marker=DEFAULT_TRUNCATION_MARKER)
+        logger.warning(f"Truncated thread from {len(tokens)} to ~{MAX_ALLOWED} tokens")
+
+    if analysis_prompt is None:
+        # used by the shared rate limiter's tokens-per-minute budget
+        estimated_tokens = min(len(tokens), MAX_ALLOWED) + RESPONSE_TOKEN_RESERVE
+
+        # Enhance system prompt for analysis
+        analysis_prompt = _analysis_prompt(thread=thread, text_to_analyze=thread_text_to_analyze)
+
+    # Run AI analysis - transient API errors are retried inside the request, a response cut off by the length limit
+    # is retried here with a prompt asking for a shorter answer
+    length_warning = "\n\nWARNING: The last response exceeded length limits. Please keep your answer SHORTER while still providing complete information."
+
+    try:
+        for attempt in range(1, MAX_LENGTH_RETRIES + 1):
+            try:
+                result: TextAnalysisPromptModel = await provider.make_structured_request(
+                    system_prompt=analysis_prompt,
+                    prompt_model=TextAnalysisPromptModel,
+                    estimated_tokens=estimated_tokens,
+                )
+                break
+            except ResponseTruncatedError:
+                if attempt >= MAX_LENGTH_RETRIES:
+                    logger.error(f"Max retries exceeded for thread analysis: {thread.thread_id} ({thread.jump_url})")
+                    raise
+                logger.warning(
+                    f"Length error detected on attempt {attempt} - {thread.thread_id} ({thread.jump_url}) - appending STFU to prompt and retrying")
+                # Append length warning to original prompt
+                analysis_prompt += f" {length_warning} (re-attempt# {attempt} of {MAX_LENGTH_RETRIES})"
+
+        logger.info(f"AI analysis completed for Thread {thread.thread_id} ({thread.jump_url}) \n\n- tile: {result.title_slug}, summary: {result.extremely_short_summary}")
+
+        return thread.thread_id, AiThreadAnalysisModel(
+            server_id=thread.server_id,
+            server_name=thread.server_name,
+            category_id=thread.category_id,
+            category_name=thread.category_name,
+            channel_id=thread.channel_id,
+            channel_name=thread.channel_name,
+            thread_id=thread.thread_id,
+            thread_name=thread.thread_name,
+            jump_url=thread.jump_url,
+            thread_owner_id=thread.owner_id,
+            analysis_prompt=analysis_prompt,
+            base_text=thread_text_to_analyze,
+            base_text_hash=AiThreadAnalysisModel.hash_text(thread_text),
+            analyzed_with=provider.name,
+            long_thread_strategy=applied_strategy,
+            topic_areas= result.topic_areas_as_string,
+            **result.model_dump(exclude={'topic_areas'})
+        )
 
     except Exception as e:
         logger.error(f"Error analyzing Thread {thread.thread_id}: {e} \n\n\n({thread.jump_url})")
@@ -1,5 +1,7 @@
+import asyncio
 import enum
 import logging
+import time
 
 import numpy as np
 import pandas as pd
@@ -8,9 +10,12 @@ from pydantic import BaseModel
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 
-from skellybot_analysis.ai.embeddings_stuff.ollama_embedding import DEFAULT_OLLAMA_EMBEDDINGS_MODEL, \
-    calculate_ollama_embeddings
-from skellybot_analysis.data_models.analysis_models import AiThreadAnalysisModel
+from skellybot_analysis.ai.embeddings_stuff.chunked_embedding import ChunkedTexts, PoolingMethod, \
+    DEFAULT_POOLING_METHOD
+from skellybot_analysis.ai.embeddings_stuff.embedding_backends import EmbeddingBackend, get_embedding_backend
+from skellybot_analysis.ai.embeddings_stuff.embedding_cache import EmbeddingCache, get_embedding_cache
+from skellybot_analysis.ai.embeddings_stuff.ollama_embedding import DEFAULT_OLLAMA_EMBEDDINGS_MODEL
+from skellybot_analysis.data_models.analysis_models import AiThreadAnalysisModel, AiUserProfileModel
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +29,7 @@ RANDOM_SEED = 42
 #   - content_type(enum: message_and_response, thread_analysis, tag, user_profile), 
 #   - embedded_text, 
 #   - thread_id (nullable - for messages and thread analyses),
+#   - channel_id (nullable - for messages and thread analyses),
 #   - message_id (nullable, messages only, id of the human message),
 #   - user_id (nullable, for everything but tags)
 #   - embedding method: str
@@ -69,9 +75,11 @@ class EmbeddableItem(BaseModel):
     embedded_text: str
     message_id: int | None = None  # for messages only
     thread_id: int | None = None  # messages and thread analyses
+    channel_id: int | None = None  # messages and thread analyses
     user_id: int | None = None  # for everything but tags
     jump_url: str | None = None  # Jump URL to the relevant thing, if available
     embedding_method: str = DEFAULT_OLLAMA_EMBEDDINGS_MODEL # Default embedding method
+    chunk_count: int = 1  # texts too long for the embedding model are embedded in chunks, then pooled
     
     pca: dict[PCAComponentNumber, PCAComponent] = {}
     tsne: dict[TSNEPerpexityValue,TSNEProjection] = {}
@@ -85,6 +93,7 @@ class EmbeddableItem(BaseModel):
             embedded_text=df_row["message_and_response"],
             message_id=df_row["message_id"],
             thread_id=df_row["thread_id"],
+            channel_id=df_row["channel_id"],
             user_id=df_row["author_id"],
             embedding_method=embedding_method
         )
@@ -96,6 +105,7 @@ class EmbeddableItem(BaseModel):
             content_type=EmbeddableContentType.THREAD_ANALYSIS.value,
             embedded_text=analysis.full_text_no_base_text,
             thread_id=analysis.thread_id,
+            channel_id=analysis.channel_id,
             user_id=analysis.thread_owner_id,
             jump_url=analysis.jump_url,
             embedding_method=embedding_method
@@ -114,6 +124,16 @@ class EmbeddableItem(BaseModel):
             embedding_method=embedding_method
         )
 
+    @classmethod
+    def from_user_profile(cls, profile: AiUserProfileModel, index: int, embedding_method: str = DEFAULT_OLLAMA_EMBEDDINGS_MODEL) -> "EmbeddableItem":
+        return cls(
+            embedding_index=index,
+            content_type=EmbeddableContentType.USER_PROFILE.value,
+            embedded_text=profile.full_text,
+            user_id=profile.user_id,
+            embedding_method=embedding_method
+        )
+
     def model_dump_flattened(self) -> dict:
         """Flatten projections for CSV storage"""
         dump = self.model_dump()
@@ -141,20 +161,73 @@ class EmbeddableItem(BaseModel):
 
         return dump
 
-async def calculate_embeddings_and_projections(embeddable_items:list[EmbeddableItem]) -> tuple[list[EmbeddableItem], pd.DataFrame]:
+async def calculate_embeddings(embeddable_items: list[EmbeddableItem],
+                               embedding_backend: EmbeddingBackend | None = None,
+                               embedding_cache: EmbeddingCache | None = None,
+                               use_cache: bool = True,
+                               pooling: PoolingMethod = DEFAULT_POOLING_METHOD) -> np.ndarray:
+    """
+    Embed the text of every item with the `embedding_backend` (Ollama by default), returns an (n_items, embedding_dim)
+    array ordered by `embedding_index` - the backend is recorded as each item's `embedding_method`.
+    Texts longer than the embedding model's context are split into (token-counted) chunks that are embedded
+    separately and pooled into one vector (the item's `chunk_count` is set).
+    Chunks already in the embedding cache (same model and normalized text) are not embedded again.
+    """
+    for index, item in enumerate(embeddable_items):
+        if not item.embedding_index - embeddable_items[0].embedding_index == index:
+            raise ValueError(
+                f"Item index {item.embedding_index} does not match expected index {index}.")
+    if not embeddable_items:
+        return np.empty((0, 0))
+
+    embedding_backend = embedding_backend or get_embedding_backend()
+    chunked_texts = await asyncio.to_thread(ChunkedTexts,
+                                            [item.embedded_text for item in embeddable_items],
+                                            embedding_backend.model)
+    for item, chunk_count in zip(embeddable_items, chunked_texts.chunk_counts):
+        item.chunk_count = chunk_count
+        item.embedding_method = embedding_backend.name
+    text_to_embed = chunked_texts.chunks
+    embedding_cache = (embedding_cache or get_embedding_cache()) if use_cache else None
+    # the SQLite reads/writes run in a worker thread, so they don't stall the other stages' requests on the event loop
+    cached = (await asyncio.to_thread(embedding_cache.get_many, embedding_backend.name, text_to_embed)
+              if embedding_cache else [None] * len(text_to_embed))
+    miss_indices = [index for index, embedding in enumerate(cached) if embedding is None]
+    logger.info(f"Calculating embeddings for {len(embeddable_items)} items ({len(text_to_embed)} chunks) - "
+                f"{len(text_to_embed) - len(miss_indices)} chunks cached "
+                f"({100 * (1 - len(miss_indices) / len(text_to_embed)):.1f}% hit rate), embedding {len(miss_indices)}...")
+    if miss_indices:
+        miss_texts = [text_to_embed[index] for index in miss_indices]
+        start = time.perf_counter()
+        miss_embeddings = await embedding_backend.embed(miss_texts)
+        logger.info(f"{embedding_backend.name} embedded {len(miss_texts)} chunks "
+                    f"({len(miss_texts) / (time.perf_counter() - start):.1f} chunks/s)")
+        embedded = ~np.isnan(miss_embeddings).any(axis=1)
+        if embedding_cache:
+            await asyncio.to_thread(embedding_cache.put_many,
+                                    embedding_backend.name,
+                                    [text for text, ok in zip(miss_texts, embedded) if ok],
+                                    miss_embeddings[embedded])
+        if not embedded.all():
+            # the successful ones are cached, a rerun only embeds the failed ones
+            raise RuntimeError(f"{int((~embedded).sum())} of {len(miss_texts)} chunks could not be embedded")
+        for index, embedding in zip(miss_indices, miss_embeddings):
+            cached[index] = embedding
+    if embedding_cache:
+        logger.info(f"Embedding cache: {embedding_cache.stats}")
+    return chunked_texts.pool(np.array(cached), pooling=pooling)
 
-    logger.info(f"Creating embeddings and projections for {len(embeddable_items)} items...")
 
+def calculate_projections(embeddable_items: list[EmbeddableItem],
+                          embeddings_npy: np.ndarray) -> tuple[list[EmbeddableItem], pd.DataFrame]:
+    """Fit the t-SNE/UMAP/PCA projections of the embeddings (CPU bound, no I/O)"""
+    logger.info(f"Calculating projections for {len(embeddable_items)} items...")
     for index, item in enumerate(embeddable_items):
         if not item.embedding_index == index:
             raise ValueError(
                 f"Item index {item.embedding_index} does not match expected index {index}.")
-        
-    text_to_embed = [item.embedded_text for item in embeddable_items]
-    # Calculate embeddings
-    logger.info("Calculating embeddings...")
-    embedding_vectors = await calculate_ollama_embeddings(text_to_embed)
-    embeddings_npy = np.array(embedding_vectors)
+    if not len(embeddable_items) == embeddings_npy.shape[0]:
+        raise ValueError(f"Got {embeddings_npy.shape[0]} embeddings for {len(embeddable_items)} items")
 
     # 1. Calculate t-SNE projections
     logger.info("Calculating t-SNE projections...")
@@ -213,4 +286,10 @@ async def calculate_embeddings_and_projections(embeddable_items:list[EmbeddableI
         [item.model_dump_flattened() for item in embeddable_items]
     )
     return embeddable_items, embedding_projections_df
-    
\ No newline at end of file
+
+
+async def calculate_embeddings_and_projections(embeddable_items:list[EmbeddableItem]) -> tuple[list[EmbeddableItem], pd.DataFrame]:
+
+    logger.info(f"Creating embeddings and projections for {len(embeddable_items)} items...")
+    embeddings_npy = await calculate_embeddings(embeddable_items)
+    return calculate_projections(embeddable_items=embeddable_items, embeddings_npy=embeddings_npy)
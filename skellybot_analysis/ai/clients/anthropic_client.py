@@ -0,0 +1,32 @@
+from anthropic import AsyncAnthropic
+
+from skellybot_analysis.ai.clients.rate_limiter import AdaptiveRateLimiter
+from skellybot_analysis.ai.clients.retry_policy import RetryEngine
+from skellybot_analysis.utilities.load_env_variables import ANTHROPIC_API_KEY
+
+ANTHROPIC_CLIENT = None
+DEFAULT_ANTHROPIC_LLM = "claude-3-5-haiku-latest"
+ANTHROPIC_MAX_TOKEN_LENGTH = int(200_000 * .9)
+DEFAULT_ANTHROPIC_MAX_RESPONSE_TOKENS = 4096
+
+# Starting budgets (the anthropic-ratelimit-* headers use a different format, so these are not resynced -
+# a 429's Retry-After still pauses the limiter)
+DEFAULT_ANTHROPIC_REQUESTS_PER_MINUTE = 50
+DEFAULT_ANTHROPIC_TOKENS_PER_MINUTE = 50_000
+DEFAULT_ANTHROPIC_MAX_IN_FLIGHT = 16
+
+ANTHROPIC_RATE_LIMITER = AdaptiveRateLimiter(name="anthropic",
+                                             requests_per_minute=DEFAULT_ANTHROPIC_REQUESTS_PER_MINUTE,
+                                             tokens_per_minute=DEFAULT_ANTHROPIC_TOKENS_PER_MINUTE,
+                                             max_in_flight=DEFAULT_ANTHROPIC_MAX_IN_FLIGHT)
+ANTHROPIC_RETRY_ENGINE = RetryEngine(name="anthropic")
+
+
+def get_anthropic_client() -> AsyncAnthropic:
+    global ANTHROPIC_CLIENT
+    if ANTHROPIC_CLIENT is None:
+        if not ANTHROPIC_API_KEY:
+            raise ValueError("Please set ANTHROPIC_API_KEY in your .env file to use Anthropic models")
+        # retries are handled by ANTHROPIC_RETRY_ENGINE (so every attempt goes through the rate limiter)
+        ANTHROPIC_CLIENT = AsyncAnthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
+    return ANTHROPIC_CLIENT
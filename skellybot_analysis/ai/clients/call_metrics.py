@@ -0,0 +1,206 @@
+"""
+Per-call instrumentation of the LLM and embedding requests: latency, token counts, retries, cache hits, truncations
+and an estimated cost - tagged with the pipeline stage that made the call, summarized per stage (p50/p95/p99).
+"""
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+LLM_CALLS_FILENAME = "llm_calls.csv"
+LLM_CALL_SUMMARY_FILENAME = "llm_call_stage_summary.csv"
+UNSTAGED = "unstaged"
+TRUNCATION_ERROR_NAMES = {"LengthFinishReasonError", "ResponseTruncatedError"}
+
+# USD per million (input, output) tokens, matched by model name prefix (longest prefix wins) - local models are free
+MODEL_PRICES_USD_PER_MILLION_TOKENS: dict[str, tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+    "claude-3-5-haiku": (0.80, 4.00),
+    "claude-3-5-sonnet": (3.00, 15.00),
+    "claude-3-7-sonnet": (3.00, 15.00),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+FREE_PROVIDERS = {"ollama"}
+
+# name of the pipeline stage the current task is running for (set by the pipeline, see `pipeline_stages.py`)
+CURRENT_STAGE_NAME: ContextVar[str | None] = ContextVar("current_stage_name", default=None)
+
+
+def estimate_cost_usd(provider: str, model: str, prompt_tokens: int, completion_tokens: int) -> float | None:
+    if provider in FREE_PROVIDERS:
+        return 0.0
+    matches = [prefix for prefix in MODEL_PRICES_USD_PER_MILLION_TOKENS if model.startswith(prefix)]
+    if not matches:
+        return None
+    input_price, output_price = MODEL_PRICES_USD_PER_MILLION_TOKENS[max(matches, key=len)]
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+
+
+class LlmCallRecord(BaseModel):
+    stage: str
+    kind: str  # "chat" or "embedding"
+    provider: str
+    model: str
+    started_at: datetime
+    latency_seconds: float
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    cache_hit: bool = False
+    truncated: bool = False
+    success: bool = True
+    error_type: str | None = None
+    estimated_cost_usd: float | None = None
+
+
+class CallTracker:
+    """Filled in by the request function while the call runs (see `CallMetricsRecorder.track`)"""
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.cache_hit = False
+
+
+_CURRENT_CALL: ContextVar[CallTracker | None] = ContextVar("current_llm_call", default=None)
+
+
+def note_retry() -> None:
+    """Count a retry against the call being tracked in this context (called by the `RetryEngine`)"""
+    tracker = _CURRENT_CALL.get()
+    if tracker is not None:
+        tracker.retries += 1
+
+
+class StageCallSummary(BaseModel):
+    stage: str
+    kind: str
+    calls: int
+    failures: int
+    retries: int
+    cache_hit_rate: float
+    truncations: int
+    prompt_tokens: int
+    completion_tokens: int
+    estimated_cost_usd: float
+    p50_latency_seconds: float
+    p95_latency_seconds: float
+    p99_latency_seconds: float
+
+
+class CallMetricsRecorder:
+    def __init__(self):
+        self.records: list[LlmCallRecord] = []
+
+    def reset(self) -> None:
+        self.records = []
+
+    @contextmanager
+    def track(self, kind: str, provider: str, model: str) -> Iterator[CallTracker]:
+        tracker = CallTracker()
+        context_token = _CURRENT_CALL.set(tracker)
+        started_at = datetime.now()
+        start = time.perf_counter()
+        error: BaseException | None = None
+        try:
+            yield tracker
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _CURRENT_CALL.reset(context_token)
+            error_type = type(error).__name__ if error is not None else None
+            self.records.append(LlmCallRecord(
+                stage=CURRENT_STAGE_NAME.get() or UNSTAGED,
+                kind=kind,
+                provider=provider,
+                model=model,
+                started_at=started_at,
+                latency_seconds=time.perf_counter() - start,
+                prompt_tokens=tracker.prompt_tokens,
+                completion_tokens=tracker.completion_tokens,
+                retries=tracker.retries,
+                cache_hit=tracker.cache_hit,
+                truncated=error_type in TRUNCATION_ERROR_NAMES,
+                success=error is None,
+                error_type=error_type,
+                estimated_cost_usd=0.0 if tracker.cache_hit else estimate_cost_usd(provider=provider,
+                                                                                   model=model,
+                                                                                   prompt_tokens=tracker.prompt_tokens,
+                                                                                   completion_tokens=tracker.completion_tokens),
+            ))
+
+    def summary_by_stage(self) -> list[StageCallSummary]:
+        if not self.records:
+            return []
+        calls_df = pd.DataFrame([record.model_dump() for record in self.records])
+        summaries = []
+        for (stage, kind), group in calls_df.groupby(["stage", "kind"], sort=True):
+            # cache hits return in microseconds, leave them out of the latency percentiles
+            latencies = group.loc[~group["cache_hit"], "latency_seconds"].to_numpy()
+            if latencies.size == 0:
+                latencies = group["latency_seconds"].to_numpy()
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            summaries.append(StageCallSummary(stage=stage,
+                                              kind=kind,
+                                              calls=len(group),
+                                              failures=int((~group["success"]).sum()),
+                                              retries=int(group["retries"].sum()),
+                                              cache_hit_rate=float(group["cache_hit"].mean()),
+                                              truncations=int(group["truncated"].sum()),
+                                              prompt_tokens=int(group["prompt_tokens"].sum()),
+                                              completion_tokens=int(group["completion_tokens"].sum()),
+                                              estimated_cost_usd=float(group["estimated_cost_usd"].fillna(0.0).sum()),
+                                              p50_latency_seconds=float(p50),
+                                              p95_latency_seconds=float(p95),
+                                              p99_latency_seconds=float(p99)))
+        return summaries
+
+    def summary_as_formatted_text(self) -> str:
+        lines = [f"{'stage':<26} {'kind':<9} {'calls':>6} {'fail':>5} {'retry':>6} {'cache%':>7} {'trunc':>6} "
+                 f"{'tokens in/out':>17} {'cost($)':>8} {'p50(s)':>7} {'p95(s)':>7} {'p99(s)':>7}"]
+        for summary in self.summary_by_stage():
+            lines.append(f"{summary.stage:<26} {summary.kind:<9} {summary.calls:>6} {summary.failures:>5} "
+                         f"{summary.retries:>6} {100 * summary.cache_hit_rate:>6.1f}% {summary.truncations:>6} "
+                         f"{f'{summary.prompt_tokens}/{summary.completion_tokens}':>17} "
+                         f"{summary.estimated_cost_usd:>8.3f} {summary.p50_latency_seconds:>7.2f} "
+                         f"{summary.p95_latency_seconds:>7.2f} {summary.p99_latency_seconds:>7.2f}")
+        unpriced_models = sorted({record.model for record in self.records if record.estimated_cost_usd is None})
+        if unpriced_models:
+            lines.append(f"(no price known for {', '.join(unpriced_models)} - not included in the cost)")
+        return "\n".join(lines)
+
+    def write_report(self, db_path: str) -> None:
+        """Write every call (`llm_calls.csv`) and the per-stage summary (`llm_call_stage_summary.csv`) to the db_path"""
+        if not self.records:
+            logger.info("No LLM or embedding calls were made - no call report written")
+            return
+        pd.DataFrame([record.model_dump() for record in self.records]).to_csv(Path(db_path) / LLM_CALLS_FILENAME,
+                                                                              index=False)
+        pd.DataFrame([summary.model_dump() for summary in self.summary_by_stage()]).to_csv(
+            Path(db_path) / LLM_CALL_SUMMARY_FILENAME, index=False)
+        logger.info(f"LLM/embedding calls by stage:\n{self.summary_as_formatted_text()}")
+
+
+CALL_METRICS_RECORDER = None
+
+
+def get_call_metrics_recorder() -> CallMetricsRecorder:
+    global CALL_METRICS_RECORDER
+    if CALL_METRICS_RECORDER is None:
+        CALL_METRICS_RECORDER = CallMetricsRecorder()
+    return CALL_METRICS_RECORDER
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from skellybot_analysis.system.files_and_folder_names import get_skellybot_analysis_data_folder_path
+
+logger = logging.getLogger(__name__)
+
+LLM_RESPONSE_CACHE_FILENAME = "llm_response_cache.sqlite"
+DEFAULT_MAX_CACHE_ENTRIES = 100_000
+DEFAULT_MAX_CACHE_AGE_DAYS = 180.0
+EVICT_EVERY_N_WRITES = 500
+
+LLM_RESPONSE_CACHE = None
+
+PromptModel = TypeVar("PromptModel", bound=BaseModel)
+
+
+class LlmCacheStats(BaseModel):
+    hits: int
+    misses: int
+    entries: int
+    size_bytes: int
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return (f"{self.hits} hits, {self.misses} misses ({100 * self.hit_rate:.1f}% hit rate), "
+                f"{self.entries} entries ({self.size_bytes / 1e6:.1f} MB)")
+
+
+class LlmResponseCache:
+    """
+    On-disk (SQLite) cache of LLM responses, keyed by a hash of everything that determines the response:
+    model, system prompt, response schema and user input.
+    Entries older than `max_age_days` (since last use) are evicted, as are the least recently used entries
+    beyond `max_entries`. Safe to use from several threads (e.g. via `asyncio.to_thread`).
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 max_entries: int = DEFAULT_MAX_CACHE_ENTRIES,
+                 max_age_days: float = DEFAULT_MAX_CACHE_AGE_DAYS):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._writes_since_eviction = 0
+        self._lock = threading.RLock()  # one transaction at a time on the shared connection
+
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS llm_responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_last_used_at ON llm_responses (last_used_at)")
+        self._connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(llm_model: str,
+                 system_prompt: str,
+                 response_schema: dict | None = None,
+                 user_input: str | None = None) -> str:
+        return hashlib.sha256(json.dumps([llm_model, system_prompt, response_schema, user_input],
+                                         sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._connection.execute("SELECT response FROM llm_responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE llm_responses SET last_used_at = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            return row[0]
+
+    def get_validated(self, key: str, prompt_model: Type[PromptModel]) -> PromptModel | None:
+        """The cached response parsed as `prompt_model` - an entry that doesn't validate is deleted and counts as a miss"""
+        response = self.get(key)
+        if response is None:
+            return None
+        try:
+            return prompt_model.model_validate_json(response)
+        except ValidationError:
+            logger.warning(f"Dropping a cached response that isn't a valid {prompt_model.__name__}")
+            with self._lock:
+                self.delete(key)
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+    def put(self, key: str, llm_model: str, response: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, model, response, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, llm_model, response, now, now))
+            self._connection.commit()
+            self._writes_since_eviction += 1
+            if self._writes_since_eviction >= EVICT_EVERY_N_WRITES:
+                self.evict()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM llm_responses WHERE key = ?", (key,))
+            self._connection.commit()
+
+    def evict(self) -> int:
+        """Drop expired and least recently used entries, returns the number of evicted entries"""
+        cutoff = time.time() - self.max_age_days * 24 * 60 * 60
+        with self._lock:
+            self._writes_since_eviction = 0
+            evicted = self._connection.execute("DELETE FROM llm_responses WHERE last_used_at < ?", (cutoff,)).rowcount
+            evicted += self._connection.execute("""
+                DELETE FROM llm_responses WHERE key IN (
+                    SELECT key FROM llm_responses ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )""", (self.max_entries,)).rowcount
+            self._connection.commit()
+        if evicted:
+            logger.info(f"Evicted {evicted} entries from the LLM response cache")
+        return evicted
+
+    @property
+    def stats(self) -> LlmCacheStats:
+        with self._lock:
+            entries, size_bytes = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(response)), 0) FROM llm_responses").fetchone()
+        return LlmCacheStats(hits=self.hits, misses=self.misses, entries=entries, size_bytes=size_bytes)
+
+
+def get_llm_response_cache() -> LlmResponseCache:
+    global LLM_RESPONSE_CACHE
+    if LLM_RESPONSE_CACHE is None:
+        LLM_RESPONSE_CACHE = LlmResponseCache(
+            db_path=str(Path(get_skellybot_analysis_data_folder_path()) / LLM_RESPONSE_CACHE_FILENAME))
+    return LLM_RESPONSE_CACHE
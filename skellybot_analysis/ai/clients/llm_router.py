@@ -0,0 +1,158 @@
+import logging
+import time
+from collections import deque
+from typing import Type
+
+import numpy as np
+from pydantic import BaseModel
+
+from skellybot_analysis.ai.clients.retry_policy import CircuitOpenError, ErrorClass, classify_error
+from skellybot_analysis.ai.clients.structured_output import StructuredOutputProvider, PromptModel, \
+    ResponseTruncatedError, get_structured_output_provider
+
+logger = logging.getLogger(__name__)
+
+LATENCY_WINDOW = 200  # most recent request latencies kept per provider
+DEFAULT_EXPECTED_LATENCY_SECONDS = 10.0  # for providers without any completed request yet
+
+
+class ProviderStats(BaseModel):
+    name: str
+    weight: float
+    requests: int
+    successes: int
+    failures: int
+    in_flight: int
+    p50_latency_seconds: float | None
+    p95_latency_seconds: float | None
+
+    def __str__(self):
+        latency = (f"p50 {self.p50_latency_seconds:.2f}s, p95 {self.p95_latency_seconds:.2f}s"
+                   if self.p50_latency_seconds is not None else "no latency data")
+        return (f"{self.name} (weight {self.weight}): {self.successes}/{self.requests} succeeded, "
+                f"{self.failures} failed over, {latency}")
+
+
+class LlmRouter(StructuredOutputProvider):
+    """
+    Spreads structured requests over several providers (each keeps its own rate limiter/concurrency budget).
+
+    Each request goes to the available provider with the lowest expected wait - (in-flight requests + 1) x median
+    latency / weight - providers that are throttled (paused after a 429) or down (circuit open) are tried last.
+    A request that still fails on a provider after its own retries (rate limit, server or network errors) fails over to
+    the next provider, other errors are raised as they are.
+    """
+    provider_name = "router"
+
+    def __init__(self, providers: list[StructuredOutputProvider], weights: list[float] | None = None):
+        if not providers:
+            raise ValueError("LlmRouter needs at least one provider")
+        weights = weights or [1.0] * len(providers)
+        if len(weights) != len(providers):
+            raise ValueError(f"Got {len(weights)} weights for {len(providers)} providers")
+        # tokenizer/budget decisions are made before routing, so use the first model's tokenizer
+        # and the smallest context window
+        super().__init__(llm_model=providers[0].llm_model,
+                         max_input_tokens=min(provider.max_input_tokens for provider in providers))
+        self.providers = providers
+        self.weights = {provider.name: weight for provider, weight in zip(providers, weights)}
+        self._in_flight = {provider.name: 0 for provider in providers}
+        self._requests = {provider.name: 0 for provider in providers}
+        self._successes = {provider.name: 0 for provider in providers}
+        self._failures = {provider.name: 0 for provider in providers}
+        self._latencies = {provider.name: deque(maxlen=LATENCY_WINDOW) for provider in providers}
+
+    @property
+    def name(self) -> str:
+        return f"router({', '.join(provider.name for provider in self.providers)})"
+
+    @property
+    def is_available(self) -> bool:
+        return any(provider.is_available for provider in self.providers)
+
+    def _expected_wait(self, provider: StructuredOutputProvider) -> float:
+        latencies = self._latencies[provider.name]
+        latency = float(np.median(latencies)) if latencies else DEFAULT_EXPECTED_LATENCY_SECONDS
+        return (self._in_flight[provider.name] + 1) * latency / self.weights[provider.name]
+
+    def _ranked_providers(self) -> list[StructuredOutputProvider]:
+        return sorted(self.providers, key=lambda provider: (not provider.is_available, self._expected_wait(provider)))
+
+    async def make_structured_request(self,
+                                      system_prompt: str,
+                                      prompt_model: Type[PromptModel],
+                                      user_input: str | None = None,
+                                      estimated_tokens: int | None = None) -> PromptModel:
+        last_error: Exception | None = None
+        for provider in self._ranked_providers():
+            self._requests[provider.name] += 1
+            self._in_flight[provider.name] += 1
+            start = time.perf_counter()
+            try:
+                result = await provider.make_structured_request(system_prompt=system_prompt,
+                                                                prompt_model=prompt_model,
+                                                                user_input=user_input,
+                                                                estimated_tokens=estimated_tokens)
+            except ResponseTruncatedError:
+                raise  # the provider worked, the caller has to ask for a shorter response
+            except Exception as e:
+                if not isinstance(e, CircuitOpenError) and classify_error(e) == ErrorClass.PERMANENT:
+                    raise
+                self._failures[provider.name] += 1
+                last_error = e
+                logger.warning(f"{provider.name} failed ({type(e).__name__}: {e}) - failing over to the next provider")
+                continue
+            finally:
+                self._in_flight[provider.name] -= 1
+            self._latencies[provider.name].append(time.perf_counter() - start)
+            self._successes[provider.name] += 1
+            return result
+        raise last_error
+
+    @property
+    def stats(self) -> list[ProviderStats]:
+        stats = []
+        for provider in self.providers:
+            latencies = self._latencies[provider.name]
+            stats.append(ProviderStats(name=provider.name,
+                                       weight=self.weights[provider.name],
+                                       requests=self._requests[provider.name],
+                                       successes=self._successes[provider.name],
+                                       failures=self._failures[provider.name],
+                                       in_flight=self._in_flight[provider.name],
+                                       p50_latency_seconds=float(np.percentile(latencies, 50)) if latencies else None,
+                                       p95_latency_seconds=float(np.percentile(latencies, 95)) if latencies else None))
+        return stats
+
+    @property
+    def stats_summary(self) -> str | None:
+        return "\n".join(str(provider_stats) for provider_stats in self.stats)
+
+
+def build_llm_router(provider_specs: list[str], weights: list[float] | None = None) -> LlmRouter:
+    """
+    `provider_specs` are "provider" or "provider/model" strings,
+    e.g. `build_llm_router(["openai/gpt-4o-mini", "anthropic", "ollama/llama3.2"])`
+    """
+    providers = []
+    for spec in provider_specs:
+        provider_name, _, llm_model = spec.partition("/")
+        providers.append(get_structured_output_provider(provider_name=provider_name, llm_model=llm_model or None))
+    return LlmRouter(providers=providers, weights=weights)
+
+
+if __name__ == "__main__":
+    import asyncio
+    from skellybot_analysis.data_models.prompt_models import TextAnalysisPromptModel
+
+    logging.basicConfig(level=logging.INFO)
+    _router = build_llm_router(["openai", "ollama"])
+    _texts = [f"Fact #{index}: foxes are mammals, and mammals have a cerebellum." for index in range(8)]
+
+    async def _run():
+        return await asyncio.gather(*[_router.make_structured_request(system_prompt=f"Analyze this text:\n\n{text}",
+                                                                      prompt_model=TextAnalysisPromptModel)
+                                      for text in _texts])
+
+    asyncio.run(_run())
+    print(_router.stats_summary)
@@ -1,13 +1,26 @@
+import httpx
 from ollama import AsyncClient
 
-OLLAMA_ASYNC_CLIENT = None
+from skellybot_analysis.ai.clients.retry_policy import RetryEngine
+
+OLLAMA_ASYNC_CLIENTS: dict[tuple[str | None, int], AsyncClient] = {}
 
 DEFAULT_OLLAMA_MODEL = 'llama3.2'
-def get_ollama_client () -> AsyncClient:
-    global OLLAMA_ASYNC_CLIENT
-    if OLLAMA_ASYNC_CLIENT is None:
-        OLLAMA_ASYNC_CLIENT = AsyncClient()
-    return OLLAMA_ASYNC_CLIENT
+DEFAULT_OLLAMA_MAX_CONNECTIONS = 8  # pooled (keep-alive) HTTP connections per Ollama server
+DEFAULT_OLLAMA_TIMEOUT_SECONDS = 600.0  # local models on a CPU box can be slow
+OLLAMA_RETRY_ENGINE = RetryEngine(name="ollama")
+
+
+def get_ollama_client(host: str | None = None,
+                      max_connections: int = DEFAULT_OLLAMA_MAX_CONNECTIONS) -> AsyncClient:
+    """Shared client per Ollama server (`host=None` -> `OLLAMA_HOST` or localhost), with a pool of keep-alive connections"""
+    key = (host, max_connections)
+    if key not in OLLAMA_ASYNC_CLIENTS:
+        OLLAMA_ASYNC_CLIENTS[key] = AsyncClient(host=host,
+                                                timeout=DEFAULT_OLLAMA_TIMEOUT_SECONDS,
+                                                limits=httpx.Limits(max_connections=max_connections,
+                                                                    max_keepalive_connections=max_connections))
+    return OLLAMA_ASYNC_CLIENTS[key]
 
 if __name__ == "__main__":
     import asyncio
@@ -16,8 +29,8 @@ if __name__ == "__main__":
 
     async def chat():
         message = {'role': 'user', 'content': 'Whats decussation?'}
-        response = await AsyncClient().chat(model=DEFAULT_OLLAMA_MODEL, messages=[message])
+        response = await ollama_client.chat(model=DEFAULT_OLLAMA_MODEL, messages=[message])
         print(response.message.content)
 
 
-    asyncio.run(chat())
\ No newline at end of file
+    asyncio.run(chat())
@@ -1,11 +1,17 @@
 # https://platform.openai.com/docs/guides/text-generation?text-generation-quickstart-example=json
 import asyncio
-import json
 from typing import Type
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, LengthFinishReasonError, RateLimitError
+from openai.types import CompletionUsage
 from pydantic import BaseModel
 
+from skellybot_analysis.ai.clients.openai_client.openai_client import OPENAI_RATE_LIMITER, OPENAI_RETRY_ENGINE
+from skellybot_analysis.ai.clients.call_metrics import get_call_metrics_recorder
+from skellybot_analysis.ai.clients.llm_response_cache import LlmResponseCache, get_llm_response_cache
+from skellybot_analysis.ai.clients.rate_limiter import AdaptiveRateLimiter
+from skellybot_analysis.ai.clients.retry_policy import RetryEngine
+from skellybot_analysis.ai.tokenizer_service import get_tokenizer_service
 
 
 async def make_openai_json_mode_ai_request(client: AsyncOpenAI,
@@ -13,7 +19,18 @@ async def make_openai_json_mode_ai_request(client: AsyncOpenAI,
                                            prompt_model: Type[BaseModel],
                                            llm_model: str,
                                            user_input: str | None = None,
-                                           results_list: list | None = None):
+                                           results_list: list | None = None,
+                                           estimated_tokens: int | None = None,
+                                           rate_limiter: AdaptiveRateLimiter = OPENAI_RATE_LIMITER,
+                                           retry_engine: RetryEngine = OPENAI_RETRY_ENGINE,
+                                           response_cache: LlmResponseCache | None = None,
+                                           use_cache: bool = True):
+    """
+    `estimated_tokens` (prompt + expected response) is drawn from the rate limiter's token budget,
+    pass it when it's already known, otherwise the prompt is counted with the shared tokenizer.
+    Responses are cached on disk (see `llm_response_cache.py`), so identical requests are only paid for once.
+    Rate limit, server and network errors are retried by `retry_engine` (see `retry_policy.py`).
+    """
     messages = [
         {
             "role": "system",
@@ -27,15 +44,59 @@ async def make_openai_json_mode_ai_request(client: AsyncOpenAI,
                 "content": user_input
             }
         )
-    response = await client.beta.chat.completions.parse(
-        model=llm_model,
-        messages=messages,
-        response_format=prompt_model
-    )
-    output = prompt_model(**json.loads(response.choices[0].message.content))
-    if results_list is not None:
-        results_list.append(output)
-    return output
+    with get_call_metrics_recorder().track(kind="chat", provider="openai", model=llm_model) as call:
+        if use_cache:
+            response_cache = response_cache or get_llm_response_cache()
+            cache_key = response_cache.make_key(llm_model=llm_model,
+                                                system_prompt=system_prompt,
+                                                response_schema=prompt_model.model_json_schema(),
+                                                user_input=user_input)
+        output = (await asyncio.to_thread(response_cache.get_validated, cache_key, prompt_model)
+                  if use_cache else None)
+        call.cache_hit = output is not None
+
+        if output is None:
+            if estimated_tokens is None:
+                estimated_tokens = get_tokenizer_service(llm_model).count_tokens(system_prompt + (user_input or ""))
+
+            async def call_api():
+                # every attempt (re-)acquires the rate limiter, so retries are paced by the shared budget
+                async with rate_limiter.limit(estimated_tokens):
+                    try:
+                        return await client.beta.chat.completions.with_raw_response.parse(
+                            model=llm_model,
+                            messages=messages,
+                            response_format=prompt_model
+                        )
+                    except RateLimitError as e:
+                        rate_limiter.on_rate_limited(e.response.headers)
+                        raise
+
+            def record_usage(usage: CompletionUsage | None):
+                rate_limiter.record_usage(estimated_tokens, usage.total_tokens if usage else None)
+                if usage:
+                    call.prompt_tokens = usage.prompt_tokens
+                    call.completion_tokens = usage.completion_tokens
+
+            raw_response = await retry_engine.run(call_api, description=f"{llm_model} json mode request")
+            rate_limiter.update_from_headers(raw_response.headers)
+            try:
+                response = raw_response.parse()
+            except LengthFinishReasonError as e:
+                # a truncated response is still paid for - count it before the caller retries with more room
+                record_usage(e.completion.usage)
+                raise
+            record_usage(response.usage)
+            message = response.choices[0].message
+            if message.refusal:
+                raise ValueError(f"{llm_model} refused the request: {message.refusal}")
+            output = prompt_model.model_validate_json(message.content)
+            if use_cache:  # only responses that validate are cached
+                await asyncio.to_thread(response_cache.put, cache_key, llm_model=llm_model, response=message.content)
+
+        if results_list is not None:
+            results_list.append(output)
+        return output
 
 
 if __name__ == "__main__":
@@ -1,25 +1,70 @@
 # https://platform.openai.com/docs/guides/text-generation?text-generation-quickstart-example=json
 import asyncio
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError
+
+from skellybot_analysis.ai.clients.openai_client.openai_client import OPENAI_RATE_LIMITER, OPENAI_RETRY_ENGINE
+from skellybot_analysis.ai.clients.call_metrics import get_call_metrics_recorder
+from skellybot_analysis.ai.clients.llm_response_cache import LlmResponseCache, get_llm_response_cache
+from skellybot_analysis.ai.clients.rate_limiter import AdaptiveRateLimiter
+from skellybot_analysis.ai.clients.retry_policy import RetryEngine
+from skellybot_analysis.ai.tokenizer_service import get_tokenizer_service
 
 
 async def make_openai_text_generation_ai_request(client: AsyncOpenAI,
                                            system_prompt: str,
-                                           llm_model: str):
+                                           llm_model: str,
+                                           estimated_tokens: int | None = None,
+                                           rate_limiter: AdaptiveRateLimiter = OPENAI_RATE_LIMITER,
+                                           retry_engine: RetryEngine = OPENAI_RETRY_ENGINE,
+                                           response_cache: LlmResponseCache | None = None,
+                                           use_cache: bool = True):
     messages = [
         {
             "role": "system",
             "content": system_prompt
         }
     ]
-    response = await client.beta.chat.completions.parse(
-        model=llm_model,
-        messages=messages,
-        temperature=0.0,
-    )
-    output = response.choices[0].message.content
-    return output
+    with get_call_metrics_recorder().track(kind="chat", provider="openai", model=llm_model) as call:
+        if use_cache:
+            response_cache = response_cache or get_llm_response_cache()
+            cache_key = response_cache.make_key(llm_model=llm_model,
+                                                system_prompt=system_prompt,
+                                                response_schema=None,
+                                                user_input=None)
+        response_content = await asyncio.to_thread(response_cache.get, cache_key) if use_cache else None
+        call.cache_hit = response_content is not None
+
+        if response_content is None:
+            if estimated_tokens is None:
+                estimated_tokens = get_tokenizer_service(llm_model).count_tokens(system_prompt)
+
+            async def call_api():
+                # every attempt (re-)acquires the rate limiter, so retries are paced by the shared budget
+                async with rate_limiter.limit(estimated_tokens):
+                    try:
+                        return await client.beta.chat.completions.with_raw_response.parse(
+                            model=llm_model,
+                            messages=messages,
+                            temperature=0.0,
+                        )
+                    except RateLimitError as e:
+                        rate_limiter.on_rate_limited(e.response.headers)
+                        raise
+
+            raw_response = await retry_engine.run(call_api, description=f"{llm_model} text generation request")
+            rate_limiter.update_from_headers(raw_response.headers)
+            response = raw_response.parse()
+            rate_limiter.record_usage(estimated_tokens, response.usage.total_tokens if response.usage else None)
+            if response.usage:
+                call.prompt_tokens = response.usage.prompt_tokens
+                call.completion_tokens = response.usage.completion_tokens
+            response_content = response.choices[0].message.content
+            if use_cache and response_content is not None:
+                await asyncio.to_thread(response_cache.put, cache_key, llm_model=llm_model, response=response_content)
+
+        output = response_content
+        return output
 
 
 if __name__ == "__main__":
@@ -1,7 +1,22 @@
 from openai import AsyncOpenAI
 
+from skellybot_analysis.ai.clients.rate_limiter import AdaptiveRateLimiter
+from skellybot_analysis.ai.clients.retry_policy import RetryEngine
 from skellybot_analysis.utilities.load_env_variables import OPENAI_API_KEY
 
-OPENAI_CLIENT = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# retries are handled by OPENAI_RETRY_ENGINE (so every attempt goes through the rate limiter)
+OPENAI_CLIENT = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 DEFAULT_LLM = "gpt-4o-mini"
 MAX_TOKEN_LENGTH = int(128_000 * .9)
+
+# Starting budgets - resynced from the `x-ratelimit-*` headers of the first response
+DEFAULT_OPENAI_REQUESTS_PER_MINUTE = 500
+DEFAULT_OPENAI_TOKENS_PER_MINUTE = 200_000
+DEFAULT_OPENAI_MAX_IN_FLIGHT = 32
+
+# shared by every OpenAI call, so concurrent stages draw from the same budget
+OPENAI_RATE_LIMITER = AdaptiveRateLimiter(name="openai",
+                                          requests_per_minute=DEFAULT_OPENAI_REQUESTS_PER_MINUTE,
+                                          tokens_per_minute=DEFAULT_OPENAI_TOKENS_PER_MINUTE,
+                                          max_in_flight=DEFAULT_OPENAI_MAX_IN_FLIGHT)
+OPENAI_RETRY_ENGINE = RetryEngine(name="openai")
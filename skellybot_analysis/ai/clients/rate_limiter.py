@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Mapping
+
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_MINUTE = 60.0
+ADDITIVE_INCREASE_EVERY_N_SUCCESSES = 10
+_DURATION_PART_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNIT_SECONDS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_duration(value: str | None) -> float | None:
+    """Parse the rate limit header durations (e.g. "20ms", "1s", "6m0s") or plain seconds (`Retry-After`)"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNIT_SECONDS[unit] for amount, unit in parts)
+
+
+def _parse_int(value: str | None) -> int | None:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    Client-side limiter for an LLM API with requests-per-minute and tokens-per-minute budgets.
+
+    - RPM/TPM are continuously refilling buckets, each request takes 1 request + its estimated tokens
+    - the number of in-flight requests is capped, the cap is halved on every 429 and grows back by one
+      every few successful requests (AIMD)
+    - the `x-ratelimit-*` response headers resync the budgets with what the server reports, and a 429's
+      `Retry-After` pauses all new requests
+    """
+
+    def __init__(self,
+                 name: str,
+                 requests_per_minute: int,
+                 tokens_per_minute: int,
+                 max_in_flight: int,
+                 min_in_flight: int = 1):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+
+        self.in_flight_limit = max_in_flight
+        self.in_flight = 0
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._successes_since_increase = 0
+        self._condition: asyncio.Condition | None = None
+        self._condition_loop: asyncio.AbstractEventLoop | None = None
+
+        self.total_requests = 0
+        self.total_rate_limited = 0
+
+    @property
+    def _lock(self) -> asyncio.Condition:
+        # created lazily so the limiter can be built at import time, outside of any event loop - and again for every
+        # new loop (e.g. a second `asyncio.run`), an asyncio.Condition only works on the loop it was first used on
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._condition_loop is not loop:
+            self._condition = asyncio.Condition()
+            self._condition_loop = loop
+            self.in_flight = 0  # requests of an earlier loop can't still be running
+        return self._condition
+
+    @property
+    def is_paused(self) -> bool:
+        """Whether new requests are on hold after a 429"""
+        return time.monotonic() < self._paused_until
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._available_requests = min(float(self.requests_per_minute),
+                                       self._available_requests + elapsed * self.requests_per_minute / SECONDS_PER_MINUTE)
+        self._available_tokens = min(float(self.tokens_per_minute),
+                                     self._available_tokens + elapsed * self.tokens_per_minute / SECONDS_PER_MINUTE)
+
+    def _seconds_until_available(self, tokens: int) -> float:
+        """0 if a request of `tokens` can start now, otherwise how long until it (probably) can"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.in_flight >= self.in_flight_limit:
+            return float("inf")  # woken up by `release`
+        # a request bigger than the whole token budget only needs a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        missing_requests = max(0.0, 1.0 - self._available_requests)
+        missing_tokens = max(0.0, tokens - self._available_tokens)
+        return max(missing_requests * SECONDS_PER_MINUTE / self.requests_per_minute,
+                   missing_tokens * SECONDS_PER_MINUTE / self.tokens_per_minute)
+
+    async def acquire(self, estimated_tokens: int) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                wait_seconds = self._seconds_until_available(estimated_tokens)
+                if wait_seconds <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._lock.wait(),
+                                           timeout=None if wait_seconds == float("inf") else wait_seconds)
+                except asyncio.TimeoutError:
+                    pass
+            self._available_requests -= 1
+            self._available_tokens -= min(estimated_tokens, self.tokens_per_minute)
+            self.in_flight += 1
+            self.total_requests += 1
+
+    async def release(self, rate_limited: bool = False) -> None:
+        async with self._lock:
+            self.in_flight -= 1
+            if rate_limited:
+                self._successes_since_increase = 0
+            else:
+                self._successes_since_increase += 1
+                if (self._successes_since_increase >= ADDITIVE_INCREASE_EVERY_N_SUCCESSES
+                        and self.in_flight_limit < self.max_in_flight):
+                    self.in_flight_limit += 1
+                    self._successes_since_increase = 0
+            self._lock.notify_all()
+
+    @asynccontextmanager
+    async def limit(self, estimated_tokens: int) -> AsyncIterator["AdaptiveRateLimiter"]:
+        """`async with limiter.limit(tokens):` around a single API call"""
+        await self.acquire(estimated_tokens)
+        rate_limited = False
+        try:
+            yield self
+        except Exception as e:
+            rate_limited = getattr(e, "status_code", None) == 429
+            raise
+        finally:
+            await self.release(rate_limited=rate_limited)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int | None) -> None:
+        """Correct the token bucket once the real usage of a request is known"""
+        if actual_tokens is None:
+            return
+        self._available_tokens += min(estimated_tokens, self.tokens_per_minute) - actual_tokens
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """Resync the budgets with the `x-ratelimit-*` headers of a response"""
+        limit_requests = _parse_int(headers.get("x-ratelimit-limit-requests"))
+        limit_tokens = _parse_int(headers.get("x-ratelimit-limit-tokens"))
+        remaining_requests = _parse_int(headers.get("x-ratelimit-remaining-requests"))
+        remaining_tokens = _parse_int(headers.get("x-ratelimit-remaining-tokens"))
+        if limit_requests:
+            self.requests_per_minute = limit_requests
+        if limit_tokens:
+            self.tokens_per_minute = limit_tokens
+        self._refill()
+        if remaining_requests is not None:
+            self._available_requests = min(self._available_requests, float(remaining_requests))
+        if remaining_tokens is not None:
+            self._available_tokens = min(self._available_tokens, float(remaining_tokens))
+
+    def on_rate_limited(self, headers: Mapping[str, str] | None = None) -> None:
+        """Back off after a 429: halve the in-flight cap and pause new requests until the server's reset time"""
+        self.total_rate_limited += 1
+        self.in_flight_limit = max(self.min_in_flight, self.in_flight_limit // 2)
+        headers = headers or {}
+        pause_seconds = (parse_reset_duration(headers.get("retry-after"))
+                         or max(parse_reset_duration(headers.get("x-ratelimit-reset-requests")) or 0.0,
+                                parse_reset_duration(headers.get("x-ratelimit-reset-tokens")) or 0.0)
+                         or 1.0)
+        self._paused_until = max(self._paused_until, time.monotonic() + pause_seconds)
+        logger.warning(f"[{self.name}] rate limited (429) - pausing {pause_seconds:.1f}s, "
+                       f"max in-flight requests reduced to {self.in_flight_limit}")
@@ -0,0 +1,166 @@
+import asyncio
+import enum
+import logging
+import random
+import time
+from typing import Awaitable, Callable, TypeVar
+
+import anthropic
+import httpx
+import openai
+from pydantic import BaseModel
+
+from skellybot_analysis.ai.clients.call_metrics import note_retry
+from skellybot_analysis.ai.clients.rate_limiter import parse_reset_duration
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MAX_RETRY_AFTER_SECONDS = 300.0
+
+
+class ErrorClass(enum.Enum):
+    RATE_LIMIT = "rate_limit"  # 429
+    SERVER = "server"  # 5xx, 408 (timeout), 409 (lock conflict)
+    NETWORK = "network"  # connection errors and timeouts, no response at all
+    PERMANENT = "permanent"  # everything else - bad request, auth, validation, bugs...
+
+
+def classify_error(error: BaseException) -> ErrorClass:
+    status_code = getattr(error, "status_code", None)
+    if status_code == 429:
+        return ErrorClass.RATE_LIMIT
+    if isinstance(status_code, int) and (status_code >= 500 or status_code in (408, 409)):
+        return ErrorClass.SERVER
+    # the anthropic SDK's connection/timeout errors don't subclass the openai/httpx ones
+    if isinstance(error, (openai.APIConnectionError, anthropic.APIConnectionError, httpx.TransportError,
+                          ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return ErrorClass.NETWORK
+    return ErrorClass.PERMANENT
+
+
+def retry_after_seconds(error: BaseException) -> float | None:
+    """The server's requested wait (`retry-after-ms` / `Retry-After` headers), if the error carries a response"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_after_ms = parse_reset_duration(headers.get("retry-after-ms"))
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return parse_reset_duration(headers.get("retry-after"))
+
+
+class RetryPolicy(BaseModel):
+    max_attempts: int
+    base_delay_seconds: float = 1.0
+    max_delay_seconds: float = 60.0
+    jitter_ratio: float = 0.5  # up to this fraction of each backoff delay is randomly taken off
+    respect_retry_after: bool = True
+
+    def delay_seconds(self, attempt: int, error: BaseException) -> float:
+        """How long to wait after failed attempt number `attempt` (1-based)"""
+        if self.respect_retry_after:
+            retry_after = retry_after_seconds(error)
+            if retry_after is not None:
+                return min(retry_after, MAX_RETRY_AFTER_SECONDS)
+        backoff = min(self.max_delay_seconds, self.base_delay_seconds * 2 ** (attempt - 1))
+        return backoff * (1 - self.jitter_ratio * random.random())
+
+
+DEFAULT_RETRY_POLICIES: dict[ErrorClass, RetryPolicy] = {
+    ErrorClass.RATE_LIMIT: RetryPolicy(max_attempts=6, base_delay_seconds=2.0, max_delay_seconds=60.0),
+    ErrorClass.SERVER: RetryPolicy(max_attempts=4, base_delay_seconds=1.0, max_delay_seconds=30.0),
+    ErrorClass.NETWORK: RetryPolicy(max_attempts=4, base_delay_seconds=1.0, max_delay_seconds=30.0),
+}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast once a service looks down: after `failure_threshold` consecutive server/network failures the
+    circuit opens and every call is rejected for `reset_timeout_seconds`, then a single trial call is let through
+    (half-open) - its success closes the circuit again, its failure re-opens it.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 10, reset_timeout_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.consecutive_failures = 0
+        self._opened_at: float | None = None
+        self._trial_in_progress = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self) -> None:
+        if self._opened_at is None:
+            return
+        if time.monotonic() - self._opened_at < self.reset_timeout_seconds or self._trial_in_progress:
+            raise CircuitOpenError(f"[{self.name}] circuit open after {self.consecutive_failures} consecutive failures")
+        self._trial_in_progress = True
+
+    def record_success(self) -> None:
+        if self._opened_at is not None:
+            logger.info(f"[{self.name}] circuit closed")
+        self.consecutive_failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self._trial_in_progress or (self._opened_at is None and self.consecutive_failures >= self.failure_threshold):
+            logger.error(f"[{self.name}] circuit opened after {self.consecutive_failures} consecutive failures - "
+                         f"failing calls fast for {self.reset_timeout_seconds}s")
+            self._opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+
+class RetryEngine:
+    """
+    Runs an async call with the retry policy of each error's class (see `classify_error`), waiting the jittered
+    exponential backoff or the server's `Retry-After` between attempts, behind a shared circuit breaker.
+    Error classes without a policy (e.g. `ErrorClass.PERMANENT`) are raised immediately.
+    """
+
+    def __init__(self,
+                 name: str,
+                 policies: dict[ErrorClass, RetryPolicy] | None = None,
+                 circuit_breaker: CircuitBreaker | None = None):
+        self.name = name
+        self.policies = policies if policies is not None else DEFAULT_RETRY_POLICIES
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(name=name)
+        self.total_retries = 0
+
+    async def run(self, call: Callable[[], Awaitable[T]], description: str = "call") -> T:
+        attempts_by_class: dict[ErrorClass, int] = {}
+        while True:
+            self.circuit_breaker.before_call()
+            try:
+                result = await call()
+            except Exception as error:
+                error_class = classify_error(error)
+                if error_class in (ErrorClass.SERVER, ErrorClass.NETWORK):
+                    self.circuit_breaker.record_failure()
+                else:
+                    self.circuit_breaker.record_success()  # the service answered, it just didn't like the request
+                policy = self.policies.get(error_class)
+                attempts_by_class[error_class] = attempts_by_class.get(error_class, 0) + 1
+                attempt = attempts_by_class[error_class]
+                if policy is None or attempt >= policy.max_attempts:
+                    raise
+                delay = policy.delay_seconds(attempt=attempt, error=error)
+                self.total_retries += 1
+                note_retry()
+                logger.warning(f"[{self.name}] {description} failed ({error_class.value}: {type(error).__name__}: {error}) - "
+                               f"retrying in {delay:.1f}s (attempt {attempt + 1} of {policy.max_attempts})")
+                await asyncio.sleep(delay)
+                continue
+            self.circuit_breaker.record_success()
+            return result
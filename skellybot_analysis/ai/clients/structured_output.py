@@ -0,0 +1,299 @@
+"""
+Provider-agnostic structured output: send a prompt, get back an instance of a pydantic `prompt_model`.
+
+The analysis code only talks to a `StructuredOutputProvider`, so the same extraction (e.g. `TextAnalysisPromptModel`)
+can run against the OpenAI API, the Anthropic API or a local Ollama server (or all of them, see `llm_router.py`).
+"""
+import asyncio
+import json
+from abc import ABC, abstractmethod
+import logging
+from functools import partial
+from typing import Type, TypeVar
+
+import anthropic
+from openai import AsyncOpenAI, LengthFinishReasonError
+from pydantic import BaseModel
+
+from skellybot_analysis.ai.clients.anthropic_client import get_anthropic_client, DEFAULT_ANTHROPIC_LLM, \
+    ANTHROPIC_MAX_TOKEN_LENGTH, DEFAULT_ANTHROPIC_MAX_RESPONSE_TOKENS, ANTHROPIC_RATE_LIMITER, ANTHROPIC_RETRY_ENGINE
+from skellybot_analysis.ai.clients.call_metrics import get_call_metrics_recorder
+from skellybot_analysis.ai.clients.llm_response_cache import LlmResponseCache, get_llm_response_cache
+from skellybot_analysis.ai.clients.ollama_client import get_ollama_client, DEFAULT_OLLAMA_MODEL, \
+    DEFAULT_OLLAMA_MAX_CONNECTIONS, OLLAMA_RETRY_ENGINE
+from skellybot_analysis.ai.clients.openai_client.make_openai_json_mode_ai_request import \
+    make_openai_json_mode_ai_request
+from skellybot_analysis.ai.clients.openai_client.openai_client import OPENAI_CLIENT, DEFAULT_LLM, MAX_TOKEN_LENGTH, \
+    OPENAI_RATE_LIMITER, OPENAI_RETRY_ENGINE
+from skellybot_analysis.ai.clients.rate_limiter import AdaptiveRateLimiter
+from skellybot_analysis.ai.clients.retry_policy import RetryEngine
+from skellybot_analysis.ai.tokenizer_service import get_tokenizer_service
+
+logger = logging.getLogger(__name__)
+
+PromptModel = TypeVar("PromptModel", bound=BaseModel)
+
+DEFAULT_OLLAMA_CONTEXT_LENGTH = 32_768  # Ollama's own default (2048) would silently cut off most threads
+DEFAULT_OLLAMA_MAX_CONCURRENT_REQUESTS = 4
+
+STRUCTURED_OUTPUT_PROVIDERS: dict[tuple[str, str], "StructuredOutputProvider"] = {}
+
+
+class ResponseTruncatedError(Exception):
+    """The model hit its output length limit before finishing the structured response"""
+
+
+class StructuredOutputProvider(ABC):
+    """
+    Base class for the LLM backends. `max_input_tokens` is the prompt budget (context window minus the room needed
+    for the response), callers use it to decide when a text needs to be truncated or chunked.
+    """
+    provider_name: str = "base"
+
+    def __init__(self, llm_model: str, max_input_tokens: int):
+        self.llm_model = llm_model
+        self.max_input_tokens = max_input_tokens
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider_name}/{self.llm_model}"
+
+    @property
+    def is_available(self) -> bool:
+        """False while the provider is known to be throttled or down (so a router can send requests elsewhere)"""
+        return True
+
+    @property
+    def stats_summary(self) -> str | None:
+        """Usage statistics worth logging after a batch of requests, if the provider keeps any"""
+        return None
+
+    @abstractmethod
+    async def make_structured_request(self,
+                                      system_prompt: str,
+                                      prompt_model: Type[PromptModel],
+                                      user_input: str | None = None,
+                                      estimated_tokens: int | None = None) -> PromptModel:
+        """Raises `ResponseTruncatedError` if the response was cut off by the output length limit"""
+
+
+class OpenAiStructuredOutputProvider(StructuredOutputProvider):
+    provider_name = "openai"
+
+    def __init__(self,
+                 llm_model: str = DEFAULT_LLM,
+                 client: AsyncOpenAI = OPENAI_CLIENT,
+                 max_input_tokens: int = MAX_TOKEN_LENGTH,
+                 rate_limiter: AdaptiveRateLimiter = OPENAI_RATE_LIMITER,
+                 retry_engine: RetryEngine = OPENAI_RETRY_ENGINE):
+        super().__init__(llm_model=llm_model, max_input_tokens=max_input_tokens)
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.retry_engine = retry_engine
+
+    @property
+    def is_available(self) -> bool:
+        return not self.rate_limiter.is_paused and not self.retry_engine.circuit_breaker.is_open
+
+    async def make_structured_request(self,
+                                      system_prompt: str,
+                                      prompt_model: Type[PromptModel],
+                                      user_input: str | None = None,
+                                      estimated_tokens: int | None = None) -> PromptModel:
+        try:
+            return await make_openai_json_mode_ai_request(client=self.client,
+                                                          system_prompt=system_prompt,
+                                                          prompt_model=prompt_model,
+                                                          llm_model=self.llm_model,
+                                                          user_input=user_input,
+                                                          estimated_tokens=estimated_tokens,
+                                                          rate_limiter=self.rate_limiter,
+                                                          retry_engine=self.retry_engine)
+        except LengthFinishReasonError as e:
+            raise ResponseTruncatedError(str(e)) from e
+
+
+class AnthropicStructuredOutputProvider(StructuredOutputProvider):
+    """
+    Claude models - the prompt model's JSON schema is the input schema of a single tool the model is forced to call,
+    the tool call's input is the structured response.
+    """
+    provider_name = "anthropic"
+
+    def __init__(self,
+                 llm_model: str = DEFAULT_ANTHROPIC_LLM,
+                 max_input_tokens: int = ANTHROPIC_MAX_TOKEN_LENGTH,
+                 max_response_tokens: int = DEFAULT_ANTHROPIC_MAX_RESPONSE_TOKENS,
+                 rate_limiter: AdaptiveRateLimiter = ANTHROPIC_RATE_LIMITER,
+                 retry_engine: RetryEngine = ANTHROPIC_RETRY_ENGINE,
+                 response_cache: LlmResponseCache | None = None,
+                 use_cache: bool = True):
+        super().__init__(llm_model=llm_model, max_input_tokens=max_input_tokens)
+        self.client = get_anthropic_client()
+        self.max_response_tokens = max_response_tokens
+        self.rate_limiter = rate_limiter
+        self.retry_engine = retry_engine
+        self.response_cache = response_cache
+        self.use_cache = use_cache
+
+    @property
+    def is_available(self) -> bool:
+        return not self.rate_limiter.is_paused and not self.retry_engine.circuit_breaker.is_open
+
+    async def make_structured_request(self,
+                                      system_prompt: str,
+                                      prompt_model: Type[PromptModel],
+                                      user_input: str | None = None,
+                                      estimated_tokens: int | None = None) -> PromptModel:
+        tool_name = prompt_model.__name__
+        response_schema = prompt_model.model_json_schema()
+        # the messages API needs at least one user turn
+        messages = [{"role": "user", "content": user_input or f"Provide your response with the `{tool_name}` tool."}]
+
+        with get_call_metrics_recorder().track(kind="chat", provider=self.provider_name, model=self.llm_model) as call:
+            if self.use_cache:
+                response_cache = self.response_cache or get_llm_response_cache()
+                cache_key = response_cache.make_key(llm_model=self.name,
+                                                    system_prompt=system_prompt,
+                                                    response_schema=response_schema,
+                                                    user_input=user_input)
+            cached_response = (await asyncio.to_thread(response_cache.get_validated, cache_key, prompt_model)
+                               if self.use_cache else None)
+            call.cache_hit = cached_response is not None
+            if cached_response is not None:
+                return cached_response
+
+            if estimated_tokens is None:
+                estimated_tokens = get_tokenizer_service(self.llm_model).count_tokens(system_prompt + (user_input or ""))
+
+            async def call_api():
+                async with self.rate_limiter.limit(estimated_tokens):
+                    try:
+                        return await self.client.messages.create(
+                            model=self.llm_model,
+                            max_tokens=self.max_response_tokens,
+                            system=system_prompt,
+                            messages=messages,
+                            tools=[{"name": tool_name,
+                                    "description": prompt_model.__doc__ or f"Record the {tool_name} response",
+                                    "input_schema": response_schema}],
+                            tool_choice={"type": "tool", "name": tool_name},
+                            temperature=0.0,
+                        )
+                    except anthropic.RateLimitError as e:
+                        self.rate_limiter.on_rate_limited(e.response.headers)
+                        raise
+
+            response = await self.retry_engine.run(call_api, description=f"{self.name} structured request")
+            self.rate_limiter.record_usage(estimated_tokens, response.usage.input_tokens + response.usage.output_tokens)
+            call.prompt_tokens = response.usage.input_tokens
+            call.completion_tokens = response.usage.output_tokens
+            if response.stop_reason == "max_tokens":
+                raise ResponseTruncatedError(f"{self.name} response hit the length limit "
+                                             f"({response.usage.output_tokens} completion tokens)")
+            tool_input = next(block.input for block in response.content if block.type == "tool_use")
+            validated_response = prompt_model.model_validate(tool_input)
+            if self.use_cache:  # only responses that validate are cached
+                await asyncio.to_thread(response_cache.put, cache_key, llm_model=self.name,
+                                        response=json.dumps(tool_input))
+            return validated_response
+
+
+class OllamaStructuredOutputProvider(StructuredOutputProvider):
+    """
+    Local models over Ollama: the response is constrained to the prompt model's JSON schema (Ollama's `format`),
+    requests share a pooled client and at most `max_concurrent_requests` run at once (a CPU/GPU box slows down,
+    rather than speeds up, when it's sent more parallel requests than it has slots for).
+    """
+    provider_name = "ollama"
+
+    def __init__(self,
+                 llm_model: str = DEFAULT_OLLAMA_MODEL,
+                 host: str | None = None,
+                 context_length: int = DEFAULT_OLLAMA_CONTEXT_LENGTH,
+                 max_concurrent_requests: int = DEFAULT_OLLAMA_MAX_CONCURRENT_REQUESTS,
+                 max_connections: int = DEFAULT_OLLAMA_MAX_CONNECTIONS,
+                 retry_engine: RetryEngine = OLLAMA_RETRY_ENGINE,
+                 response_cache: LlmResponseCache | None = None,
+                 use_cache: bool = True):
+        super().__init__(llm_model=llm_model, max_input_tokens=int(context_length * .75))
+        self.client = get_ollama_client(host=host, max_connections=max(max_connections, max_concurrent_requests))
+        self.context_length = context_length
+        self.max_concurrent_requests = max_concurrent_requests
+        self.retry_engine = retry_engine
+        self.response_cache = response_cache
+        self.use_cache = use_cache
+        self._semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    @property
+    def is_available(self) -> bool:
+        return not self.retry_engine.circuit_breaker.is_open
+
+    async def make_structured_request(self,
+                                      system_prompt: str,
+                                      prompt_model: Type[PromptModel],
+                                      user_input: str | None = None,
+                                      estimated_tokens: int | None = None) -> PromptModel:
+        messages = [{"role": "system", "content": system_prompt}]
+        if user_input is not None:
+            messages.append({"role": "user", "content": user_input})
+        response_schema = prompt_model.model_json_schema()
+
+        with get_call_metrics_recorder().track(kind="chat", provider=self.provider_name, model=self.llm_model) as call:
+            if self.use_cache:
+                response_cache = self.response_cache or get_llm_response_cache()
+                cache_key = response_cache.make_key(llm_model=self.name,
+                                                    system_prompt=system_prompt,
+                                                    response_schema=response_schema,
+                                                    user_input=user_input)
+            cached_response = (await asyncio.to_thread(response_cache.get_validated, cache_key, prompt_model)
+                               if self.use_cache else None)
+            call.cache_hit = cached_response is not None
+            if cached_response is not None:
+                return cached_response
+
+            async with self._semaphore:
+                response = await self.retry_engine.run(
+                    partial(self.client.chat,
+                            model=self.llm_model,
+                            messages=messages,
+                            format=response_schema,
+                            options={"temperature": 0.0, "num_ctx": self.context_length}),
+                    description=f"{self.name} structured request")
+            call.prompt_tokens = response.prompt_eval_count or 0
+            call.completion_tokens = response.eval_count or 0
+            if response.done_reason == "length":
+                raise ResponseTruncatedError(f"{self.name} response hit the length limit "
+                                             f"({response.eval_count} completion tokens)")
+            response_content = response.message.content
+            validated_response = prompt_model.model_validate_json(response_content)
+            if self.use_cache:  # only responses that validate are cached
+                await asyncio.to_thread(response_cache.put, cache_key, llm_model=self.name, response=response_content)
+            return validated_response
+
+
+def get_structured_output_provider(provider_name: str = "openai", llm_model: str | None = None) -> StructuredOutputProvider:
+    """Shared provider per (provider, model) - e.g. `get_structured_output_provider("ollama", "llama3.2")`"""
+    provider_classes = {provider_class.provider_name: provider_class
+                        for provider_class in (OpenAiStructuredOutputProvider,
+                                               AnthropicStructuredOutputProvider,
+                                               OllamaStructuredOutputProvider)}
+    if provider_name not in provider_classes:
+        raise ValueError(f"Unknown structured output provider '{provider_name}', "
+                         f"expected one of {sorted(provider_classes)}")
+    key = (provider_name, llm_model or "")
+    if key not in STRUCTURED_OUTPUT_PROVIDERS:
+        provider_class = provider_classes[provider_name]
+        STRUCTURED_OUTPUT_PROVIDERS[key] = provider_class(llm_model=llm_model) if llm_model else provider_class()
+    return STRUCTURED_OUTPUT_PROVIDERS[key]
+
+
+if __name__ == "__main__":
+    from skellybot_analysis.data_models.prompt_models import TextAnalysisPromptModel
+
+    _provider = get_structured_output_provider("ollama")
+    _text = ("The quick brown fox jumps over the lazy dog. Foxes are mammals. The mammalian nervous system includes "
+             "the basal ganglia, the cerebellum, and the cerebral cortex, among other structures.")
+    _result = asyncio.run(_provider.make_structured_request(system_prompt=f"Analyze the following text:\n\n{_text}",
+                                                            prompt_model=TextAnalysisPromptModel))
+    print(_result.model_dump_json(indent=2))
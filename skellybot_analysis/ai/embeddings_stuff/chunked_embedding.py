@@ -0,0 +1,85 @@
+import enum
+import logging
+
+import numpy as np
+
+from skellybot_analysis.ai.tokenizer_service import get_tokenizer_service
+
+logger = logging.getLogger(__name__)
+
+# context window (in the model's own tokens) of the embedding models we use
+EMBEDDING_MODEL_MAX_TOKENS: dict[str, int] = {
+    "mxbai-embed-large": 512,
+    "nomic-embed-text": 8192,
+    "all-minilm": 256,
+    "all-MiniLM-L6-v2": 256,
+    "text-embedding-3-small": 8191,
+    "text-embedding-3-large": 8191,
+}
+DEFAULT_EMBEDDING_MODEL_MAX_TOKENS = 512
+# chunks are counted with tiktoken, non-OpenAI models (e.g. BERT wordpiece tokenizers) split the same text into
+# more tokens - so their chunks are kept to this fraction of the context window
+FOREIGN_TOKENIZER_SAFETY_RATIO = 0.6
+EMBEDDING_CHUNK_OVERLAP_RATIO = 0.05
+
+
+class PoolingMethod(enum.Enum):
+    MEAN = "mean"  # every chunk counts the same
+    LENGTH_WEIGHTED = "length_weighted"  # chunks are weighted by their token count (a short tail chunk counts less)
+
+
+DEFAULT_POOLING_METHOD = PoolingMethod.LENGTH_WEIGHTED
+
+
+def max_chunk_tokens(embedding_model: str) -> int:
+    max_tokens = EMBEDDING_MODEL_MAX_TOKENS.get(embedding_model, DEFAULT_EMBEDDING_MODEL_MAX_TOKENS)
+    if embedding_model.startswith("text-embedding"):
+        return max_tokens
+    return int(max_tokens * FOREIGN_TOKENIZER_SAFETY_RATIO)
+
+
+def chunk_text_for_embedding(text: str, embedding_model: str) -> tuple[list[str], list[int]]:
+    """The text split into chunks that fit the embedding model's context, and the token count of each chunk"""
+    tokenizer = get_tokenizer_service(embedding_model)
+    tokens = tokenizer.encode(text)
+    max_tokens = max_chunk_tokens(embedding_model)
+    if len(tokens) <= max_tokens:
+        return [text], [max(len(tokens), 1)]
+    chunks = tokenizer.chunk_tokens(tokens=tokens, max_tokens=max_tokens, overlap_ratio=EMBEDDING_CHUNK_OVERLAP_RATIO)
+    return chunks, [max(count, 1) for count in tokenizer.count_tokens_batch(chunks)]
+
+
+class ChunkedTexts:
+    """
+    Texts flattened into their embedding chunks - embed `chunks` (in any batching/concurrency), then `pool` the
+    chunk embeddings back into one vector per text.
+    """
+
+    def __init__(self, texts: list[str], embedding_model: str):
+        self.chunks: list[str] = []
+        self.chunk_token_counts: list[int] = []
+        self.chunk_counts: list[int] = []
+        for text in texts:
+            chunks, token_counts = chunk_text_for_embedding(text, embedding_model)
+            self.chunks.extend(chunks)
+            self.chunk_token_counts.extend(token_counts)
+            self.chunk_counts.append(len(chunks))
+        chunked_texts = sum(1 for count in self.chunk_counts if count > 1)
+        if chunked_texts:
+            logger.info(f"Split {chunked_texts} of {len(texts)} texts that are too long for {embedding_model} "
+                        f"into chunks ({len(self.chunks)} chunks in total)")
+
+    def pool(self, chunk_embeddings: np.ndarray, pooling: PoolingMethod = DEFAULT_POOLING_METHOD) -> np.ndarray:
+        """(n_chunks, dim) chunk embeddings -> (n_texts, dim) text embeddings"""
+        chunk_embeddings = np.asarray(chunk_embeddings, dtype=np.float32)
+        if chunk_embeddings.shape[0] != len(self.chunks):
+            raise ValueError(f"Got {chunk_embeddings.shape[0]} embeddings for {len(self.chunks)} chunks")
+        pooled = np.empty((len(self.chunk_counts), chunk_embeddings.shape[1]), dtype=np.float32)
+        start = 0
+        for text_index, chunk_count in enumerate(self.chunk_counts):
+            embeddings = chunk_embeddings[start:start + chunk_count]
+            weights = (np.asarray(self.chunk_token_counts[start:start + chunk_count], dtype=np.float32)
+                       if pooling == PoolingMethod.LENGTH_WEIGHTED else None)
+            pooled[text_index] = np.average(embeddings, axis=0, weights=weights)
+            start += chunk_count
+        return pooled
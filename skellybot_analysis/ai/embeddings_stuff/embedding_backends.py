@@ -0,0 +1,131 @@
+"""
+Embedding backends behind one batch interface - `get_embedding_backend("ollama" | "openai" | "sentence_transformers")`.
+"""
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from skellybot_analysis.ai.clients.call_metrics import get_call_metrics_recorder
+from skellybot_analysis.ai.clients.openai_client.openai_client import OPENAI_CLIENT
+from skellybot_analysis.ai.embeddings_stuff.ollama_embedding import DEFAULT_OLLAMA_EMBEDDINGS_MODEL, \
+    calculate_ollama_embeddings
+from skellybot_analysis.ai.embeddings_stuff.openai_embedding import DEFAULT_OPENAI_EMDEDDINGS_MODEL, \
+    DEFAULT_HUGGINGFACE_EMBEDDINGS_MODEL, get_embeddings_for_texts_openai
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SENTENCE_TRANSFORMERS_BATCH_SIZE = 64
+
+EMBEDDING_BACKENDS: dict[tuple[str, str], "EmbeddingBackend"] = {}
+
+
+class EmbeddingBackend(ABC):
+    """
+    Embeds a batch of texts (each already short enough for the model, see `chunked_embedding.py`) into an
+    (n_texts, dim) float32 matrix - rows of texts that could not be embedded (after retries) are NaN, it raises if
+    none of them could be.
+    """
+    backend_name = "base"
+    default_model = ""
+
+    def __init__(self, model: str | None = None):
+        self.model = model or self.default_model
+
+    @property
+    def name(self) -> str:
+        """Recorded as the `embedding_method` of the embedded items, and part of the embedding cache key"""
+        return f"{self.backend_name}/{self.model}"
+
+    @abstractmethod
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        pass
+
+
+class OllamaEmbeddingBackend(EmbeddingBackend):
+    backend_name = "ollama"
+    default_model = DEFAULT_OLLAMA_EMBEDDINGS_MODEL
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        embeddings = await calculate_ollama_embeddings(texts, model=self.model, raise_on_failure=False)
+        dimensions = next((len(embedding) for embedding in embeddings if embedding is not None), None)
+        if dimensions is None:
+            raise RuntimeError(f"All {len(texts)} texts failed to embed with {self.name}")
+        return np.asarray([embedding if embedding is not None else [np.nan] * dimensions for embedding in embeddings],
+                          dtype=np.float32)
+
+
+class OpenAiEmbeddingBackend(EmbeddingBackend):
+    backend_name = "openai"
+    default_model = DEFAULT_OPENAI_EMDEDDINGS_MODEL
+
+    def __init__(self, model: str | None = None):
+        super().__init__(model=model)
+        self.client = OPENAI_CLIENT
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        embeddings, _ = await get_embeddings_for_texts_openai(client=self.client,
+                                                              texts_to_embed=texts,
+                                                              embedding_model=self.model)
+        return embeddings
+
+
+class SentenceTransformersEmbeddingBackend(EmbeddingBackend):
+    """In-process CPU (or GPU, if torch finds one) model - no server needed, needs `pip install sentence-transformers`"""
+    backend_name = "sentence_transformers"
+    default_model = DEFAULT_HUGGINGFACE_EMBEDDINGS_MODEL
+
+    def __init__(self, model: str | None = None, batch_size: int = DEFAULT_SENTENCE_TRANSFORMERS_BATCH_SIZE):
+        super().__init__(model=model)
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError("The sentence_transformers embedding backend needs the `sentence-transformers` package "
+                              "(`pip install sentence-transformers`)") from e
+        self.batch_size = batch_size
+        self._model = SentenceTransformer(self.model)
+        self._lock = asyncio.Lock()  # one encode at a time - it already uses every core
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        async with self._lock:
+            with get_call_metrics_recorder().track(kind="embedding", provider=self.backend_name, model=self.model):
+                embeddings = await asyncio.to_thread(self._model.encode,
+                                                     texts,
+                                                     batch_size=self.batch_size,
+                                                     convert_to_numpy=True,
+                                                     show_progress_bar=False)
+        return np.asarray(embeddings, dtype=np.float32)
+
+
+def get_embedding_backend(backend_name: str = "ollama", model: str | None = None) -> EmbeddingBackend:
+    """Shared backend per (backend, model) - e.g. `get_embedding_backend("sentence_transformers")` to embed offline"""
+    backend_classes = {backend_class.backend_name: backend_class
+                       for backend_class in (OllamaEmbeddingBackend,
+                                             OpenAiEmbeddingBackend,
+                                             SentenceTransformersEmbeddingBackend)}
+    if backend_name not in backend_classes:
+        raise ValueError(f"Unknown embedding backend '{backend_name}', expected one of {sorted(backend_classes)}")
+    key = (backend_name, model or "")
+    if key not in EMBEDDING_BACKENDS:
+        EMBEDDING_BACKENDS[key] = backend_classes[backend_name](model=model)
+    return EMBEDDING_BACKENDS[key]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    _texts = [f"Message #{index}: how does the cerebellum help with motor learning and gaze stabilization?"
+              for index in range(1000)]
+
+    async def _benchmark(backend: EmbeddingBackend) -> float:
+        _start = time.perf_counter()
+        await backend.embed(_texts)
+        return len(_texts) / (time.perf_counter() - _start)
+
+    for _backend_name in ("ollama", "openai", "sentence_transformers"):
+        try:
+            _backend = get_embedding_backend(_backend_name)
+            print(f"{_backend.name:>45}: {asyncio.run(_benchmark(_backend)):8.1f} texts/s")
+        except Exception as _error:
+            print(f"{_backend_name:>45}: unavailable ({type(_error).__name__}: {_error})")
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+import numpy as np
+
+from skellybot_analysis.ai.clients.llm_response_cache import LlmCacheStats
+from skellybot_analysis.system.files_and_folder_names import get_skellybot_analysis_data_folder_path
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_FILENAME = "embedding_cache.sqlite"
+DEFAULT_MAX_EMBEDDING_CACHE_ENTRIES = 1_000_000
+DEFAULT_MAX_EMBEDDING_CACHE_AGE_DAYS = 365.0
+EVICT_EVERY_N_WRITES = 10_000
+SQLITE_MAX_VARIABLES = 500  # keys per `IN (...)` lookup
+
+EMBEDDING_CACHE = None
+
+
+def normalize_text(text: str) -> str:
+    """Unicode (NFC) and line-ending normalized, stripped text - texts that only differ in these share an embedding"""
+    return unicodedata.normalize("NFC", text).replace("\r\n", "\n").strip()
+
+
+class EmbeddingCache:
+    """
+    On-disk (SQLite) cache of embedding vectors (float32 blobs), keyed by a hash of the embedding model and the
+    normalized text. Entries older than `max_age_days` (since last use) are evicted, as are the least recently used
+    entries beyond `max_entries`. Safe to use from several threads (e.g. via `asyncio.to_thread`).
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 max_entries: int = DEFAULT_MAX_EMBEDDING_CACHE_ENTRIES,
+                 max_age_days: float = DEFAULT_MAX_EMBEDDING_CACHE_AGE_DAYS):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._writes_since_eviction = 0
+        self._lock = threading.RLock()  # one transaction at a time on the shared connection
+
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                dimensions INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used_at ON embeddings (last_used_at)")
+        self._connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: list[str]) -> list[np.ndarray | None]:
+        """The cached embedding of each text (`None` for misses), in the order of the texts"""
+        keys = [self.make_key(model, text) for text in texts]
+        found: dict[str, np.ndarray] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique_keys), SQLITE_MAX_VARIABLES):
+                key_batch = unique_keys[start:start + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(key_batch))
+                for key, vector in self._connection.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", key_batch):
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+                now = time.time()
+                self._connection.execute(f"UPDATE embeddings SET last_used_at = ? WHERE key IN ({placeholders})",
+                                         (now, *key_batch))
+            self._connection.commit()
+            embeddings = [found.get(key) for key in keys]
+            hits = sum(1 for embedding in embeddings if embedding is not None)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return embeddings
+
+    def put_many(self, model: str, texts: list[str], embeddings: list[list[float]] | np.ndarray) -> None:
+        now = time.time()
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32)
+            rows.append((self.make_key(model, text), model, vector.shape[0], vector.tobytes(), now, now))
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dimensions, vector, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._connection.commit()
+            self._writes_since_eviction += len(rows)
+            if self._writes_since_eviction >= EVICT_EVERY_N_WRITES:
+                self.evict()
+
+    def evict(self) -> int:
+        """Drop expired and least recently used entries, returns the number of evicted entries"""
+        cutoff = time.time() - self.max_age_days * 24 * 60 * 60
+        with self._lock:
+            self._writes_since_eviction = 0
+            evicted = self._connection.execute("DELETE FROM embeddings WHERE last_used_at < ?", (cutoff,)).rowcount
+            evicted += self._connection.execute("""
+                DELETE FROM embeddings WHERE key IN (
+                    SELECT key FROM embeddings ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )""", (self.max_entries,)).rowcount
+            self._connection.commit()
+        if evicted:
+            logger.info(f"Evicted {evicted} entries from the embedding cache")
+        return evicted
+
+    @property
+    def stats(self) -> LlmCacheStats:
+        with self._lock:
+            entries, size_bytes = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+        return LlmCacheStats(hits=self.hits, misses=self.misses, entries=entries, size_bytes=size_bytes)
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global EMBEDDING_CACHE
+    if EMBEDDING_CACHE is None:
+        EMBEDDING_CACHE = EmbeddingCache(
+            db_path=str(Path(get_skellybot_analysis_data_folder_path()) / EMBEDDING_CACHE_FILENAME))
+    return EMBEDDING_CACHE
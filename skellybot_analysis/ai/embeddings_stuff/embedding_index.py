@@ -0,0 +1,307 @@
+"""
+Nearest-neighbor ("similar messages/threads/tags") search over the embedding matrix - exact blocked matmul search for
+small sets, an approximate NN-descent graph (pynndescent, which comes with umap-learn) for large ones.
+"""
+import enum
+import json
+import logging
+import pickle
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel
+
+from skellybot_analysis.ai.embeddings_stuff.embedding_backends import EmbeddingBackend
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_INDEX_FOLDER_NAME = "embedding_index"
+EMBEDDING_INDEX_INFO_FILENAME = "index_info.json"  # written last, so it only exists next to a complete index
+EXACT_INDEX_MAX_ROWS = 20_000  # above this many rows an (automatic) index is approximate
+APPROXIMATE_GRAPH_DEGREE = 30  # neighbors per node of the NN-descent graph
+APPROXIMATE_SEARCH_EPSILON = 0.1  # higher searches more of the graph (better recall, slower queries)
+FILTER_OVERFETCH_FACTOR = 4  # filtered approximate queries fetch this many times k, then filter
+SIMILARITY_BLOCK_ROWS = 1024  # query rows per similarity matmul block (keeps the block matrix small)
+DEFAULT_NEIGHBOR_COUNT = 10
+DEFAULT_BENCHMARK_QUERIES = 200
+RANDOM_SEED = 42
+
+
+class NeighborIndexKind(enum.Enum):
+    EXACT = "exact"  # blocked matmul over every (filtered) row
+    APPROXIMATE = "approximate"  # NN-descent graph search
+
+
+def normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+def cosine_top_k(queries: np.ndarray,
+                 corpus: np.ndarray,
+                 k: int,
+                 exclude_indices: np.ndarray | None = None,
+                 normalized: bool = False) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Indices (into `corpus`) and cosine similarities of the `k` most similar rows to each query, most similar first -
+    computed in blocks of query rows. `exclude_indices` (one per query) drops e.g. the query's own row from its neighbors.
+    """
+    if not normalized:
+        queries, corpus = normalize_rows(queries), normalize_rows(corpus)
+    k = max(min(k, corpus.shape[0] - (1 if exclude_indices is not None else 0)), 0)
+    neighbors = np.empty((queries.shape[0], k), dtype=np.int64)
+    similarities = np.empty((queries.shape[0], k), dtype=np.float32)
+    if k == 0:
+        return neighbors, similarities
+    for start in range(0, queries.shape[0], SIMILARITY_BLOCK_ROWS):
+        block = queries[start:start + SIMILARITY_BLOCK_ROWS] @ corpus.T
+        if exclude_indices is not None:
+            block[np.arange(block.shape[0]), exclude_indices[start:start + SIMILARITY_BLOCK_ROWS]] = -np.inf
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_similarities = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1)
+        neighbors[start:start + SIMILARITY_BLOCK_ROWS] = np.take_along_axis(top, order, axis=1)
+        similarities[start:start + SIMILARITY_BLOCK_ROWS] = np.take_along_axis(top_similarities, order, axis=1)
+    return neighbors, similarities
+
+
+class EmbeddingIndex:
+    """
+    Top-k cosine neighbors of the embedded items, optionally filtered by content type and/or channel.
+    Row `i` of the vectors is the item with `embedding_index == i` in `items` (see `EmbeddableItem`).
+    """
+
+    def __init__(self,
+                 vectors: np.ndarray,
+                 items: pd.DataFrame,
+                 kind: NeighborIndexKind | None = None,
+                 graph=None):
+        if vectors.shape[0] != len(items):
+            raise ValueError(f"Got {vectors.shape[0]} vectors for {len(items)} items")
+        start = time.perf_counter()
+        self.vectors = normalize_rows(vectors)
+        self.items = items.sort_values("embedding_index").reset_index(drop=True)
+        self.kind = kind or (NeighborIndexKind.APPROXIMATE if vectors.shape[0] > EXACT_INDEX_MAX_ROWS
+                             else NeighborIndexKind.EXACT)
+        self._graph = graph
+        if self.kind == NeighborIndexKind.APPROXIMATE and self._graph is None:
+            from pynndescent import NNDescent
+            logger.info(f"Building the approximate neighbor graph of {vectors.shape[0]} embeddings...")
+            self._graph = NNDescent(self.vectors,
+                                    metric="cosine",
+                                    n_neighbors=min(APPROXIMATE_GRAPH_DEGREE, vectors.shape[0] - 1),
+                                    random_state=RANDOM_SEED,
+                                    low_memory=True)
+            self._graph.prepare()
+        self.build_seconds = time.perf_counter() - start
+        self._content_types = self.items["content_type"].to_numpy()
+        self._channel_ids = self.items["channel_id"].fillna(-1).astype(np.int64).to_numpy()
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def embedding_method(self) -> str | None:
+        methods = self.items["embedding_method"].unique()
+        return methods[0] if len(methods) else None
+
+    def _filter_mask(self,
+                     content_types: list[str] | None = None,
+                     channel_ids: list[int] | None = None) -> np.ndarray | None:
+        if not content_types and not channel_ids:
+            return None
+        mask = np.ones(len(self), dtype=bool)
+        if content_types:
+            mask &= np.isin(self._content_types, [getattr(content_type, "value", content_type)
+                                                  for content_type in content_types])
+        if channel_ids:
+            mask &= np.isin(self._channel_ids, list(channel_ids))
+        return mask
+
+    def search(self,
+               query_vectors: np.ndarray,
+               k: int = DEFAULT_NEIGHBOR_COUNT,
+               content_types: list[str] | None = None,
+               channel_ids: list[int] | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Rows and cosine similarities of the `k` nearest items to each query vector, most similar first - rows past the
+        number of matching items are -1 (with a NaN similarity). An approximate index searches its graph (queries left
+        with fewer than `k` matches after filtering fall back to an exact search over the filtered rows), an exact
+        index searches every (filtered) row.
+        """
+        queries = normalize_rows(np.atleast_2d(query_vectors))
+        mask = self._filter_mask(content_types=content_types, channel_ids=channel_ids)
+        rows = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        similarities = np.full((queries.shape[0], k), np.nan, dtype=np.float32)
+        candidate_rows = np.flatnonzero(mask) if mask is not None else None
+        candidate_count = len(self) if candidate_rows is None else candidate_rows.size
+
+        if self.kind == NeighborIndexKind.APPROXIMATE and candidate_count > 0:
+            fetch = min(k * (FILTER_OVERFETCH_FACTOR if mask is not None else 1), len(self))
+            graph_rows, distances = self._graph.query(queries, k=fetch, epsilon=APPROXIMATE_SEARCH_EPSILON)
+            short_queries = []
+            for query_number, (query_rows, query_distances) in enumerate(zip(graph_rows, distances)):
+                keep = mask[query_rows] if mask is not None else np.ones(query_rows.size, dtype=bool)
+                kept_rows, kept_distances = query_rows[keep][:k], query_distances[keep][:k]
+                if kept_rows.size < min(k, candidate_count):
+                    short_queries.append(query_number)  # too few matches in the over-fetched neighbors
+                rows[query_number, :kept_rows.size] = kept_rows
+                similarities[query_number, :kept_rows.size] = 1 - kept_distances
+            query_numbers = np.asarray(short_queries, dtype=np.int64)
+        else:
+            query_numbers = np.arange(queries.shape[0])
+
+        if query_numbers.size:
+            corpus = self.vectors if candidate_rows is None else self.vectors[candidate_rows]
+            exact_rows, exact_similarities = cosine_top_k(queries[query_numbers], corpus, k=k, normalized=True)
+            if candidate_rows is not None:
+                exact_rows = candidate_rows[exact_rows]
+            rows[query_numbers, :exact_rows.shape[1]] = exact_rows
+            similarities[query_numbers, :exact_rows.shape[1]] = exact_similarities
+        return rows, similarities
+
+    def _neighbors_dataframe(self, rows: np.ndarray, similarities: np.ndarray) -> pd.DataFrame:
+        found = rows >= 0
+        neighbors = self.items.iloc[rows[found]].copy()
+        neighbors.insert(0, "similarity", similarities[found])
+        neighbors.insert(0, "rank", np.arange(found.sum()) + 1)
+        return neighbors.reset_index(drop=True)
+
+    def similar_items(self,
+                      embedding_index: int,
+                      k: int = DEFAULT_NEIGHBOR_COUNT,
+                      content_types: list[str] | None = None,
+                      channel_ids: list[int] | None = None) -> pd.DataFrame:
+        """The `k` items most similar to the item at `embedding_index` (not including itself), as rows of `items`"""
+        rows, similarities = self.search(self.vectors[embedding_index], k=k + 1,
+                                         content_types=content_types, channel_ids=channel_ids)
+        not_self = rows[0] != embedding_index
+        return self._neighbors_dataframe(rows[0][not_self][None, :k], similarities[0][not_self][None, :k])
+
+    async def similar_to_text(self,
+                              text: str,
+                              embedding_backend: EmbeddingBackend,
+                              k: int = DEFAULT_NEIGHBOR_COUNT,
+                              content_types: list[str] | None = None,
+                              channel_ids: list[int] | None = None) -> pd.DataFrame:
+        """The `k` items most similar to a (short) query text, embedded with the backend that embedded the items"""
+        if embedding_backend.name != self.embedding_method:
+            raise ValueError(f"The index was built from {self.embedding_method} embeddings, "
+                             f"can't query it with {embedding_backend.name}")
+        query_vector = await embedding_backend.embed([text])
+        rows, similarities = self.search(query_vector, k=k, content_types=content_types, channel_ids=channel_ids)
+        return self._neighbors_dataframe(rows, similarities)
+
+    def save(self, db_path: str) -> None:
+        folder = Path(db_path) / EMBEDDING_INDEX_FOLDER_NAME
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / EMBEDDING_INDEX_INFO_FILENAME).unlink(missing_ok=True)
+        np.save(folder / "vectors.npy", self.vectors)
+        self.items.to_csv(folder / "items.csv", index=False)
+        if self._graph is not None:
+            with open(folder / "graph.pkl", "wb") as graph_file:
+                pickle.dump(self._graph, graph_file)
+        (folder / EMBEDDING_INDEX_INFO_FILENAME).write_text(json.dumps({"kind": self.kind.value, "rows": len(self)}))
+        logger.info(f"Saved the {self.kind.value} embedding index ({len(self)} items) to {folder}")
+
+    @classmethod
+    def load(cls, db_path: str) -> "EmbeddingIndex":
+        folder = Path(db_path) / EMBEDDING_INDEX_FOLDER_NAME
+        if not (folder / EMBEDDING_INDEX_INFO_FILENAME).exists():
+            raise FileNotFoundError(f"No embedding index in {db_path} - run the augmentation pipeline with embeddings")
+        kind = NeighborIndexKind(json.loads((folder / EMBEDDING_INDEX_INFO_FILENAME).read_text())["kind"])
+        graph = None
+        if kind == NeighborIndexKind.APPROXIMATE:
+            with open(folder / "graph.pkl", "rb") as graph_file:
+                graph = pickle.load(graph_file)
+        return cls(vectors=np.load(folder / "vectors.npy"),
+                   items=pd.read_csv(folder / "items.csv"),
+                   kind=kind,
+                   graph=graph)
+
+
+class EmbeddingIndexBenchmark(BaseModel):
+    kind: str
+    selected: bool  # the kind of index that was saved
+    rows: int
+    dimensions: int
+    build_seconds: float
+    query_p50_ms: float
+    query_p95_ms: float
+    filtered_query_p50_ms: float  # filtered to the most common content type
+    recall_at_k: float  # against the exact index
+    k: int
+
+    @property
+    def as_formatted_text(self) -> str:
+        return (f"{self.kind:>11}{' (selected)' if self.selected else '           '}: {self.rows} x {self.dimensions}, "
+                f"built in {self.build_seconds:.2f}s, queries p50 {self.query_p50_ms:.2f}ms / "
+                f"p95 {self.query_p95_ms:.2f}ms (filtered p50 {self.filtered_query_p50_ms:.2f}ms), "
+                f"recall@{self.k} {self.recall_at_k:.4f}")
+
+
+def benchmark_embedding_index(index: EmbeddingIndex,
+                              exact_index: EmbeddingIndex | None = None,
+                              k: int = DEFAULT_NEIGHBOR_COUNT,
+                              query_count: int = DEFAULT_BENCHMARK_QUERIES) -> EmbeddingIndexBenchmark:
+    """Single-query latencies of `index` (item vectors as queries), and its recall against the `exact_index`"""
+    sample = np.random.default_rng(RANDOM_SEED).choice(len(index), size=min(query_count, len(index)), replace=False)
+    most_common_content_type = index.items["content_type"].mode().iloc[0]
+    latencies_ms, filtered_latencies_ms, recalls = [], [], []
+    for row in sample:
+        start = time.perf_counter()
+        rows, _ = index.search(index.vectors[row], k=k)
+        latencies_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        index.search(index.vectors[row], k=k, content_types=[most_common_content_type])
+        filtered_latencies_ms.append((time.perf_counter() - start) * 1000)
+        if exact_index is not None:
+            exact_rows, _ = exact_index.search(index.vectors[row], k=k)
+            recalls.append(np.intersect1d(rows[0], exact_rows[0]).size / max(exact_rows.shape[1], 1))
+    return EmbeddingIndexBenchmark(kind=index.kind.value,
+                                   selected=True,
+                                   rows=len(index),
+                                   dimensions=index.vectors.shape[1],
+                                   build_seconds=index.build_seconds,
+                                   query_p50_ms=float(np.percentile(latencies_ms, 50)),
+                                   query_p95_ms=float(np.percentile(latencies_ms, 95)),
+                                   filtered_query_p50_ms=float(np.percentile(filtered_latencies_ms, 50)),
+                                   recall_at_k=float(np.mean(recalls)) if recalls else 1.0,
+                                   k=k)
+
+
+def build_and_benchmark_embedding_index(vectors: np.ndarray,
+                                        items: pd.DataFrame,
+                                        kind: NeighborIndexKind | None = None
+                                        ) -> tuple[EmbeddingIndex, list[EmbeddingIndexBenchmark]]:
+    """
+    Build the index (approximate above `EXACT_INDEX_MAX_ROWS` rows, unless `kind` is given) and benchmark it - an
+    approximate index is benchmarked against the exact one (which is free to build) as well.
+    """
+    index = EmbeddingIndex(vectors=vectors, items=items, kind=kind)
+    if len(index) == 0:
+        return index, []
+    if index.kind == NeighborIndexKind.EXACT:
+        benchmarks = [benchmark_embedding_index(index)]
+    else:
+        exact_index = EmbeddingIndex(vectors=vectors, items=items, kind=NeighborIndexKind.EXACT)
+        benchmarks = [benchmark_embedding_index(index, exact_index=exact_index),
+                      benchmark_embedding_index(exact_index).model_copy(update={"selected": False})]
+    for benchmark in benchmarks:
+        logger.info(f"Embedding index {benchmark.as_formatted_text}")
+    return index, benchmarks
+
+
+if __name__ == "__main__":
+    from skellybot_analysis.utilities.get_most_recent_db_location import get_most_recent_db_location
+
+    logging.basicConfig(level=logging.INFO)
+    _index = EmbeddingIndex.load(get_most_recent_db_location())
+    _first_thread = _index.items.index[_index.items["content_type"] == "thread_analysis"][0]
+    print(f"Threads most similar to: {_index.items.loc[_first_thread, 'embedded_text'][:200]}\n")
+    print(_index.similar_items(_first_thread, content_types=["thread_analysis"])[
+              ["rank", "similarity", "thread_id", "jump_url"]].to_string())
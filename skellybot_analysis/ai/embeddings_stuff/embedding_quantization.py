@@ -0,0 +1,140 @@
+"""
+Smaller on-disk storage of the embedding matrices (`*_embeddings.npy`), and a check of what it costs in accuracy -
+`embedding_storage_report` compares the nearest neighbors of each storage dtype against full precision.
+"""
+import enum
+import logging
+
+import numpy as np
+from pydantic import BaseModel
+
+from skellybot_analysis.ai.embeddings_stuff.embedding_index import cosine_top_k
+
+logger = logging.getLogger(__name__)
+
+INT8_MAX = 127
+DEFAULT_RECALL_K = 10
+DEFAULT_RECALL_SAMPLE_SIZE = 1000  # query rows sampled for the recall check
+RANDOM_SEED = 42
+
+
+class EmbeddingStorageDtype(enum.Enum):
+    FLOAT32 = "float32"  # full precision (what the embedding backends produce), 4 bytes per dimension
+    FLOAT16 = "float16"  # 2 bytes per dimension
+    INT8 = "int8"  # symmetric scalar quantization with one float32 scale per row, ~1 byte per dimension
+
+
+DEFAULT_EMBEDDING_STORAGE_DTYPE = EmbeddingStorageDtype.FLOAT32
+
+
+def _int8_dtype(dimensions: int) -> np.dtype:
+    return np.dtype([("codes", np.int8, (dimensions,)), ("scale", np.float32)])
+
+
+def quantize_embeddings(embeddings: np.ndarray,
+                        storage_dtype: EmbeddingStorageDtype = DEFAULT_EMBEDDING_STORAGE_DTYPE) -> np.ndarray:
+    """
+    (n, dim) embeddings -> the array to save in `storage_dtype`. INT8 is a structured (n,) array of per-row codes and
+    scales (so it stays a single self-describing `.npy`), see `dequantize_embeddings`.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if storage_dtype == EmbeddingStorageDtype.FLOAT32 or embeddings.size == 0:
+        return embeddings
+    if storage_dtype == EmbeddingStorageDtype.FLOAT16:
+        return embeddings.astype(np.float16)
+    scales = np.abs(embeddings).max(axis=1) / INT8_MAX
+    scales[scales == 0] = 1.0
+    quantized = np.empty(embeddings.shape[0], dtype=_int8_dtype(embeddings.shape[1]))
+    quantized["codes"] = np.clip(np.rint(embeddings / scales[:, None]), -INT8_MAX, INT8_MAX).astype(np.int8)
+    quantized["scale"] = scales
+    return quantized
+
+
+def dequantize_embeddings(stored: np.ndarray) -> np.ndarray:
+    """Any stored embedding array (float64 from older runs, float32, float16 or INT8) -> (n, dim) float32"""
+    if stored.dtype.names is not None and "codes" in stored.dtype.names:
+        return stored["codes"].astype(np.float32) * stored["scale"][:, None]
+    return stored.astype(np.float32, copy=False)
+
+
+def storage_dtype_of(stored: np.ndarray) -> EmbeddingStorageDtype | None:
+    """The storage dtype of a saved embedding array (`None` for float64 arrays of older runs)"""
+    if stored.dtype.names is not None and "codes" in stored.dtype.names:
+        return EmbeddingStorageDtype.INT8
+    try:
+        return EmbeddingStorageDtype(stored.dtype.name)
+    except ValueError:
+        return None
+
+
+class EmbeddingStorageReport(BaseModel):
+    storage_dtype: str
+    bytes_per_vector: float
+    size_ratio: float  # stored size / float32 size
+    recall_at_k: float  # fraction of the full precision top-k neighbors that are still in the top-k
+    k: int
+    mean_absolute_error: float
+
+    @property
+    def as_formatted_text(self) -> str:
+        return (f"{self.storage_dtype:>8}: {self.bytes_per_vector:8.0f} bytes/vector ({self.size_ratio:.2f}x), "
+                f"recall@{self.k} {self.recall_at_k:.4f}, mean abs error {self.mean_absolute_error:.2e}")
+
+
+def embedding_storage_report(embeddings: np.ndarray,
+                             storage_dtype: EmbeddingStorageDtype,
+                             k: int = DEFAULT_RECALL_K,
+                             sample_size: int = DEFAULT_RECALL_SAMPLE_SIZE) -> EmbeddingStorageReport:
+    """
+    Size and neighbor-recall loss of storing the (full precision) `embeddings` in `storage_dtype`: the cosine top-k
+    neighbors of (up to `sample_size`) sampled rows in the stored embeddings vs. in the full precision ones.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    stored = quantize_embeddings(embeddings, storage_dtype)
+    restored = dequantize_embeddings(stored)
+    n_rows = embeddings.shape[0]
+    sample = np.random.default_rng(RANDOM_SEED).choice(n_rows, size=min(sample_size, n_rows), replace=False)
+    exact_neighbors, _ = cosine_top_k(embeddings[sample], embeddings, k=k, exclude_indices=sample)
+    stored_neighbors, _ = cosine_top_k(restored[sample], restored, k=k, exclude_indices=sample)
+    if exact_neighbors.shape[1]:
+        recall = float(np.mean([np.intersect1d(exact, approximate).size / exact_neighbors.shape[1]
+                                for exact, approximate in zip(exact_neighbors, stored_neighbors)]))
+    else:
+        recall = 1.0
+    float32_bytes = embeddings.nbytes or 1
+    return EmbeddingStorageReport(storage_dtype=storage_dtype.value,
+                                  bytes_per_vector=stored.nbytes / max(n_rows, 1),
+                                  size_ratio=stored.nbytes / float32_bytes,
+                                  recall_at_k=recall,
+                                  k=exact_neighbors.shape[1],
+                                  mean_absolute_error=float(np.abs(restored - embeddings).mean()))
+
+
+def store_embeddings(embeddings: np.ndarray,
+                     storage_dtype: EmbeddingStorageDtype = DEFAULT_EMBEDDING_STORAGE_DTYPE,
+                     label: str = "embeddings") -> np.ndarray:
+    """`quantize_embeddings`, logging the size/recall cost of the quantization (when there is one)"""
+    if storage_dtype != EmbeddingStorageDtype.FLOAT32 and embeddings.shape[0] > 1:
+        report = embedding_storage_report(embeddings, storage_dtype)
+        logger.info(f"Storing {embeddings.shape[0]} {label} as {report.as_formatted_text}")
+    return quantize_embeddings(embeddings, storage_dtype)
+
+
+if __name__ == "__main__":
+    from pathlib import Path
+
+    from skellybot_analysis.utilities.get_most_recent_db_location import get_most_recent_db_location
+
+    logging.basicConfig(level=logging.INFO)
+    _embeddings_path = Path(get_most_recent_db_location()) / "message_embeddings.npy"
+    if _embeddings_path.exists():
+        _stored = np.load(_embeddings_path)
+        if storage_dtype_of(_stored) not in (EmbeddingStorageDtype.FLOAT32, None):
+            print(f"{_embeddings_path.name} is already stored as {storage_dtype_of(_stored).value} - "
+                  f"the recall below is relative to that, not to full precision")
+        _embeddings = dequantize_embeddings(_stored)
+    else:
+        _embeddings = np.random.default_rng(RANDOM_SEED).normal(size=(5000, 1024)).astype(np.float32)
+    print(f"{_embeddings.shape[0]} embeddings of {_embeddings.shape[1]} dimensions:")
+    for _storage_dtype in EmbeddingStorageDtype:
+        print(embedding_storage_report(_embeddings, _storage_dtype).as_formatted_text)
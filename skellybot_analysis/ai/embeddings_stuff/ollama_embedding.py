@@ -1,36 +1,121 @@
-from typing import List
 import asyncio
+import logging
+import time
+from functools import partial
+from typing import List
 
-from ollama import AsyncClient
+from skellybot_analysis.ai.clients.call_metrics import get_call_metrics_recorder
+from skellybot_analysis.ai.clients.ollama_client import OLLAMA_RETRY_ENGINE, DEFAULT_OLLAMA_MAX_CONNECTIONS, \
+    get_ollama_client
 
-DEFAULT_OLLAMA_EMBEDDINGS_MODEL = "mxbai-embed-large"
+logger = logging.getLogger(__name__)
 
+DEFAULT_OLLAMA_EMBEDDINGS_MODEL = "mxbai-embed-large"
+DEFAULT_OLLAMA_EMBEDDING_BATCH_SIZE = 64  # texts per `embed` request
+DEFAULT_OLLAMA_MAX_IN_FLIGHT_BATCHES = 4  # more than this just queues up inside the Ollama server
+PROGRESS_LOG_INTERVAL_SECONDS = 10.0
 
-async def calculate_ollama_embeddings(texts_to_embed: List[str]) -> List[List[float]]:
-    print(f"Calculating embeddings for {len(texts_to_embed)} texts...")
-    ollama_client = AsyncClient()
-    embeddings = []
 
-    for n, text in enumerate(texts_to_embed):
+async def calculate_ollama_embeddings(texts_to_embed: List[str],
+                                      model: str = DEFAULT_OLLAMA_EMBEDDINGS_MODEL,
+                                      batch_size: int = DEFAULT_OLLAMA_EMBEDDING_BATCH_SIZE,
+                                      max_in_flight_batches: int = DEFAULT_OLLAMA_MAX_IN_FLIGHT_BATCHES,
+                                      host: str | None = None,
+                                      raise_on_failure: bool = True) -> List[List[float] | None]:
+    """
+    Embed the texts in batches of `batch_size` (one `embed` request per batch, over the shared pooled client),
+    with at most `max_in_flight_batches` requests at a time. Embeddings are returned in the order of the texts.
+    With `raise_on_failure=False` the texts of a batch that failed (after its retries) get `None` instead of raising.
+    """
+    for text in texts_to_embed:
         if not isinstance(text, str):
             raise ValueError(f"Expected text to be a string, but got {type(text)}")
-        embeddings.append(asyncio.create_task(ollama_client.embed(model=DEFAULT_OLLAMA_EMBEDDINGS_MODEL,
-                                                                  input=text,
-                                                                  truncate=True))
-                          )
-    embeddings = await asyncio.gather(*embeddings)
-    print(f"Succesfully calculated embeddings for {len(embeddings)} texts!")
-    return [list(embedding.embeddings[0]) for embedding in embeddings]
+    if not texts_to_embed:
+        return []
+    # same pooled client as the chat requests (unless more batches than its connections are in flight)
+    ollama_client = get_ollama_client(host=host,
+                                      max_connections=max(DEFAULT_OLLAMA_MAX_CONNECTIONS, max_in_flight_batches))
+    batches = [texts_to_embed[start:start + batch_size] for start in range(0, len(texts_to_embed), batch_size)]
+    logger.info(f"Calculating embeddings for {len(texts_to_embed)} texts in {len(batches)} batches of up to "
+                f"{batch_size} ({max_in_flight_batches} batches at a time)...")
+    semaphore = asyncio.Semaphore(max_in_flight_batches)
+    start = time.perf_counter()
+    last_progress_log = start
+    embedded_count = 0
+
+    async def embed_batch(batch_number: int, batch: List[str]) -> List[List[float]]:
+        nonlocal embedded_count, last_progress_log
+        async with semaphore:
+            with get_call_metrics_recorder().track(kind="embedding", provider="ollama", model=model) as call:
+                response = await OLLAMA_RETRY_ENGINE.run(partial(ollama_client.embed,
+                                                                 model=model,
+                                                                 input=batch,
+                                                                 truncate=True),
+                                                         description=f"embedding batch #{batch_number}")
+                call.prompt_tokens = response.prompt_eval_count or 0
+        if len(response.embeddings) != len(batch):
+            raise ValueError(f"Got {len(response.embeddings)} embeddings for the {len(batch)} texts of batch #{batch_number}")
+        embedded_count += len(batch)
+        now = time.perf_counter()
+        if now - last_progress_log >= PROGRESS_LOG_INTERVAL_SECONDS:
+            last_progress_log = now
+            logger.info(f"Embedded {embedded_count}/{len(texts_to_embed)} texts "
+                        f"({embedded_count / (now - start):.1f} texts/s)")
+        return [list(embedding) for embedding in response.embeddings]
+
+    batch_embeddings = await asyncio.gather(*[embed_batch(batch_number, batch)
+                                              for batch_number, batch in enumerate(batches)],
+                                            return_exceptions=not raise_on_failure)
+    failed_batches = 0
+    for batch_number, (batch, result) in enumerate(zip(batches, batch_embeddings)):
+        if isinstance(result, Exception):
+            logger.error(f"Embedding batch #{batch_number} failed: {type(result).__name__}: {result}")
+            batch_embeddings[batch_number] = [None] * len(batch)
+            failed_batches += 1
+    duration = time.perf_counter() - start
+    logger.info(f"Calculated embeddings for {len(texts_to_embed)} texts in {duration:.1f}s "
+                f"({len(texts_to_embed) / duration:.1f} texts/s, {failed_batches} of {len(batches)} batches failed)")
+    return [embedding for batch in batch_embeddings for embedding in batch]
 
 
 if __name__ == "__main__":
-    import asyncio
-
-    _texts_to_embed = [
-        "This is a test sentence.",
-        "This is another test sentence.",
-        "This is a third test sentence."
-    ]
-    _embeddings = asyncio.run(calculate_ollama_embeddings(_texts_to_embed))
-    embeddings_lengths = [len(embedding) for embedding in _embeddings]
-    print(f"embedding lengths: {embeddings_lengths}")
+    import pandas as pd
+    from pathlib import Path
+
+    from skellybot_analysis.utilities.get_most_recent_db_location import get_most_recent_db_location
+
+    logging.basicConfig(level=logging.INFO)
+
+    # throughput benchmark: the old unbounded one-request-per-text fan-out vs. batched requests, on the same texts
+    _human_messages_path = Path(get_most_recent_db_location()) / "human_messages.csv"
+    if _human_messages_path.exists():
+        _texts = pd.read_csv(_human_messages_path)["message_and_response"].dropna().astype(str).tolist()[:2000]
+    else:
+        _texts = [f"Message #{index}: how does the cerebellum help with motor learning and gaze stabilization?"
+                  for index in range(2000)]
+
+    async def _old_unbounded_fan_out(texts: List[str]) -> List[List[float]]:
+        """The baseline - the pre-batching implementation: a fresh client, one request per text, all of them at once"""
+        from ollama import AsyncClient
+
+        _client = AsyncClient()
+        _responses = await asyncio.gather(*[_client.embed(model=DEFAULT_OLLAMA_EMBEDDINGS_MODEL, input=text, truncate=True)
+                                            for text in texts])
+        return [list(response.embeddings[0]) for response in _responses]
+
+    async def _benchmark():
+        results = {}
+        await calculate_ollama_embeddings(_texts[:8])  # warm-up, so the baseline doesn't pay for loading the model
+        _start = time.perf_counter()
+        await _old_unbounded_fan_out(_texts)
+        results["unbounded, 1 text/request (old)"] = len(_texts) / (time.perf_counter() - _start)
+        for _batch_size in (1, 16, 64, 128):
+            _start = time.perf_counter()
+            await calculate_ollama_embeddings(_texts, batch_size=_batch_size)
+            results[f"batch size {_batch_size:>4}"] = len(_texts) / (time.perf_counter() - _start)
+        return results
+
+    _throughputs = asyncio.run(_benchmark())
+    _baseline = next(iter(_throughputs.values()))
+    for _label, _throughput in _throughputs.items():
+        print(f"{_label:>32}: {_throughput:8.1f} texts/s ({_throughput / _baseline:.1f}x)")
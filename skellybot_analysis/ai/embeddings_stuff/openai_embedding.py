@@ -1,38 +1,108 @@
+import asyncio
+import logging
+from functools import partial
 from typing import List
 
 import numpy as np
 from openai import AsyncOpenAI
 
+from skellybot_analysis.ai.clients.call_metrics import get_call_metrics_recorder
+from skellybot_analysis.ai.clients.openai_client.openai_client import OPENAI_RETRY_ENGINE
+from skellybot_analysis.ai.embeddings_stuff.chunked_embedding import ChunkedTexts, PoolingMethod, DEFAULT_POOLING_METHOD
+
+logger = logging.getLogger(__name__)
+
 DEFAULT_OPENAI_EMDEDDINGS_MODEL = "text-embedding-3-small"
 DEFAULT_HUGGINGFACE_EMBEDDINGS_MODEL = "all-MiniLM-L6-v2"
-import logging
-logger = logging.getLogger(__name__)
-async def get_embedding_for_text_openai(client: AsyncOpenAI,
-                                        text_to_embed: str,
-                                        embedding_model: str = DEFAULT_OPENAI_EMDEDDINGS_MODEL) -> List[float]:
-    embedding_responses = []
-    embedding_max_tokens = 8000
+OPENAI_EMBEDDING_MAX_INPUTS_PER_REQUEST = 2048
+OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST = 300_000
+DEFAULT_OPENAI_MAX_CONCURRENT_EMBEDDING_REQUESTS = 4
+
 
-    try:
-        for i in range(0, len(text_to_embed),
-                       embedding_max_tokens):  # really should be splitting by token hgere, but characters are smaller than tokens, so it's fine
-            embedding_response = await client.embeddings.create(
-                input=text_to_embed[i:i + embedding_max_tokens],
-                model=embedding_model
-            )
-            embedding_responses.append(embedding_response.data[0].embedding)
-    except Exception as e:
-        logger.exception(f"Error getting embeddings for text: {e}")
+def _pack_batches(token_counts: list[int],
+                  max_inputs: int = OPENAI_EMBEDDING_MAX_INPUTS_PER_REQUEST,
+                  max_tokens: int = OPENAI_EMBEDDING_MAX_TOKENS_PER_REQUEST) -> list[list[int]]:
+    """Consecutive input indices packed into batches of at most `max_inputs` inputs and `max_tokens` tokens"""
+    batches: list[list[int]] = []
+    batch_tokens = 0
+    for index, token_count in enumerate(token_counts):
+        if not batches or len(batches[-1]) >= max_inputs or batch_tokens + token_count > max_tokens:
+            batches.append([])
+            batch_tokens = 0
+        batches[-1].append(index)
+        batch_tokens += token_count
+    return batches
 
 
-    return list(np.mean(embedding_responses, axis=0)) # return mean if multiple embeddings are returned
+async def get_embeddings_for_texts_openai(client: AsyncOpenAI,
+                                          texts_to_embed: List[str],
+                                          embedding_model: str = DEFAULT_OPENAI_EMDEDDINGS_MODEL,
+                                          pooling: PoolingMethod = DEFAULT_POOLING_METHOD,
+                                          max_concurrent_requests: int = DEFAULT_OPENAI_MAX_CONCURRENT_EMBEDDING_REQUESTS
+                                          ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Embed many texts with as few `embeddings.create` requests as the API's per-request input and token limits allow,
+    at most `max_concurrent_requests` at a time. Texts over the model's token limit are embedded in chunks and pooled.
 
+    Returns the (n_texts, dim) float32 embedding matrix and a boolean `failed` mask - the rows of texts whose request
+    failed (after retries) are NaN. Raises if every request failed.
+    """
+    if not texts_to_embed:
+        return np.empty((0, 0), dtype=np.float32), np.zeros(0, dtype=bool)
+    chunked_texts = await asyncio.to_thread(ChunkedTexts, texts_to_embed, embedding_model)
+    batches = _pack_batches(chunked_texts.chunk_token_counts)
+    logger.info(f"Embedding {len(texts_to_embed)} texts ({len(chunked_texts.chunks)} chunks) with {embedding_model} "
+                f"in {len(batches)} requests ({max_concurrent_requests} at a time)")
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    async def embed_batch(batch: list[int]) -> list[list[float]]:
+        async with semaphore:
+            with get_call_metrics_recorder().track(kind="embedding", provider="openai", model=embedding_model) as call:
+                embedding_response = await OPENAI_RETRY_ENGINE.run(
+                    partial(client.embeddings.create,
+                            input=[chunked_texts.chunks[index] for index in batch],
+                            model=embedding_model),
+                    description=f"{embedding_model} embedding of {len(batch)} inputs")
+                call.prompt_tokens = embedding_response.usage.prompt_tokens
+        return [item.embedding for item in sorted(embedding_response.data, key=lambda item: item.index)]
+
+    results = await asyncio.gather(*[embed_batch(batch) for batch in batches], return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if len(errors) == len(results):
+        raise errors[-1]
+
+    dimensions = len(next(result for result in results if not isinstance(result, Exception))[0])
+    chunk_embeddings = np.full((len(chunked_texts.chunks), dimensions), np.nan, dtype=np.float32)
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            logger.error(f"Embedding request for {len(batch)} inputs failed: {type(result).__name__}: {result}")
+            continue
+        chunk_embeddings[batch] = result
+    # a text with any failed chunk pools to a NaN row
+    embeddings = chunked_texts.pool(chunk_embeddings, pooling=pooling)
+    failed = np.isnan(embeddings).any(axis=1)
+    if failed.any():
+        logger.warning(f"{int(failed.sum())} of {len(texts_to_embed)} texts could not be embedded")
+    return embeddings, failed
+
+
+async def get_embedding_for_text_openai(client: AsyncOpenAI,
+                                        text_to_embed: str,
+                                        embedding_model: str = DEFAULT_OPENAI_EMDEDDINGS_MODEL,
+                                        pooling: PoolingMethod = DEFAULT_POOLING_METHOD) -> List[float]:
+    embeddings, _ = await get_embeddings_for_texts_openai(client=client,
+                                                          texts_to_embed=[text_to_embed],
+                                                          embedding_model=embedding_model,
+                                                          pooling=pooling)
+    return embeddings[0].tolist()
 
 
 if __name__ == "__main__":
     from main_ai_process import OPENAI_CLIENT
     from pprint import pprint
-    import asyncio
     text_to_embed = "woweee this is a long text, I wonder what the embeddings will look like for this text"
     embeddings = asyncio.run(get_embedding_for_text_openai(OPENAI_CLIENT,text_to_embed))
-    pprint(embeddings)
\ No newline at end of file
+    pprint(embeddings)
+
+    _matrix, _failed = asyncio.run(get_embeddings_for_texts_openai(OPENAI_CLIENT, [text_to_embed] * 100))
+    print(f"embedding matrix: {_matrix.shape}, {int(_failed.sum())} failed rows")
\ No newline at end of file
@@ -0,0 +1,200 @@
+import asyncio
+import enum
+import hashlib
+import json
+import logging
+
+from skellybot_analysis.ai.analyze_server_data import RESPONSE_TOKEN_RESERVE, PROMPT_TOKEN_RESERVE
+from skellybot_analysis.ai.clients.structured_output import StructuredOutputProvider, get_structured_output_provider
+from skellybot_analysis.ai.tokenizer_service import get_tokenizer_service, DEFAULT_TRUNCATION_MARKER
+from skellybot_analysis.data_models.analysis_models import AiThreadAnalysisModel, AiRollupAnalysisModel
+from skellybot_analysis.data_models.prompt_models import TextAnalysisPromptModel
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENT_ROLLUP_CALLS = 8
+
+
+class RollupLevel(enum.Enum):
+    CHANNEL = "channel"  # summarizes the channel's thread analyses
+    CATEGORY = "category"  # summarizes the category's channel summaries
+    SERVER = "server"  # summarizes the server's category summaries
+
+
+ChildAnalysis = AiThreadAnalysisModel | AiRollupAnalysisModel
+# the analysis content a rollup (or profile) is made from - a child whose content changed (e.g. re-analyzed with
+# another model) changes its parent's hash, even if the child's source text did not change
+CHILD_CONTENT_FIELDS = ("title_slug", "extremely_short_summary", "very_short_summary", "short_summary",
+                        "highlights", "detailed_summary", "topic_areas")
+
+
+def _child_hash(child: ChildAnalysis) -> str:
+    # `or ""` - empty strings come back as None from the csvs
+    content = json.dumps([getattr(child, field) or "" for field in CHILD_CONTENT_FIELDS])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def analyses_hash(label: str, analyses: list[ChildAnalysis], provider_name: str) -> str:
+    """
+    Hash of the label, the name of the provider making the summary and the (sorted) content hashes of the analyses -
+    a re-analyzed thread changes the hash of its channel, and the new channel summary that of its category and server
+    (and nothing else)
+    """
+    child_hashes = sorted(_child_hash(analysis) for analysis in analyses)
+    return hashlib.sha256("\n".join([label, provider_name, *child_hashes]).encode("utf-8")).hexdigest()
+
+
+def _rollup_id(level: RollupLevel, first_child: ChildAnalysis) -> str:
+    if level == RollupLevel.CHANNEL:
+        return f"{level.value}:{first_child.channel_id}"
+    if level == RollupLevel.CATEGORY:
+        return f"{level.value}:{first_child.server_id}:{first_child.category_id}"
+    return f"{level.value}:{first_child.server_id}"
+
+
+def _child_summary(child: ChildAnalysis, detail: str) -> str:
+    summary = child.short_summary if detail == "short" else child.extremely_short_summary
+    return f"### {child.title}\n{summary}\nTopic areas: {child.topic_areas}"
+
+
+def analyses_summary_text(children: list[ChildAnalysis], provider: StructuredOutputProvider) -> str:
+    """The analyses' short summaries - or extremely short ones (then truncated) if they don't fit the context"""
+    tokenizer = get_tokenizer_service(provider.llm_model)
+    max_tokens = provider.max_input_tokens - RESPONSE_TOKEN_RESERVE - PROMPT_TOKEN_RESERVE
+    children_text = ""
+    for detail in ("short", "extremely_short"):
+        children_text = "\n\n".join(_child_summary(child, detail) for child in children)
+        if tokenizer.count_tokens(children_text) <= max_tokens:
+            return children_text
+    logger.warning(f"Summaries of {len(children)} child analyses don't fit in {max_tokens} tokens - truncating")
+    return tokenizer.truncate(children_text, max_tokens=max_tokens, marker=DEFAULT_TRUNCATION_MARKER)
+
+
+def _rollup_prompt(level: RollupLevel, name: str, server_name: str, child_count: int, children_text: str) -> str:
+    child_description = {RollupLevel.CHANNEL: "conversation threads",
+                         RollupLevel.CATEGORY: "channels",
+                         RollupLevel.SERVER: "channel categories"}[level]
+    return (
+        f"You are currently reviewing the chat data from the {server_name} Discord server to provide a landscape "
+        f"of the topics that are being discussed.\n\n"
+        f"You are summarizing the {level.value} '{name}', from the summaries of its {child_count} {child_description}.\n\n"
+        f"BEGIN SUMMARIES\n\n"
+        f"{children_text}\n\n"
+        f"END SUMMARIES\n"
+        f"Describe the {level.value} as a whole - its main themes, how they relate and what stands out - rather than "
+        f"listing the {child_description} one by one. Keep your answers concise and to the point, without sacrificing "
+        f"clarity and coverage.\n\n"
+        f"Provide the output prescribed by the provided JSON schema."
+    )
+
+
+async def _rollup(level: RollupLevel,
+                  children: list[ChildAnalysis],
+                  children_hash: str,
+                  provider: StructuredOutputProvider,
+                  semaphore: asyncio.Semaphore) -> AiRollupAnalysisModel:
+    first_child = children[0]
+    name = {RollupLevel.CHANNEL: first_child.channel_name,
+            RollupLevel.CATEGORY: first_child.category_name if first_child.category_id != -1 else "uncategorized channels",
+            RollupLevel.SERVER: first_child.server_name}[level]
+    children_text = await asyncio.to_thread(analyses_summary_text, children, provider)
+    analysis_prompt = _rollup_prompt(level=level,
+                                     name=name,
+                                     server_name=first_child.server_name,
+                                     child_count=len(children),
+                                     children_text=children_text)
+    async with semaphore:
+        result: TextAnalysisPromptModel = await provider.make_structured_request(system_prompt=analysis_prompt,
+                                                                                 prompt_model=TextAnalysisPromptModel)
+    logger.info(f"Rolled up {level.value} '{name}' from {len(children)} analyses - {result.extremely_short_summary}")
+    return AiRollupAnalysisModel(
+        rollup_id=_rollup_id(level, first_child),
+        level=level.value,
+        server_id=first_child.server_id,
+        server_name=first_child.server_name,
+        category_id=first_child.category_id if level != RollupLevel.SERVER else -1,
+        category_name=first_child.category_name if level != RollupLevel.SERVER else "none",
+        channel_id=first_child.channel_id if level == RollupLevel.CHANNEL else -1,
+        channel_name=first_child.channel_name if level == RollupLevel.CHANNEL else "none",
+        child_count=len(children),
+        children_hash=children_hash,
+        analysis_prompt=analysis_prompt,
+        topic_areas=result.topic_areas_as_string,
+        **result.model_dump(exclude={'topic_areas'})
+    )
+
+
+async def _rollup_level(level: RollupLevel,
+                        children: list[ChildAnalysis],
+                        previous_rollups: dict[str, AiRollupAnalysisModel],
+                        provider: StructuredOutputProvider,
+                        semaphore: asyncio.Semaphore) -> tuple[list[AiRollupAnalysisModel], int]:
+    """Roll up one level - returns the (re-used or new) rollups and how many of them failed"""
+    groups: dict[str, list[ChildAnalysis]] = {}
+    for child in children:
+        groups.setdefault(_rollup_id(level, child), []).append(child)
+
+    rollups: list[AiRollupAnalysisModel] = []
+    rollup_tasks = []
+    for rollup_id, group in groups.items():
+        children_hash = analyses_hash(level.value, group, provider_name=provider.name)
+        previous_rollup = previous_rollups.get(rollup_id)
+        if previous_rollup is not None and previous_rollup.children_hash == children_hash:
+            rollups.append(previous_rollup)
+            continue
+        rollup_tasks.append(_rollup(level=level,
+                                    children=group,
+                                    children_hash=children_hash,
+                                    provider=provider,
+                                    semaphore=semaphore))
+    logger.info(f"Rolling up {len(rollup_tasks)} new or changed {level.value}s "
+                f"({len(rollups)} unchanged {level.value} summaries re-used)")
+    failures = 0
+    for result in await asyncio.gather(*rollup_tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(f"{level.value} rollup failed: {type(result).__name__}: {result}")
+            failures += 1
+        else:
+            rollups.append(result)
+    return rollups, failures
+
+
+async def ai_rollup_analyses(thread_analyses: list[AiThreadAnalysisModel],
+                             previous_rollups: dict[str, AiRollupAnalysisModel] | None = None,
+                             provider: StructuredOutputProvider | None = None,
+                             max_concurrent_calls: int = DEFAULT_MAX_CONCURRENT_ROLLUP_CALLS
+                             ) -> tuple[dict[str, AiRollupAnalysisModel], int]:
+    """
+    Bottom-up summaries: thread analyses -> channel summaries -> category summaries -> server summaries.
+    A rollup in `previous_rollups` made by the same provider from unchanged child analyses (same `children_hash`) is
+    re-used as it is, so a changed thread analysis only re-runs its channel, its category and its server.
+    Returns the rollups by `rollup_id` and the number of rollups that failed (their ancestors are made from the
+    children that succeeded).
+    """
+    provider = provider or get_structured_output_provider()
+    previous_rollups = previous_rollups or {}
+    semaphore = asyncio.Semaphore(max_concurrent_calls)
+    rollups: dict[str, AiRollupAnalysisModel] = {}
+    total_failures = 0
+    children: list[ChildAnalysis] = list(thread_analyses)
+    for level in RollupLevel:
+        level_rollups, failures = await _rollup_level(level=level,
+                                                      children=children,
+                                                      previous_rollups=previous_rollups,
+                                                      provider=provider,
+                                                      semaphore=semaphore)
+        rollups.update({rollup.rollup_id: rollup for rollup in level_rollups})
+        total_failures += failures
+        children = level_rollups
+    return rollups, total_failures
+
+
+if __name__ == "__main__":
+    from skellybot_analysis.df_db.dataframe_handler import DataframeHandler
+    from skellybot_analysis.utilities.get_most_recent_db_location import get_most_recent_db_location
+
+    _handler = DataframeHandler.from_db_path(db_path=get_most_recent_db_location())
+    _rollups, _ = asyncio.run(ai_rollup_analyses(thread_analyses=list(_handler.thread_analyses.values())))
+    for _rollup_analysis in _rollups.values():
+        if _rollup_analysis.level == RollupLevel.SERVER.value:
+            print(f"{_rollup_analysis.title}\n\n{_rollup_analysis.detailed_summary}")
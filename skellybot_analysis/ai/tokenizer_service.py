@@ -0,0 +1,180 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_ENCODING = "o200k_base"  # for models tiktoken doesn't know (yet)
+PROCESS_POOL_MIN_CHARS = 2_000_000  # texts at least this long are encoded in segments on a process pool
+SEGMENT_TARGET_CHARS = 500_000
+DEFAULT_TRUNCATION_MARKER = "\n[Omitted for space constraints]\n"
+
+TOKENIZER_SERVICES: dict[str, "TokenizerService"] = {}
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str) -> tiktoken.Encoding:
+    return tiktoken.get_encoding(encoding_name)
+
+
+@lru_cache(maxsize=None)
+def get_encoding_for_model(llm_model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(llm_model)
+    except KeyError:
+        logger.warning(f"No tokenizer known for model `{llm_model}` - using `{FALLBACK_ENCODING}`")
+        return get_encoding(FALLBACK_ENCODING)
+
+
+def _encode_in_worker(encoding_name: str, text: str) -> list[int]:
+    return get_encoding(encoding_name).encode_ordinary(text)
+
+
+def split_at_line_starts(text: str, target_chars: int) -> list[str]:
+    """
+    Split `text` into segments of ~`target_chars`, only at the start of a line that begins with a letter or digit
+    (a newline followed by a letter or digit is always a token boundary, so the segments encode to the same tokens
+    as the whole text)
+    """
+    segments = []
+    start = 0
+    while len(text) - start > target_chars:
+        newline = text.find("\n", start + target_chars - 1)
+        while newline != -1 and not (newline + 1 < len(text) and text[newline + 1].isalnum()):
+            newline = text.find("\n", newline + 1)
+        if newline == -1:
+            break
+        segments.append(text[start:newline + 1])
+        start = newline + 1
+    segments.append(text[start:])
+    return segments
+
+
+class TokenizerService:
+    """
+    One tokenizer per LLM model for every token count/truncation/chunking in the AI modules.
+    Encoders are cached, batches are encoded on tiktoken's thread pool, and very large texts are split into segments
+    that are encoded on a (lazily started) process pool.
+    """
+
+    def __init__(self,
+                 llm_model: str,
+                 max_workers: int | None = None,
+                 process_pool_min_chars: int = PROCESS_POOL_MIN_CHARS):
+        self.llm_model = llm_model
+        self.encoding = get_encoding_for_model(llm_model)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.process_pool_min_chars = process_pool_min_chars
+        self._process_pool: ProcessPoolExecutor | None = None
+        self._marker_token_counts: dict[str, int] = {}
+
+    @property
+    def process_pool(self) -> ProcessPoolExecutor:
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._process_pool
+
+    def shutdown(self) -> None:
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+    def _encode_large(self, text: str) -> list[int]:
+        segments = split_at_line_starts(text, SEGMENT_TARGET_CHARS)
+        if len(segments) == 1:
+            return self.encoding.encode_ordinary(text)
+        logger.debug(f"Encoding {len(text)} characters in {len(segments)} segments on the process pool")
+        tokens = []
+        for segment_tokens in self.process_pool.map(_encode_in_worker,
+                                                    [self.encoding.name] * len(segments),
+                                                    segments):
+            tokens.extend(segment_tokens)
+        return tokens
+
+    def encode(self, text: str) -> list[int]:
+        if len(text) >= self.process_pool_min_chars:
+            return self._encode_large(text)
+        return self.encoding.encode_ordinary(text)
+
+    def encode_batch(self, texts: list[str]) -> list[list[int]]:
+        small_indices = [index for index, text in enumerate(texts) if len(text) < self.process_pool_min_chars]
+        encoded: list[list[int] | None] = [None] * len(texts)
+        small_tokens = self.encoding.encode_ordinary_batch([texts[index] for index in small_indices],
+                                                           num_threads=self.max_workers)
+        for index, tokens in zip(small_indices, small_tokens):
+            encoded[index] = tokens
+        for index, text in enumerate(texts):
+            if encoded[index] is None:
+                encoded[index] = self._encode_large(text)
+        return encoded
+
+    def decode(self, tokens: list[int]) -> str:
+        return self.encoding.decode(tokens)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encode(text))
+
+    def count_tokens_batch(self, texts: list[str]) -> list[int]:
+        return [len(tokens) for tokens in self.encode_batch(texts)]
+
+    def _marker_token_count(self, marker: str) -> int:
+        if marker not in self._marker_token_counts:
+            self._marker_token_counts[marker] = len(self.encoding.encode_ordinary(marker))
+        return self._marker_token_counts[marker]
+
+    def truncate_tokens(self, tokens: list[int], max_tokens: int, marker: str | None = DEFAULT_TRUNCATION_MARKER) -> str:
+        """
+        Decode `tokens`, cut to at most `max_tokens` - with a `marker` the start and the end are kept and the middle is
+        replaced by the marker, without one only the start is kept
+        """
+        if len(tokens) <= max_tokens:
+            return self.decode(tokens)
+        if marker is None:
+            return self.decode(tokens[:max_tokens])
+        keep_tokens = max(0, max_tokens - self._marker_token_count(marker))
+        head = tokens[:keep_tokens - keep_tokens // 2]
+        tail = tokens[len(tokens) - keep_tokens // 2:]
+        return self.decode(head) + marker + self.decode(tail)
+
+    def truncate(self, text: str, max_tokens: int, marker: str | None = DEFAULT_TRUNCATION_MARKER) -> str:
+        return self.truncate_tokens(self.encode(text), max_tokens=max_tokens, marker=marker)
+
+    def chunk_tokens(self, tokens: list[int], max_tokens: int, overlap_ratio: float = 0.1) -> list[str]:
+        """Split `tokens` into decoded chunks of at most `max_tokens`, consecutive chunks overlap by `overlap_ratio`"""
+        if overlap_ratio < 0 or overlap_ratio >= 1:
+            raise ValueError("Overlap ratio must be in the range [0, 1).")
+        overlap_tokens = int(max_tokens * overlap_ratio)
+        if overlap_tokens == 0 and overlap_ratio != 0:
+            overlap_tokens = 1
+        step = max(1, max_tokens - overlap_tokens)
+        return [self.decode(tokens[start:start + max_tokens]) for start in range(0, len(tokens), step)]
+
+    def chunk(self, text: str, max_tokens: int, overlap_ratio: float = 0.1) -> list[str]:
+        return self.chunk_tokens(self.encode(text), max_tokens=max_tokens, overlap_ratio=overlap_ratio)
+
+
+def get_tokenizer_service(llm_model: str) -> TokenizerService:
+    if llm_model not in TOKENIZER_SERVICES:
+        TOKENIZER_SERVICES[llm_model] = TokenizerService(llm_model=llm_model)
+    return TOKENIZER_SERVICES[llm_model]
+
+
+if __name__ == "__main__":
+    import time
+
+    _service = get_tokenizer_service("gpt-4o-mini")
+    _text = "\n".join(f"Line {index}: the quick brown fox jumps over the lazy dog." for index in range(200_000))
+    _tic = time.perf_counter()
+    _single = _service.encoding.encode_ordinary(_text)
+    _single_seconds = time.perf_counter() - _tic
+    _tic = time.perf_counter()
+    _pooled = _service.encode(_text)
+    _pooled_seconds = time.perf_counter() - _tic
+    assert _single == _pooled, "Segmented encoding should match the single-pass encoding"
+    print(f"{len(_text)} characters -> {len(_pooled)} tokens: "
+          f"single pass {_single_seconds:.2f}s, process pool {_pooled_seconds:.2f}s")
+    print(_service.chunk("Wow, this is a long sentence that will be chunked to the max token length of 4.", max_tokens=4))
+    _service.shutdown()
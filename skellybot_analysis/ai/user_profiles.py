@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+from skellybot_analysis.ai.clients.structured_output import StructuredOutputProvider, get_structured_output_provider
+from skellybot_analysis.ai.rollup_analyses import analyses_hash, analyses_summary_text
+from skellybot_analysis.data_models.analysis_models import AiThreadAnalysisModel, AiUserProfileModel
+from skellybot_analysis.data_models.prompt_models import UserProfilePromptModel
+from skellybot_analysis.data_models.server_models import ThreadId, UserId
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENT_PROFILE_CALLS = 8
+USER_PROFILE_HASH_LABEL = "user_profile"
+
+
+def _user_profile_prompt(user_id: UserId, server_name: str, analyses: list[AiThreadAnalysisModel], analyses_text: str) -> str:
+    return (
+        f"You are currently reviewing the chat data from the {server_name} Discord server to build a profile of "
+        f"each of its (human) users.\n\n"
+        f"User {user_id} took part in {len(analyses)} conversation threads, here are the summaries of those threads:\n\n"
+        f"BEGIN THREAD SUMMARIES\n\n"
+        f"{analyses_text}\n\n"
+        f"END THREAD SUMMARIES\n"
+        f"Describe the user from what they talked about - their interests, background and what they are working "
+        f"towards. Keep your answers concise and to the point, without sacrificing clarity and coverage.\n\n"
+        f"Provide the output prescribed by the provided JSON schema."
+    )
+
+
+async def _user_profile(user_id: UserId,
+                        analyses: list[AiThreadAnalysisModel],
+                        user_analyses_hash: str,
+                        provider: StructuredOutputProvider,
+                        semaphore: asyncio.Semaphore) -> AiUserProfileModel:
+    analyses = sorted(analyses, key=lambda analysis: analysis.thread_id)
+    analyses_text = await asyncio.to_thread(analyses_summary_text, analyses, provider)
+    analysis_prompt = _user_profile_prompt(user_id=user_id,
+                                           server_name=analyses[0].server_name,
+                                           analyses=analyses,
+                                           analyses_text=analyses_text)
+    async with semaphore:
+        result: UserProfilePromptModel = await provider.make_structured_request(system_prompt=analysis_prompt,
+                                                                                prompt_model=UserProfilePromptModel)
+    logger.info(f"Profiled user {user_id} from {len(analyses)} thread analyses - {result.terse_summary}")
+    return AiUserProfileModel(user_id=user_id,
+                              server_id=analyses[0].server_id,
+                              server_name=analyses[0].server_name,
+                              thread_count=len(analyses),
+                              thread_ids=",".join(str(analysis.thread_id) for analysis in analyses),
+                              analyses_hash=user_analyses_hash,
+                              analysis_prompt=analysis_prompt,
+                              terse_summary=result.terse_summary,
+                              broad_summary=result.broad_summary,
+                              interests="\n".join(f"- {interest.as_string}: {interest.description}"
+                                                  for interest in result.interests),
+                              recommendations="\n".join(f"- {recommendation}"
+                                                        for recommendation in result.recommendations))
+
+
+async def ai_user_profiles(thread_analyses: list[AiThreadAnalysisModel],
+                           thread_ids_by_user: dict[UserId, set[ThreadId]],
+                           previous_profiles: dict[UserId, AiUserProfileModel] | None = None,
+                           provider: StructuredOutputProvider | None = None,
+                           max_concurrent_calls: int = DEFAULT_MAX_CONCURRENT_PROFILE_CALLS
+                           ) -> tuple[dict[UserId, AiUserProfileModel], int]:
+    """
+    Profile each user from the analyses of the threads they took part in (`thread_ids_by_user`), at most
+    `max_concurrent_calls` at a time. A profile in `previous_profiles` made by the same provider from the same analysis
+    content (same `analyses_hash`) is re-used as it is.
+    Returns the profiles by user id and the number of users whose profile failed.
+    """
+    provider = provider or get_structured_output_provider()
+    previous_profiles = previous_profiles or {}
+    analyses_by_thread = {analysis.thread_id: analysis for analysis in thread_analyses}
+    semaphore = asyncio.Semaphore(max_concurrent_calls)
+
+    profiles: dict[UserId, AiUserProfileModel] = {}
+    profile_tasks = {}
+    for user_id, thread_ids in thread_ids_by_user.items():
+        user_analyses = [analyses_by_thread[thread_id] for thread_id in thread_ids if thread_id in analyses_by_thread]
+        if not user_analyses:
+            continue
+        user_analyses_hash = analyses_hash(USER_PROFILE_HASH_LABEL, user_analyses, provider_name=provider.name)
+        previous_profile = previous_profiles.get(user_id)
+        if previous_profile is not None and previous_profile.analyses_hash == user_analyses_hash:
+            profiles[user_id] = previous_profile
+            continue
+        profile_tasks[user_id] = _user_profile(user_id=user_id,
+                                               analyses=user_analyses,
+                                               user_analyses_hash=user_analyses_hash,
+                                               provider=provider,
+                                               semaphore=semaphore)
+    logger.info(f"Profiling {len(profile_tasks)} new or changed users "
+                f"({len(profiles)} unchanged user profiles re-used)")
+
+    failures = 0
+    results = await asyncio.gather(*profile_tasks.values(), return_exceptions=True)
+    for user_id, result in zip(profile_tasks.keys(), results):
+        if isinstance(result, Exception):
+            logger.error(f"Profile of user {user_id} failed: {type(result).__name__}: {result}")
+            failures += 1
+        else:
+            profiles[user_id] = result
+    return profiles, failures
@@ -1,9 +1,13 @@
+import hashlib
+
 from pydantic import computed_field
 
 from skellybot_analysis.data_models.context_route_model import ContextRoute
 from skellybot_analysis.data_models.server_models import DataframeModel, CategoryId
 from skellybot_analysis.utilities.sanitize_filename import sanitize_name
 
+WHOLE_THREAD = "whole_thread"  # `long_thread_strategy` of a thread that fit in a single request
+
 
 class AiThreadAnalysisModel(DataframeModel):
     server_id: int
@@ -17,6 +21,9 @@ class AiThreadAnalysisModel(DataframeModel):
     jump_url: str # url to the thread in the server
     thread_owner_id: int # the human user who owns the thread (human user with most messages in the thread, b/c no easier way to determine this atm)
     base_text: str
+    base_text_hash: str | None = None  # hash of the full (untruncated) thread text that was analyzed
+    analyzed_with: str | None = None  # name of the provider (`provider/model`) that made the analysis
+    long_thread_strategy: str | None = None  # how a thread over the token budget was analyzed, or WHOLE_THREAD
     analysis_prompt: str
     title_slug: str
     extremely_short_summary: str
@@ -30,6 +37,22 @@ class AiThreadAnalysisModel(DataframeModel):
     def df_filename(cls) -> str:
         return "ai_thread_analyses.csv"
 
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def is_analysis_of(self, thread_text: str, analyzed_with: str, long_thread_strategy: str) -> bool:
+        """
+        Whether this analysis was made from (exactly) this thread text, by the `analyzed_with` provider and (if the
+        thread was too long for a single request) with the `long_thread_strategy`. Analyses saved before the provider
+        and strategy were recorded never match.
+        """
+        if self.analyzed_with != analyzed_with or self.long_thread_strategy not in (WHOLE_THREAD, long_thread_strategy):
+            return False
+        if self.base_text_hash:
+            return self.base_text_hash == self.hash_text(thread_text)
+        return self.base_text == thread_text
+
     @computed_field
     def title(self) -> str:
         return self.title_slug.replace("-", " ").title()
@@ -114,3 +137,74 @@ class AiThreadAnalysisModel(DataframeModel):
     {self.base_text}\n\n
     __
             """
+
+
+class AiRollupAnalysisModel(DataframeModel):
+    """
+    Summary of a channel (from its thread analyses), a category (from its channel summaries) or a server (from its
+    category summaries) - `children_hash` identifies the exact child analyses it was made from.
+    """
+    rollup_id: str  # "<level>:<object id>", e.g. "channel:1234"
+    level: str  # see `RollupLevel`
+    server_id: int
+    server_name: str
+    category_id: CategoryId | None = -1
+    category_name: str | None = "none"
+    channel_id: int | None = -1
+    channel_name: str | None = "none"
+    child_count: int
+    children_hash: str
+    analysis_prompt: str
+    title_slug: str
+    extremely_short_summary: str
+    very_short_summary: str
+    short_summary: str
+    highlights: str
+    detailed_summary: str
+    topic_areas: str
+
+    @classmethod
+    def df_filename(cls) -> str:
+        return "ai_rollup_analyses.csv"
+
+    @computed_field
+    def title(self) -> str:
+        return self.title_slug.replace("-", " ").title()
+
+    @property
+    def context_route(self):
+        return ContextRoute(
+            server_id=self.server_id,
+            server_name=self.server_name,
+            category_id=self.category_id if self.category_id != -1 else None,
+            category_name=self.category_name if self.category_id != -1 else None,
+            channel_id=self.channel_id if self.channel_id != -1 else None,
+            channel_name=self.channel_name if self.channel_id != -1 else None,
+        )
+
+
+class AiUserProfileModel(DataframeModel):
+    """A user's profile, made from the analyses of the threads they took part in (`analyses_hash` identifies them)"""
+    user_id: int
+    server_id: int
+    server_name: str
+    thread_count: int
+    thread_ids: str  # comma separated
+    analyses_hash: str
+    analysis_prompt: str
+    terse_summary: str
+    broad_summary: str
+    interests: str
+    recommendations: str
+
+    @classmethod
+    def df_filename(cls) -> str:
+        return "ai_user_profiles.csv"
+
+    @property
+    def full_text(self) -> str:
+        return (f"# User {self.user_id}\n\n"
+                f"{self.terse_summary}\n\n"
+                f"## Summary\n{self.broad_summary}\n\n"
+                f"## Interests\n{self.interests}\n\n"
+                f"## Recommendations\n{self.recommendations}\n")
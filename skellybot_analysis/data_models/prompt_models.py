@@ -55,6 +55,15 @@ class TextAnalysisPromptModel(BaseModel):
             topic_area_strings += topic_area.as_string + " \n,"
         return topic_area_strings.strip(", \n")  # Remove trailing comma and newline
 
+    @property
+    def as_formatted_text(self) -> str:
+        topic_areas = "\n".join(f"- {topic_area.as_string}: {topic_area.description}" for topic_area in self.topic_areas)
+        return (f"# {self.title_slug}\n\n"
+                f"## Summary\n{self.short_summary}\n\n"
+                f"## Highlights\n{self.highlights}\n\n"
+                f"## Detailed Summary\n{self.detailed_summary}\n\n"
+                f"## Topic Areas\n{topic_areas}\n")
+
 class UserProfilePromptModel(BaseModel):
     """Represents a user's profile with interests and recommendations."""
     broad_summary: str = Field(description="An overall summary of the user's interactions, interests, and background. Should include everything we know or can reliably infer about the user. Formatted as a markdown bulleted outline, like `* point 1\n* point 2\n* point 3` etc. DO NOT include conversational aspects such as 'the human greets the ai' and the 'ai responds with a greeting', only include the main contentful components of the text.")
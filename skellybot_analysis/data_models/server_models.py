@@ -3,6 +3,7 @@ from typing import Any
 
 import discord
 import numpy as np
+import pandas as pd
 from pydantic import BaseModel, model_validator, computed_field
 
 from skellybot_analysis.data_models.context_route_model import ContextRoute
@@ -148,33 +149,17 @@ class ThreadModel(DataframeModel):
             channel_name=self.channel_name,
         )
     
-    def full_text(self, messages: list[MessageModel]) -> str:
+    def full_text(self, couplets: pd.DataFrame) -> str:
         """
-        Create a full text representation of the thread.
+        Create a full text representation of the thread from its conversation couplets
+        (see `df_db/conversation_couplets.py`), which must be this thread's couplets sorted by timestamp -
+        use `DataframeHandler.thread_text` to get the (cached) text built from the grouped, pre-sorted couplets.
         """
-        if not all([isinstance(message, MessageModel) for message in messages]):
-            raise ValueError("All messages must be of type MessageModel")
-        if not all([message.thread_id == self.thread_id for message in messages]):
-            raise ValueError("All messages must belong to the same thread")
-        previous_message_timestamp = None
-        for message in messages:
-            if previous_message_timestamp and message.timestamp < previous_message_timestamp:
-                raise ValueError("Messages are not sorted by timestamp")
-            previous_message_timestamp = message.timestamp
-
-        full_text = f"Server Name: {self.server_name}\n"
-        full_text += f"Channel Name: {self.channel_name}\n"
-        full_text += f"Category Name: {self.category_name}\n"
-        full_text += f"Created At: {self.created_at}\n"
-
-        full_text = f"Thread Name: {self.thread_name}\n"
-
-        for message in messages:
-            if message.bot_message:
-                # TODO - incorporate the 'merging bot messages and removing the 'continued from' text from teh df augmenter to this biz
-                full_text+= f"BOT:\n\n{message.content}" # ignore bot attachments for now
-            else:
-                full_text+= f"HUMAN:\n\n"
-            full_text += f"{message.full_content}\n\n"
-
-        return full_text
+        text_parts = [f"Thread Name: {self.thread_name}\n"]
+        for couplet in couplets.itertuples(index=False):
+            if couplet.human_end > couplet.human_start:
+                text_parts.append(f"HUMAN:\n\n{couplet.text[couplet.human_start:couplet.human_end]}\n\n")
+            if couplet.bot_end > couplet.bot_start:
+                text_parts.append(f"BOT:\n\n{couplet.text[couplet.bot_start:couplet.bot_end]}\n\n")
+
+        return "".join(text_parts)
@@ -0,0 +1,109 @@
+import logging
+from collections import defaultdict
+
+import pandas as pd
+
+from skellybot_analysis.data_models.server_models import MessageId
+from skellybot_analysis.df_db.df_augmentation.df_utils import remove_continuation_markers
+
+logger = logging.getLogger(__name__)
+
+COUPLET_TEXT_SEPARATOR = "\n\n"
+BOT_RESPONSE_SEPARATOR = "\n\n"
+NO_HUMAN_MESSAGE_ID = -1  # bot response chains that don't reply to any (known) human message
+
+# one row per human message (plus one per orphaned bot response chain)
+# columns:
+#   - human_message_id: the human message that started the exchange (NO_HUMAN_MESSAGE_ID for orphaned bot chains)
+#   - thread_id, author_id: of the human message (or of the first bot message for orphaned chains)
+#   - bot_response_ids: space separated ids of the bot messages that make up the response, in response order
+#   - text: human text + COUPLET_TEXT_SEPARATOR + merged bot response text
+#   - human_start, human_end, bot_start, bot_end: offsets of the human and bot spans within `text`
+#   - timestamp: of the first message of the exchange, last_response_timestamp: of the last bot message
+COUPLET_COLUMNS = ["human_message_id",
+                   "thread_id",
+                   "author_id",
+                   "bot_response_ids",
+                   "text",
+                   "human_start",
+                   "human_end",
+                   "bot_start",
+                   "bot_end",
+                   "timestamp",
+                   "last_response_timestamp"]
+
+
+def _as_message_id(value) -> MessageId:
+    if value is None or pd.isna(value):
+        return -1
+    return int(value)
+
+
+def build_couplet_table(messages_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Pair every human message with the (merged) chain of bot messages that respond to it, in one pass over the messages.
+
+    A bot response chain is every bot message that replies to the human message, then every bot message that
+    replies to those (the bot splits long responses into several messages), with the continuation markers removed.
+    """
+    if messages_df.empty:
+        return pd.DataFrame(columns=COUPLET_COLUMNS)
+    logger.info(f"Building conversation couplet table from {len(messages_df)} messages")
+
+    sorted_df = messages_df.sort_values('timestamp', kind='stable')
+    message_ids = {_as_message_id(message_id) for message_id in sorted_df['message_id']}
+
+    bot_replies_by_parent_id: dict[MessageId, list] = defaultdict(list)
+    for message in sorted_df[sorted_df['bot_message']].itertuples(index=False):
+        bot_replies_by_parent_id[_as_message_id(message.parent_message_id)].append(message)
+
+    def collect_responses(parent_id: MessageId) -> list:
+        direct_responses = bot_replies_by_parent_id.get(parent_id, [])
+        all_responses = list(direct_responses)
+        for response in direct_responses:
+            all_responses.extend(collect_responses(_as_message_id(response.message_id)))
+        return all_responses
+
+    rows = []
+    for message in sorted_df.itertuples(index=False):
+        message_id = _as_message_id(message.message_id)
+        if message.bot_message:
+            if _as_message_id(message.parent_message_id) in message_ids:
+                continue  # part of the response chain of an earlier message
+            human_message_id = NO_HUMAN_MESSAGE_ID
+            human_text = ""
+            responses = [message] + collect_responses(message_id)
+        else:
+            human_message_id = message_id
+            human_text = message.full_content
+            responses = collect_responses(message_id)
+
+        bot_text = remove_continuation_markers(BOT_RESPONSE_SEPARATOR.join(response.content
+                                                                           for response in responses))
+        separator = COUPLET_TEXT_SEPARATOR if human_text or not responses else ""
+        rows.append({
+            "human_message_id": human_message_id,
+            "thread_id": message.thread_id,
+            "author_id": message.author_id,
+            "bot_response_ids": " ".join(str(_as_message_id(response.message_id)) for response in responses),
+            "text": human_text + separator + bot_text,
+            "human_start": 0,
+            "human_end": len(human_text),
+            "bot_start": len(human_text) + len(separator),
+            "bot_end": len(human_text) + len(separator) + len(bot_text),
+            "timestamp": message.timestamp,
+            "last_response_timestamp": responses[-1].timestamp if responses else message.timestamp,
+        })
+
+    couplets_df = pd.DataFrame(rows, columns=COUPLET_COLUMNS)
+    logger.info(f"Built {len(couplets_df)} couplets "
+                f"({(couplets_df['human_message_id'] == NO_HUMAN_MESSAGE_ID).sum()} orphaned bot responses)")
+    return couplets_df
+
+
+def couplet_human_text(couplet: pd.Series) -> str:
+    return couplet["text"][couplet["human_start"]:couplet["human_end"]]
+
+
+def couplet_bot_text(couplet: pd.Series) -> str:
+    return couplet["text"][couplet["bot_start"]:couplet["bot_end"]]
@@ -3,11 +3,12 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 from skellybot_analysis.data_models.analysis_models import AiThreadAnalysisModel
 from skellybot_analysis.data_models.server_models import ThreadModel, MessageModel, UserModel, \
     ContextPromptModel, DataframeModel, ThreadId, MessageId, UserId, ContextId
+from skellybot_analysis.df_db.conversation_couplets import build_couplet_table
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +31,11 @@ class DataframeHandler(BaseModel):
 
     thread_analyses: dict[ThreadId, AiThreadAnalysisModel] = {}
 
+    _couplets_df: pd.DataFrame | None = PrivateAttr(default=None)
+    _messages_by_thread: dict[ThreadId, list[MessageModel]] | None = PrivateAttr(default=None)
+    _couplets_by_thread: dict[ThreadId, pd.DataFrame] | None = PrivateAttr(default=None)
+    _thread_texts: dict[ThreadId, str] = PrivateAttr(default_factory=dict)
+
     @property
     def messages_df(self) -> pd.DataFrame:
         """Convert messages to DataFrame"""
@@ -55,6 +61,45 @@ class DataframeHandler(BaseModel):
         """Convert thread analyses to DataFrame"""
         return model_list_to_dataframe(list(self.thread_analyses.values()))
 
+    @property
+    def couplets_df(self) -> pd.DataFrame:
+        """Human message/bot response couplets, built once and re-used until the messages change"""
+        if self._couplets_df is None:
+            self._couplets_df = build_couplet_table(self.messages_df)
+        return self._couplets_df
+
+    @property
+    def messages_by_thread(self) -> dict[ThreadId, list[MessageModel]]:
+        """Messages grouped by thread, each group sorted by timestamp (oldest first)"""
+        if self._messages_by_thread is None:
+            grouped: dict[ThreadId, list[MessageModel]] = {}
+            for message in sorted(self.messages.values(), key=lambda m: m.timestamp):
+                grouped.setdefault(message.thread_id, []).append(message)
+            self._messages_by_thread = grouped
+        return self._messages_by_thread
+
+    @property
+    def couplets_by_thread(self) -> dict[ThreadId, pd.DataFrame]:
+        """Conversation couplets grouped by thread, each group sorted by timestamp (oldest first)"""
+        if self._couplets_by_thread is None:
+            sorted_couplets = self.couplets_df.sort_values('timestamp', kind='stable')
+            self._couplets_by_thread = {thread_id: group
+                                        for thread_id, group in sorted_couplets.groupby('thread_id', sort=False)}
+        return self._couplets_by_thread
+
+    def thread_text(self, thread_id: ThreadId) -> str:
+        """Full text of a thread (see `ThreadModel.full_text`), built once per thread"""
+        if thread_id not in self._thread_texts:
+            thread_couplets = self.couplets_by_thread.get(thread_id, self.couplets_df.iloc[0:0])
+            self._thread_texts[thread_id] = self.threads[thread_id].full_text(couplets=thread_couplets)
+        return self._thread_texts[thread_id]
+
+    def _invalidate_indexes(self) -> None:
+        self._couplets_df = None
+        self._messages_by_thread = None
+        self._couplets_by_thread = None
+        self._thread_texts = {}
+
 
 
     @property
@@ -65,8 +110,10 @@ class DataframeHandler(BaseModel):
         """Buffer validated entity for batch writing"""
         if isinstance(entity, ThreadModel):
             self.threads[primary_id] = entity
+            self._thread_texts.pop(primary_id, None)
         elif isinstance(entity, MessageModel):
             self.messages[primary_id] = entity
+            self._invalidate_indexes()
         elif isinstance(entity, UserModel):
             self.users[primary_id] = entity
         elif isinstance(entity, ContextPromptModel):
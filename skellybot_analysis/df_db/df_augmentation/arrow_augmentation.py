@@ -0,0 +1,210 @@
+"""
+Arrow implementation of the dataframe augmentation functions.
+
+Same inputs/outputs as the pandas versions (`augment_messages`, `augment_threads`, `augment_users`,
+`calculate_cumulative_counts`), but each input is converted to an Arrow table once and every filter/sort/group/join
+runs as a (multi-threaded) Acero plan or compute kernel on the columnar data, instead of eager pandas copies.
+"""
+import enum
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import acero
+
+from skellybot_analysis.df_db.conversation_couplets import NO_HUMAN_MESSAGE_ID
+from skellybot_analysis.utilities.load_env_variables import PROF_USER_ID
+
+logger = logging.getLogger(__name__)
+
+ROW_INDEX_COLUMN = "__row_index"
+WORD_COUNT_SLICE_LENGTH = 50_000
+
+
+class AugmentationEngine(enum.Enum):
+    PANDAS = "pandas"
+    ARROW = "arrow"
+
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    if 'timestamp' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['timestamp']):
+        df = df.assign(timestamp=pd.to_datetime(df['timestamp']))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _to_pandas(table: pa.Table) -> pd.DataFrame:
+    # self_destruct frees each Arrow column as soon as it has been converted, so the peak stays ~1x the table size
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def _filter_and_sort(table: pa.Table,
+                     sort_keys: list[tuple[str, str]],
+                     filter_expression: pc.Expression | None = None) -> pa.Table:
+    declarations = [acero.Declaration("table_source", acero.TableSourceNodeOptions(table))]
+    if filter_expression is not None:
+        declarations.append(acero.Declaration("filter", acero.FilterNodeOptions(filter_expression)))
+    declarations.append(acero.Declaration("order_by", acero.OrderByNodeOptions(sort_keys)))
+    return acero.Declaration.from_sequence(declarations).to_table(use_threads=True)
+
+
+def _left_join_preserving_order(left: pa.Table, right: pa.Table, left_key: str, right_key: str) -> pa.Table:
+    """Left join that keeps the row order of `left` (like `pd.merge(how='left')`), dropping the right key column"""
+    right = right.set_column(right.schema.get_field_index(right_key),
+                             left_key,
+                             pc.cast(right[right_key], left.schema.field(left_key).type))
+    left = left.append_column(ROW_INDEX_COLUMN, pa.array(np.arange(left.num_rows)))
+    joined = left.join(right, keys=left_key, join_type="left outer", use_threads=True)
+    return joined.sort_by(ROW_INDEX_COLUMN).drop_columns([ROW_INDEX_COLUMN])
+
+
+def _count_words_in_slice(text: pa.Array) -> np.ndarray:
+    tokens = pc.utf8_split_whitespace(text)
+    flat_tokens = pc.list_flatten(tokens)
+    parent_indices = pc.list_parent_indices(tokens).to_numpy(zero_copy_only=False)
+    non_empty = pc.not_equal(pc.utf8_length(flat_tokens), 0).to_numpy(zero_copy_only=False)
+    return np.bincount(parent_indices[non_empty], minlength=len(text)).astype(np.int64)
+
+
+def count_words_arrow(text: pa.ChunkedArray | pa.Array) -> pa.Array:
+    """Arrow equivalent of `count_words` (whitespace separated words, null -> 0), spread over the CPU cores"""
+    if isinstance(text, pa.ChunkedArray):
+        text = text.combine_chunks()
+    if len(text) == 0:
+        return pa.array([], type=pa.int64())
+    slices = [text.slice(offset, WORD_COUNT_SLICE_LENGTH) for offset in range(0, len(text), WORD_COUNT_SLICE_LENGTH)]
+    with ThreadPoolExecutor(max_workers=pa.cpu_count()) as executor:
+        counts = list(executor.map(_count_words_in_slice, slices))
+    return pa.array(np.concatenate(counts))
+
+
+def augment_messages_arrow(messages_df: pd.DataFrame, couplets_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Arrow version of `augment_messages`"""
+    logger.info("Augmenting messages with word counts (arrow engine)")
+
+    messages = _filter_and_sort(_to_arrow(messages_df),
+                                sort_keys=[("timestamp", "ascending")],
+                                filter_expression=pc.field("author_id") != PROF_USER_ID)
+    messages = messages.append_column("word_count", count_words_arrow(messages["content"]))
+
+    human_messages = messages.filter(pc.invert(messages["bot_message"]))
+
+    couplets = couplets_df[couplets_df['human_message_id'] != NO_HUMAN_MESSAGE_ID]
+    couplet_columns = pa.table({
+        "human_message_id": pa.array(couplets['human_message_id'].to_numpy(), type=pa.int64()),
+        "bot_response": pa.array([text[start:end] for text, start, end in zip(couplets['text'],
+                                                                             couplets['bot_start'],
+                                                                             couplets['bot_end'])],
+                                 type=pa.string()),
+        "message_and_response": pa.array(couplets['text'].tolist(), type=pa.string()),
+    })
+    human_messages = _left_join_preserving_order(human_messages, couplet_columns,
+                                                 left_key="message_id",
+                                                 right_key="human_message_id")
+    human_messages = human_messages.set_column(
+        human_messages.schema.get_field_index("bot_response"),
+        "bot_response",
+        pc.coalesce(human_messages["bot_response"], ""))
+    human_messages = human_messages.set_column(
+        human_messages.schema.get_field_index("message_and_response"),
+        "message_and_response",
+        pc.coalesce(human_messages["message_and_response"],
+                    pc.binary_join_element_wise(human_messages["full_content"], "", "\n\n")))
+
+    human_messages = human_messages.append_column("total_word_count",
+                                                  count_words_arrow(human_messages["message_and_response"]))
+    human_messages = human_messages.append_column("human_word_count",
+                                                  count_words_arrow(human_messages["full_content"]))
+    human_messages = human_messages.append_column("bot_word_count",
+                                                  count_words_arrow(human_messages["bot_response"]))
+
+    return _to_pandas(messages), _to_pandas(human_messages)
+
+
+def _aggregate_by(table: pa.Table, key: str, aggregations: dict[str, tuple[str, str]]) -> pa.Table:
+    """
+    Group `table` by `key`, `aggregations` maps output column name -> (input column, aggregate function),
+    with `("", "count_all")` for the group size.
+    """
+    grouped = table.group_by(key, use_threads=True).aggregate(
+        [([], function) if function == "count_all" else (column, function)
+         for column, function in aggregations.values()])
+    arrow_names = ["count_all" if function == "count_all" else f"{column}_{function}"
+                   for column, function in aggregations.values()]
+    return grouped.select([key] + arrow_names).rename_columns([key] + list(aggregations.keys()))
+
+
+def augment_threads_arrow(threads_df: pd.DataFrame, human_messages_df: pd.DataFrame) -> pd.DataFrame:
+    """Arrow version of `augment_threads`"""
+    logger.info("Augmenting threads with message and word counts (arrow engine)")
+
+    per_thread = _aggregate_by(_to_arrow(human_messages_df), key="thread_id", aggregations={
+        "total_word_count": ("total_word_count", "sum"),
+        "bot_word_count": ("bot_word_count", "sum"),
+        "human_word_count": ("human_word_count", "sum"),
+        "message_count": ("", "count_all"),
+        "threads_participated": ("author_id", "count_distinct"),
+    })
+    threads = _left_join_preserving_order(_to_arrow(threads_df), per_thread,
+                                          left_key="thread_id",
+                                          right_key="thread_id")
+    return _to_pandas(threads)
+
+
+def augment_users_arrow(users_df: pd.DataFrame, human_messages_df: pd.DataFrame) -> pd.DataFrame:
+    """Arrow version of `augment_users`"""
+    logger.info("Augmenting users with activity metrics (arrow engine)")
+
+    users = _to_arrow(users_df)
+    users = users.filter(pc.and_(pc.invert(users["is_bot"]), pc.not_equal(users["user_id"], PROF_USER_ID)))
+
+    per_user = _aggregate_by(_to_arrow(human_messages_df), key="author_id", aggregations={
+        "total_messages_sent": ("", "count_all"),
+        "threads_participated": ("thread_id", "count_distinct"),
+        "total_words_sent": ("human_word_count", "sum"),
+        "total_words_received": ("bot_word_count", "sum"),
+    })
+    users = _left_join_preserving_order(users, per_user,
+                                        left_key="user_id",
+                                        right_key="author_id")
+    return _to_pandas(users)
+
+
+def calculate_cumulative_counts_arrow(human_messages_df: pd.DataFrame) -> pd.DataFrame:
+    """Arrow version of `calculate_cumulative_counts`"""
+    logger.info("Calculating cumulative message counts and word counts (arrow engine)")
+
+    human_messages = _to_arrow(human_messages_df)
+
+    # Running message count per user, ordered by (author_id, timestamp)
+    per_user = human_messages.group_by(["author_id", "timestamp"], use_threads=True).aggregate([([], "count_all")])
+    per_user = per_user.sort_by([("author_id", "ascending"), ("timestamp", "ascending")])
+    counts = per_user["count_all"].to_numpy()
+    authors = per_user["author_id"].to_numpy()
+    running_total = np.cumsum(counts)
+    group_starts = np.flatnonzero(np.r_[True, authors[1:] != authors[:-1]]) if len(authors) else np.array([], int)
+    total_before_group = np.repeat(running_total[group_starts] - counts[group_starts],
+                                   np.diff(np.r_[group_starts, len(authors)]))
+    user_cumulative = pa.table({
+        "author_id": per_user["author_id"],
+        "timestamp": per_user["timestamp"],
+        "cumulative_message_count": pa.array(running_total - total_before_group, type=pa.int64()),
+    })
+
+    # Running totals across all users, ordered by timestamp
+    per_timestamp = _aggregate_by(human_messages, key="timestamp", aggregations={
+        "total_cumulative_count": ("", "count_all"),
+        "cumulative_total_word_count": ("total_word_count", "sum"),
+        "cumulative_human_word_count": ("human_word_count", "sum"),
+        "cumulative_bot_word_count": ("bot_word_count", "sum"),
+    }).sort_by("timestamp")
+    per_timestamp = pa.table({name: (pc.cumulative_sum(column.combine_chunks()) if name != "timestamp" else column)
+                              for name, column in zip(per_timestamp.column_names, per_timestamp.columns)})
+
+    result = _left_join_preserving_order(user_cumulative, per_timestamp,
+                                         left_key="timestamp",
+                                         right_key="timestamp")
+    return _to_pandas(result)
@@ -3,15 +3,17 @@ from typing import Tuple
 
 import pandas as pd
 
-from skellybot_analysis.df_db.df_augmentation.df_utils import count_words, combine_bot_messages
+from skellybot_analysis.df_db.conversation_couplets import NO_HUMAN_MESSAGE_ID
+from skellybot_analysis.df_db.df_augmentation.df_utils import count_words
 from skellybot_analysis.utilities.load_env_variables import PROF_USER_ID
 
 logger = logging.getLogger(__name__)
 
 
-def augment_messages(messages_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def augment_messages(messages_df: pd.DataFrame, couplets_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Augment the messages dataframe with word counts and create human messages dataframe.
+    Augment the messages dataframe with word counts and create human messages dataframe,
+    with the bot responses taken from the conversation couplet table.
 
     Returns:
         Tuple of (augmented_messages_df, human_messages_df)
@@ -29,7 +31,7 @@ def augment_messages(messages_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFr
         df['timestamp'] = pd.to_datetime(df['timestamp'])
 
     # Sort messages by timestamp
-    df = df.sort_values('timestamp')
+    df = df.sort_values('timestamp', kind='stable')
 
     # Add word count to messages
     df['word_count'] = df['content'].apply(count_words)
@@ -37,15 +39,17 @@ def augment_messages(messages_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFr
     # Create human and bot message dataframes
     human_messages_df = df[~df['bot_message']].copy()
 
-    # Find bot responses to human messages using the improved function
-    human_messages_df['bot_response'] = human_messages_df['message_id'].apply(
-        lambda msg_id: combine_bot_messages(df, msg_id)
-    )
+    # Look up the (merged) bot responses to each human message
+    couplets = couplets_df[couplets_df['human_message_id'] != NO_HUMAN_MESSAGE_ID].set_index('human_message_id')
+    bot_responses = pd.Series([text[start:end] for text, start, end in zip(couplets['text'],
+                                                                         couplets['bot_start'],
+                                                                         couplets['bot_end'])],
+                              index=couplets.index, dtype=object)
+    human_messages_df['bot_response'] = human_messages_df['message_id'].map(bot_responses).fillna('')
 
     # Combine message and response
-    human_messages_df['message_and_response'] = (
-            human_messages_df['content'] + '\n\n' +
-            human_messages_df['bot_response'].fillna('')
+    human_messages_df['message_and_response'] = human_messages_df['message_id'].map(couplets['text']).fillna(
+        human_messages_df['full_content'] + '\n\n'
     )
 
     # add total_word_count, human_word_count, and bot_word_count to human messages
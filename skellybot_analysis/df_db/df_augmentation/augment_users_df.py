@@ -43,6 +43,9 @@ def augment_users(users_df: pd.DataFrame, human_messages_df: pd.DataFrame) -> pd
     )
     df = df.merge(words_sent_by_user, how='left', left_on='user_id', right_on='author_id')
 
+    if 'author_id' in df.columns:
+        df = df.drop('author_id', axis=1)
+
     words_received_by_user = human_messages_df.groupby('author_id')['bot_word_count'].sum().reset_index(
         name='total_words_received'
     )
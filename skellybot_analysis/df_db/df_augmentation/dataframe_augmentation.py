@@ -1,102 +1,525 @@
 import logging
+from functools import partial
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
-from skellybot_analysis.ai.analyze_server_data import ai_analyze_threads
-from skellybot_analysis.ai.calculate_embeddings_and_projections import calculate_embeddings_and_projections, \
-    EmbeddableItem
-from skellybot_analysis.data_models.analysis_models import AiThreadAnalysisModel
+from skellybot_analysis.ai.analyze_server_data import ai_analyze_threads, LongThreadStrategy, \
+    DEFAULT_LONG_THREAD_STRATEGY, DEFAULT_MAX_CONCURRENT_CHUNK_CALLS
+from skellybot_analysis.ai.calculate_embeddings_and_projections import calculate_embeddings, \
+    calculate_projections, EmbeddableItem, RANDOM_SEED
+from skellybot_analysis.ai.analysis_job_queue import AnalysisBudget, JobPriority, DEFAULT_JOB_PRIORITY
+from skellybot_analysis.ai.clients.call_metrics import get_call_metrics_recorder
+from skellybot_analysis.ai.clients.structured_output import StructuredOutputProvider, get_structured_output_provider
+from skellybot_analysis.ai.embeddings_stuff.chunked_embedding import DEFAULT_POOLING_METHOD, max_chunk_tokens
+from skellybot_analysis.ai.embeddings_stuff.embedding_backends import EmbeddingBackend, get_embedding_backend
+from skellybot_analysis.ai.embeddings_stuff.embedding_index import NeighborIndexKind, EXACT_INDEX_MAX_ROWS, \
+    EMBEDDING_INDEX_FOLDER_NAME, EMBEDDING_INDEX_INFO_FILENAME, build_and_benchmark_embedding_index
+from skellybot_analysis.ai.embeddings_stuff.embedding_quantization import EmbeddingStorageDtype, \
+    DEFAULT_EMBEDDING_STORAGE_DTYPE, store_embeddings, dequantize_embeddings
+from skellybot_analysis.ai.rollup_analyses import ai_rollup_analyses
+from skellybot_analysis.ai.user_profiles import ai_user_profiles
+from skellybot_analysis.data_models.analysis_models import AiThreadAnalysisModel, AiRollupAnalysisModel, \
+    AiUserProfileModel
+from skellybot_analysis.df_db.df_augmentation.arrow_augmentation import AugmentationEngine, \
+    augment_messages_arrow, augment_threads_arrow, augment_users_arrow, calculate_cumulative_counts_arrow
 from skellybot_analysis.df_db.df_augmentation.augment_messages import augment_messages
 from skellybot_analysis.df_db.df_augmentation.augment_threads_df import augment_threads
 from skellybot_analysis.df_db.df_augmentation.augment_users_df import augment_users
 from skellybot_analysis.df_db.df_augmentation.calculate_cumulative_counts import calculate_cumulative_counts
-from skellybot_analysis.df_db.dataframe_handler import DataframeHandler
-from skellybot_analysis.data_models.server_models import ThreadId
+from skellybot_analysis.df_db.df_augmentation.pipeline_stages import PipelineStage, StagedPipeline, \
+    StageKind, PipelineRunReport, IncompleteStageError
+from skellybot_analysis.data_models.server_models import DataframeModel
+from skellybot_analysis.df_db.dataframe_handler import DataframeHandler, model_list_to_dataframe
 from skellybot_analysis.utilities.get_most_recent_db_location import get_most_recent_db_location
 
 logger = logging.getLogger(__name__)
 
 MINIMUM_TAG_RANK = 10
+EMBEDDING_INDEX_ITEM_COLUMNS = ["embedding_index", "content_type", "embedded_text", "message_id", "thread_id",
+                                "channel_id", "user_id", "jump_url", "embedding_method"]
 
-async def augment_dataframes(dataframe_handler: DataframeHandler, skip_ai: bool = False, skip_embeddings:bool=False) -> None:
 
-    logger.info("Starting dataframe augmentation")
+def _augment_messages_stage(messages: pd.DataFrame,
+                            couplets: pd.DataFrame,
+                            engine: AugmentationEngine) -> dict[str, pd.DataFrame]:
+    augment = augment_messages_arrow if engine == AugmentationEngine.ARROW else augment_messages
+    augmented_messages_df, human_messages_df = augment(messages_df=messages, couplets_df=couplets)
+    return {"augmented_messages": augmented_messages_df,
+            "human_messages": human_messages_df}
 
-    # Augment messages and create human messages
-    augmented_messages_df, human_messages_df = augment_messages(dataframe_handler.messages_df)
-    
-    # Augment threads
-    augmented_threads_df = augment_threads(threads_df=dataframe_handler.threads_df,
-                                           human_messages_df=human_messages_df)
-    
-    # Augment users
-    augmented_users_df = augment_users(dataframe_handler.users_df, human_messages_df)
-    
-    # Calculate cumulative counts
-    cumulative_counts_df = calculate_cumulative_counts(human_messages_df)
-
-
-
-    # Store results
-    base_path = Path(dataframe_handler.db_path)
-    augmented_messages_df.to_csv(base_path / 'augmented_messages.csv', index=False)
-    human_messages_df.to_csv(base_path / 'human_messages.csv', index=False)
-    augmented_threads_df.to_csv(base_path / 'augmented_threads.csv', index=False)
-    augmented_users_df.to_csv(base_path / 'augmented_users.csv', index=False)
-    cumulative_counts_df.to_csv(base_path / 'cumulative_counts.csv', index=False)
-
-    if not skip_ai:
-        # Run ai analyses on threads
-        thread_analyses:dict[ThreadId, AiThreadAnalysisModel] = await ai_analyze_threads(dataframe_handler=dataframe_handler)
-        [dataframe_handler.store(primary_id=thread_id,
-                                 entity=analysis) for thread_id, analysis in thread_analyses.items()]
-        dataframe_handler.save_raw_csvs()
-
-    if not skip_embeddings:
-        embeddable_items = []
-        # Add messages
-        for _, row in human_messages_df.iterrows():
-            embeddable_items.append(
-                EmbeddableItem.from_human_message_row(df_row=row,
-                                                      index=len(embeddable_items))
-            )
-        # Add thread analyses
-        for analysis in dataframe_handler.thread_analyses.values():
+
+def _augment_threads_stage(threads: pd.DataFrame,
+                           human_messages: pd.DataFrame,
+                           engine: AugmentationEngine) -> dict[str, pd.DataFrame]:
+    augment = augment_threads_arrow if engine == AugmentationEngine.ARROW else augment_threads
+    return {"augmented_threads": augment(threads_df=threads,
+                                         human_messages_df=human_messages)}
+
+
+def _augment_users_stage(users: pd.DataFrame,
+                         human_messages: pd.DataFrame,
+                         engine: AugmentationEngine) -> dict[str, pd.DataFrame]:
+    augment = augment_users_arrow if engine == AugmentationEngine.ARROW else augment_users
+    return {"augmented_users": augment(users_df=users, human_messages_df=human_messages)}
+
+
+def _cumulative_counts_stage(human_messages: pd.DataFrame, engine: AugmentationEngine) -> dict[str, pd.DataFrame]:
+    calculate = calculate_cumulative_counts_arrow if engine == AugmentationEngine.ARROW else calculate_cumulative_counts
+    return {"cumulative_counts": calculate(human_messages_df=human_messages)}
+
+
+async def _ai_thread_analysis_stage(dataframe_handler: DataframeHandler,
+                                    long_thread_strategy: LongThreadStrategy,
+                                    max_concurrent_chunk_calls: int,
+                                    provider: StructuredOutputProvider,
+                                    job_priority: JobPriority,
+                                    budget: AnalysisBudget | None,
+                                    **_inputs) -> dict[str, pd.DataFrame]:
+    # `threads` and `couplets` are declared inputs (so changes invalidate this stage), but the analysis itself
+    # works from the validated models (and the same couplet table) held by the dataframe handler
+    thread_analyses = await ai_analyze_threads(dataframe_handler=dataframe_handler,
+                                               long_thread_strategy=long_thread_strategy,
+                                               max_concurrent_chunk_calls=max_concurrent_chunk_calls,
+                                               provider=provider,
+                                               job_priority=job_priority,
+                                               budget=budget)
+    for thread_id, analysis in thread_analyses.items():
+        dataframe_handler.store(primary_id=thread_id, entity=analysis)
+    outputs = {"thread_analyses": dataframe_handler.thread_analyses_df}
+
+    unanalyzed_thread_ids = [thread_id for thread_id in dataframe_handler.threads
+                             if dataframe_handler.messages_by_thread.get(thread_id) and thread_id not in thread_analyses]
+    if unanalyzed_thread_ids:
+        raise IncompleteStageError(reason=f"{len(unanalyzed_thread_ids)} threads not analyzed (failed or over the budget)", outputs=outputs)
+    return outputs
+
+
+def _thread_analyses_from_df(thread_analyses_df: pd.DataFrame) -> list[AiThreadAnalysisModel]:
+    if thread_analyses_df.empty:
+        return []
+    records = thread_analyses_df.replace({np.nan: None}).to_dict(orient='records')
+    return [AiThreadAnalysisModel.model_validate(record) for record in records]
+
+
+def _previous_models(db_path: str, model_cls: type[DataframeModel]) -> list[DataframeModel]:
+    """The models of the `model_cls` csv written by the previous run (used as the cache of the LLM stages)"""
+    csv_path = Path(db_path) / model_cls.df_filename()
+    if not csv_path.exists():
+        return []
+    try:
+        records = pd.read_csv(csv_path).replace({np.nan: None}).to_dict(orient='records')
+    except pd.errors.EmptyDataError:
+        return []
+    return [model_cls.model_validate(record) for record in records]
+
+
+async def _ai_rollup_stage(db_path: str,
+                           provider: StructuredOutputProvider,
+                           thread_analyses: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    # the previous run's rollups are the cache - rollups whose children are unchanged are re-used
+    previous_rollups = {rollup.rollup_id: rollup for rollup in _previous_models(db_path, AiRollupAnalysisModel)}
+    rollups, failures = await ai_rollup_analyses(thread_analyses=_thread_analyses_from_df(thread_analyses),
+                                                 previous_rollups=previous_rollups,
+                                                 provider=provider)
+    outputs = {"rollup_analyses": model_list_to_dataframe(list(rollups.values()))}
+    if failures:
+        raise IncompleteStageError(reason=f"{failures} rollup summaries failed", outputs=outputs)
+    return outputs
+
+
+async def _ai_user_profiles_stage(db_path: str,
+                                  provider: StructuredOutputProvider,
+                                  thread_analyses: pd.DataFrame,
+                                  human_messages: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    thread_ids_by_user = {int(user_id): set(thread_ids.astype(int))
+                          for user_id, thread_ids in human_messages.groupby("author_id")["thread_id"]}
+    previous_profiles = {profile.user_id: profile for profile in _previous_models(db_path, AiUserProfileModel)}
+    profiles, failures = await ai_user_profiles(thread_analyses=_thread_analyses_from_df(thread_analyses),
+                                                thread_ids_by_user=thread_ids_by_user,
+                                                previous_profiles=previous_profiles,
+                                                provider=provider)
+    outputs = {"user_profiles": model_list_to_dataframe([profiles[user_id] for user_id in sorted(profiles)])}
+    if failures:
+        raise IncompleteStageError(reason=f"{failures} user profiles failed", outputs=outputs)
+    return outputs
+
+
+def _message_embeddable_items(human_messages: pd.DataFrame) -> list[EmbeddableItem]:
+    embeddable_items = []
+    for _, row in human_messages.iterrows():
+        embeddable_items.append(
+            EmbeddableItem.from_human_message_row(df_row=row,
+                                                  index=len(embeddable_items))
+        )
+    return embeddable_items
+
+
+def _analysis_and_tag_embeddable_items(thread_analyses: pd.DataFrame,
+                                       start_index: int,
+                                       minimum_tag_rank: int) -> list[EmbeddableItem]:
+    """Items for the thread analyses and their most common tags, indexed from `start_index` (i.e. after the messages)"""
+    analyses = _thread_analyses_from_df(thread_analyses)
+    embeddable_items = []
+    # Add thread analyses
+    for analysis in analyses:
+        embeddable_items.append(
+            EmbeddableItem.from_thread_analysis(analysis=analysis,
+                                                index=start_index + len(embeddable_items)
+                                                )
+        )
+    # Add tags
+    tags_with_rank: dict[str, int] = {}
+    for analysis in analyses:
+        for tag in analysis.tags:
+            if tag not in tags_with_rank:
+                tags_with_rank[tag] = 0
+            tags_with_rank[tag] += 1
+
+    filtered_tags = {tag: rank for tag, rank in tags_with_rank.items() if rank > minimum_tag_rank}
+    for tag in filtered_tags.keys():
+        try:
             embeddable_items.append(
-                EmbeddableItem.from_thread_analysis(analysis=analysis,
-                                                    index=len(embeddable_items)
-                                                    )
+                EmbeddableItem.from_tag(tag=tag,
+                                        index=start_index + len(embeddable_items))
             )
-        # Add tags
-        tags_with_rank : dict[str,int]= {}
-        for analysis in dataframe_handler.thread_analyses.values():
-            for tag in analysis.tags:
-                if tag not in tags_with_rank:
-                    tags_with_rank[tag] = 0
-                tags_with_rank[tag] += 1
-
-
-        filtered_tags = {tag: rank for tag, rank in tags_with_rank.items() if rank > MINIMUM_TAG_RANK}
-        for tag in filtered_tags.keys():
-            try:
-                embeddable_items.append(
-                    EmbeddableItem.from_tag(tag=tag,
-                                            index=len(embeddable_items))
-                )
-            except Exception as e:
-                logger.error(f"Error creating EmbeddableItem from tag {tag}: {e} - skipping this tag.")
-                continue
-
-
-
-        _, embedding_projections_df = await calculate_embeddings_and_projections(
-            embeddable_items=embeddable_items,
-        )
+        except Exception as e:
+            logger.error(f"Error creating EmbeddableItem from tag {tag}: {e} - skipping this tag.")
+            continue
+    return embeddable_items
+
+
+def _user_profile_embeddable_items(user_profiles: pd.DataFrame, start_index: int) -> list[EmbeddableItem]:
+    """Items for the user profiles, indexed from `start_index` (i.e. after the analyses and tags)"""
+    if user_profiles.empty:
+        return []
+    records = user_profiles.replace({np.nan: None}).to_dict(orient='records')
+    return [EmbeddableItem.from_user_profile(profile=AiUserProfileModel.model_validate(record), index=start_index + index)
+            for index, record in enumerate(records)]
+
+
+def _chunk_counts(embedded_items: list[EmbeddableItem]) -> np.ndarray:
+    # set by `calculate_embeddings`, saved so the downstream stages don't have to tokenize every text again
+    return np.array([item.chunk_count for item in embedded_items], dtype=np.int32)
+
+
+async def _embed_messages_stage(embedding_backend: EmbeddingBackend,
+                                storage_dtype: EmbeddingStorageDtype,
+                                human_messages: pd.DataFrame) -> dict[str, np.ndarray]:
+    items = _message_embeddable_items(human_messages)
+    embeddings = await calculate_embeddings(items, embedding_backend=embedding_backend)
+    return {"message_embeddings": store_embeddings(embeddings, storage_dtype, label="message embeddings"),
+            "message_chunk_counts": _chunk_counts(items)}
+
+
+async def _embed_analyses_and_tags_stage(embedding_backend: EmbeddingBackend,
+                                         storage_dtype: EmbeddingStorageDtype,
+                                         human_messages: pd.DataFrame,
+                                         thread_analyses: pd.DataFrame,
+                                         minimum_tag_rank: int) -> dict[str, np.ndarray]:
+    items = _analysis_and_tag_embeddable_items(thread_analyses=thread_analyses,
+                                               start_index=len(human_messages),
+                                               minimum_tag_rank=minimum_tag_rank)
+    embeddings = await calculate_embeddings(items, embedding_backend=embedding_backend)
+    return {"analysis_embeddings": store_embeddings(embeddings, storage_dtype, label="analysis and tag embeddings"),
+            "analysis_chunk_counts": _chunk_counts(items)}
+
+
+async def _embed_user_profiles_stage(embedding_backend: EmbeddingBackend,
+                                     storage_dtype: EmbeddingStorageDtype,
+                                     user_profiles: pd.DataFrame) -> dict[str, np.ndarray]:
+    # indexed from 0 here (`calculate_embeddings` only checks that the items are consecutive),
+    # the projections stage re-indexes them after the messages, analyses and tags
+    items = _user_profile_embeddable_items(user_profiles, start_index=0)
+    embeddings = await calculate_embeddings(items, embedding_backend=embedding_backend)
+    return {"user_profile_embeddings": store_embeddings(embeddings, storage_dtype, label="user profile embeddings"),
+            "user_profile_chunk_counts": _chunk_counts(items)}
+
+
+def _all_embeddable_items(human_messages: pd.DataFrame,
+                          thread_analyses: pd.DataFrame,
+                          user_profiles: pd.DataFrame,
+                          minimum_tag_rank: int,
+                          embedding_method: str,
+                          chunk_counts: list[np.ndarray]) -> list[EmbeddableItem]:
+    """Every embedded item, in the order of the concatenated embeddings (see `_all_embeddings`)"""
+    embeddable_items = _message_embeddable_items(human_messages) + _analysis_and_tag_embeddable_items(
+        thread_analyses=thread_analyses,
+        start_index=len(human_messages),
+        minimum_tag_rank=minimum_tag_rank)
+    embeddable_items += _user_profile_embeddable_items(user_profiles, start_index=len(embeddable_items))
+    # the embedding stages set these on their own copies of the items, and save the chunk counts
+    all_chunk_counts = np.concatenate([counts.ravel() for counts in chunk_counts]).astype(int)
+    if all_chunk_counts.size != len(embeddable_items):
+        logger.warning(f"Got {all_chunk_counts.size} chunk counts for {len(embeddable_items)} embedded items "
+                       f"(embeddings from an older run?) - re-run the embedding stages to record them")
+        all_chunk_counts = np.ones(len(embeddable_items), dtype=int)
+    for item, chunk_count in zip(embeddable_items, all_chunk_counts):
+        item.embedding_method = embedding_method
+        item.chunk_count = int(chunk_count)
+    return embeddable_items
+
+
+def _all_embeddings(*stored_embeddings: np.ndarray) -> np.ndarray:
+    # stored embeddings may be float16/int8 quantized - the projections and the neighbor index work on float32
+    embeddings = [dequantize_embeddings(embeddings) for embeddings in stored_embeddings if embeddings.size > 0]
+    if not embeddings:
+        # e.g. the embed stages are disabled and there are no embeddings on disk yet
+        return np.empty((0, 0), dtype=np.float32)
+    return np.concatenate(embeddings)
+
+
+def _projections_stage(human_messages: pd.DataFrame,
+                       thread_analyses: pd.DataFrame,
+                       user_profiles: pd.DataFrame,
+                       message_embeddings: np.ndarray,
+                       analysis_embeddings: np.ndarray,
+                       user_profile_embeddings: np.ndarray,
+                       message_chunk_counts: np.ndarray,
+                       analysis_chunk_counts: np.ndarray,
+                       user_profile_chunk_counts: np.ndarray,
+                       minimum_tag_rank: int,
+                       embedding_method: str) -> dict[str, pd.DataFrame]:
+    embeddings_npy = _all_embeddings(message_embeddings, analysis_embeddings, user_profile_embeddings)
+    if embeddings_npy.shape[0] == 0:
+        logger.warning("No embeddings to project - skipping the projections")
+        return {"embedding_projections": pd.DataFrame()}
+    embeddable_items = _all_embeddable_items(human_messages=human_messages,
+                                             thread_analyses=thread_analyses,
+                                             user_profiles=user_profiles,
+                                             minimum_tag_rank=minimum_tag_rank,
+                                             embedding_method=embedding_method,
+                                             chunk_counts=[message_chunk_counts, analysis_chunk_counts,
+                                                           user_profile_chunk_counts])
+    _, embedding_projections_df = calculate_projections(embeddable_items=embeddable_items,
+                                                        embeddings_npy=embeddings_npy)
+    return {"embedding_projections": embedding_projections_df}
+
+
+def _embedding_index_stage(human_messages: pd.DataFrame,
+                           thread_analyses: pd.DataFrame,
+                           user_profiles: pd.DataFrame,
+                           message_embeddings: np.ndarray,
+                           analysis_embeddings: np.ndarray,
+                           user_profile_embeddings: np.ndarray,
+                           message_chunk_counts: np.ndarray,
+                           analysis_chunk_counts: np.ndarray,
+                           user_profile_chunk_counts: np.ndarray,
+                           minimum_tag_rank: int,
+                           embedding_method: str,
+                           index_kind: NeighborIndexKind | None,
+                           db_path: str) -> dict[str, pd.DataFrame]:
+    # the index itself is saved to `<db_path>/embedding_index/` (see `EmbeddingIndex.load`),
+    # its build/query benchmark is the stage's output
+    vectors = _all_embeddings(message_embeddings, analysis_embeddings, user_profile_embeddings)
+    if vectors.shape[0] == 0:
+        logger.warning("No embeddings to index - skipping the embedding index")
+        return {"embedding_index_benchmark": pd.DataFrame()}
+    embeddable_items = _all_embeddable_items(human_messages=human_messages,
+                                             thread_analyses=thread_analyses,
+                                             user_profiles=user_profiles,
+                                             minimum_tag_rank=minimum_tag_rank,
+                                             embedding_method=embedding_method,
+                                             chunk_counts=[message_chunk_counts, analysis_chunk_counts,
+                                                           user_profile_chunk_counts])
+    items_df = pd.DataFrame([item.model_dump(include=set(EMBEDDING_INDEX_ITEM_COLUMNS)) for item in embeddable_items],
+                            columns=EMBEDDING_INDEX_ITEM_COLUMNS)
+    index, benchmarks = build_and_benchmark_embedding_index(vectors=vectors, items=items_df, kind=index_kind)
+    index.save(db_path)
+    return {"embedding_index_benchmark": pd.DataFrame([benchmark.model_dump() for benchmark in benchmarks])}
+
+
+def build_augmentation_stages(dataframe_handler: DataframeHandler,
+                              skip_ai: bool = False,
+                              skip_embeddings: bool = False,
+                              engine: AugmentationEngine = AugmentationEngine.PANDAS,
+                              long_thread_strategy: LongThreadStrategy = DEFAULT_LONG_THREAD_STRATEGY,
+                              max_concurrent_chunk_calls: int = DEFAULT_MAX_CONCURRENT_CHUNK_CALLS,
+                              analysis_provider: StructuredOutputProvider | None = None,
+                              job_priority: JobPriority = DEFAULT_JOB_PRIORITY,
+                              analysis_budget: AnalysisBudget | None = None,
+                              embedding_backend: EmbeddingBackend | None = None,
+                              embedding_storage_dtype: EmbeddingStorageDtype = DEFAULT_EMBEDDING_STORAGE_DTYPE,
+                              neighbor_index_kind: NeighborIndexKind | None = None) -> list[PipelineStage]:
+    """
+    The augmentation pipeline, in dependency order. Message embeddings only depend on the augmented messages,
+    so they are computed while the (slow) thread analyses are still running.
+    Both engines produce the same tables, so the engine is not part of the stage parameters (i.e. switching
+    engines does not invalidate cached outputs).
+    """
+    analysis_provider = analysis_provider or get_structured_output_provider()
+    embedding_backend = embedding_backend or get_embedding_backend()
+    embedding_parameters = {"embedding_backend": embedding_backend.name,
+                            "pooling": DEFAULT_POOLING_METHOD.value,
+                            "max_chunk_tokens": max_chunk_tokens(embedding_backend.model),
+                            "storage_dtype": embedding_storage_dtype.value}
+    return [
+        PipelineStage(name="augment_messages",
+                      kind=StageKind.CPU,
+                      inputs=["messages", "couplets"],
+                      outputs={"augmented_messages": "augmented_messages.csv",
+                               "human_messages": "human_messages.csv"},
+                      run=partial(_augment_messages_stage, engine=engine)),
+        PipelineStage(name="augment_threads",
+                      kind=StageKind.CPU,
+                      inputs=["threads", "human_messages"],
+                      outputs={"augmented_threads": "augmented_threads.csv"},
+                      run=partial(_augment_threads_stage, engine=engine)),
+        PipelineStage(name="augment_users",
+                      kind=StageKind.CPU,
+                      inputs=["users", "human_messages"],
+                      outputs={"augmented_users": "augmented_users.csv"},
+                      run=partial(_augment_users_stage, engine=engine)),
+        PipelineStage(name="cumulative_counts",
+                      kind=StageKind.CPU,
+                      inputs=["human_messages"],
+                      outputs={"cumulative_counts": "cumulative_counts.csv"},
+                      run=partial(_cumulative_counts_stage, engine=engine)),
+        PipelineStage(name="ai_thread_analysis",
+                      kind=StageKind.IO,
+                      inputs=["threads", "couplets"],
+                      outputs={"thread_analyses": AiThreadAnalysisModel.df_filename()},
+                      run=partial(_ai_thread_analysis_stage,
+                                  dataframe_handler=dataframe_handler,
+                                  long_thread_strategy=long_thread_strategy,
+                                  max_concurrent_chunk_calls=max_concurrent_chunk_calls,
+                                  provider=analysis_provider,
+                                  job_priority=job_priority,
+                                  budget=analysis_budget),
+                      parameters={"llm": analysis_provider.name, "long_thread_strategy": long_thread_strategy.value},
+                      enabled=not skip_ai),
+        PipelineStage(name="ai_rollup_analyses",
+                      kind=StageKind.IO,
+                      inputs=["thread_analyses"],
+                      outputs={"rollup_analyses": AiRollupAnalysisModel.df_filename()},
+                      run=partial(_ai_rollup_stage,
+                                  db_path=dataframe_handler.db_path,
+                                  provider=analysis_provider),
+                      parameters={"llm": analysis_provider.name},
+                      enabled=not skip_ai),
+        PipelineStage(name="ai_user_profiles",
+                      kind=StageKind.IO,
+                      inputs=["thread_analyses", "human_messages"],
+                      outputs={"user_profiles": AiUserProfileModel.df_filename()},
+                      run=partial(_ai_user_profiles_stage,
+                                  db_path=dataframe_handler.db_path,
+                                  provider=analysis_provider),
+                      parameters={"llm": analysis_provider.name},
+                      enabled=not skip_ai),
+        PipelineStage(name="embed_messages",
+                      kind=StageKind.IO,
+                      inputs=["human_messages"],
+                      outputs={"message_embeddings": "message_embeddings.npy",
+                               "message_chunk_counts": "message_chunk_counts.npy"},
+                      run=partial(_embed_messages_stage,
+                                  embedding_backend=embedding_backend,
+                                  storage_dtype=embedding_storage_dtype),
+                      parameters=embedding_parameters,
+                      enabled=not skip_embeddings),
+        PipelineStage(name="embed_analyses_and_tags",
+                      kind=StageKind.IO,
+                      inputs=["human_messages", "thread_analyses"],
+                      outputs={"analysis_embeddings": "analysis_embeddings.npy",
+                               "analysis_chunk_counts": "analysis_chunk_counts.npy"},
+                      run=partial(_embed_analyses_and_tags_stage,
+                                  embedding_backend=embedding_backend,
+                                  storage_dtype=embedding_storage_dtype,
+                                  minimum_tag_rank=MINIMUM_TAG_RANK),
+                      parameters={**embedding_parameters, "minimum_tag_rank": MINIMUM_TAG_RANK},
+                      enabled=not skip_embeddings),
+        PipelineStage(name="embed_user_profiles",
+                      kind=StageKind.IO,
+                      inputs=["user_profiles"],
+                      outputs={"user_profile_embeddings": "user_profile_embeddings.npy",
+                               "user_profile_chunk_counts": "user_profile_chunk_counts.npy"},
+                      run=partial(_embed_user_profiles_stage,
+                                  embedding_backend=embedding_backend,
+                                  storage_dtype=embedding_storage_dtype),
+                      parameters=embedding_parameters,
+                      enabled=not skip_embeddings),
+        PipelineStage(name="embedding_projections",
+                      kind=StageKind.CPU,
+                      inputs=["human_messages", "thread_analyses", "user_profiles",
+                              "message_embeddings", "analysis_embeddings", "user_profile_embeddings",
+                              "message_chunk_counts", "analysis_chunk_counts", "user_profile_chunk_counts"],
+                      outputs={"embedding_projections": "embedding_projections.csv"},
+                      # a CPU stage runs in a worker process, so it gets the backend's (picklable) name
+                      run=partial(_projections_stage,
+                                  minimum_tag_rank=MINIMUM_TAG_RANK,
+                                  embedding_method=embedding_backend.name),
+                      parameters={"minimum_tag_rank": MINIMUM_TAG_RANK, "random_seed": RANDOM_SEED,
+                                  "embedding_backend": embedding_backend.name},
+                      enabled=not skip_embeddings),
+        PipelineStage(name="embedding_index",
+                      kind=StageKind.CPU,
+                      inputs=["human_messages", "thread_analyses", "user_profiles",
+                              "message_embeddings", "analysis_embeddings", "user_profile_embeddings",
+                              "message_chunk_counts", "analysis_chunk_counts", "user_profile_chunk_counts"],
+                      outputs={"embedding_index_benchmark": "embedding_index_benchmark.csv"},
+                      # the index itself (see `EmbeddingIndex.save`) - a missing/half-written index is rebuilt
+                      side_output_files=[f"{EMBEDDING_INDEX_FOLDER_NAME}/{EMBEDDING_INDEX_INFO_FILENAME}"],
+                      run=partial(_embedding_index_stage,
+                                  minimum_tag_rank=MINIMUM_TAG_RANK,
+                                  embedding_method=embedding_backend.name,
+                                  index_kind=neighbor_index_kind,
+                                  db_path=dataframe_handler.db_path),
+                      parameters={"minimum_tag_rank": MINIMUM_TAG_RANK,
+                                  "embedding_backend": embedding_backend.name,
+                                  "index_kind": neighbor_index_kind.value if neighbor_index_kind else "auto",
+                                  "exact_index_max_rows": EXACT_INDEX_MAX_ROWS},
+                      enabled=not skip_embeddings),
+    ]
+
+
+async def augment_dataframes(dataframe_handler: DataframeHandler,
+                             skip_ai: bool = False,
+                             skip_embeddings: bool = False,
+                             force_rerun: bool = False,  # re-run every enabled stage, even if it's up to date
+                             engine: AugmentationEngine = AugmentationEngine.PANDAS,  # ARROW uses less memory
+                             long_thread_strategy: LongThreadStrategy = DEFAULT_LONG_THREAD_STRATEGY,
+                             max_concurrent_chunk_calls: int = DEFAULT_MAX_CONCURRENT_CHUNK_CALLS,
+                             analysis_provider: StructuredOutputProvider | None = None,  # OpenAI by default
+                             job_priority: JobPriority = DEFAULT_JOB_PRIORITY,
+                             analysis_budget: AnalysisBudget | None = None,  # token/cost cap of the thread analyses
+                             embedding_backend: EmbeddingBackend | None = None,  # Ollama by default
+                             # float16/int8 make the `*_embeddings.npy` 2x/4x smaller
+                             embedding_storage_dtype: EmbeddingStorageDtype = DEFAULT_EMBEDDING_STORAGE_DTYPE,
+                             # None -> exact up to `EXACT_INDEX_MAX_ROWS` items, approximate above that
+                             neighbor_index_kind: NeighborIndexKind | None = None) -> PipelineRunReport:
+    """
+    Run the augmentation pipeline, skipping the stages that are up to date (see `pipeline_manifest.json` in the
+    db_path). The LLM call report is written to the db_path at the end of the run, whether or not it succeeded.
+    """
+    logger.info("Starting dataframe augmentation")
+    call_metrics_recorder = get_call_metrics_recorder()
+    call_metrics_recorder.reset()
 
-        embedding_projections_df.to_csv(base_path / f'embedding_projections.csv', index=False)
+    pipeline = StagedPipeline(db_path=dataframe_handler.db_path,
+                              stages=build_augmentation_stages(dataframe_handler=dataframe_handler,
+                                                               skip_ai=skip_ai,
+                                                               skip_embeddings=skip_embeddings,
+                                                               engine=engine,
+                                                               long_thread_strategy=long_thread_strategy,
+                                                               max_concurrent_chunk_calls=max_concurrent_chunk_calls,
+                                                               analysis_provider=analysis_provider,
+                                                               job_priority=job_priority,
+                                                               analysis_budget=analysis_budget,
+                                                               embedding_backend=embedding_backend,
+                                                               embedding_storage_dtype=embedding_storage_dtype,
+                                                               neighbor_index_kind=neighbor_index_kind))
+    try:
+        report = await pipeline.run(artifacts={"messages": dataframe_handler.messages_df,
+                                               "couplets": dataframe_handler.couplets_df,
+                                               "threads": dataframe_handler.threads_df,
+                                               "users": dataframe_handler.users_df},
+                                    force_rerun=force_rerun)
+    finally:
+        # a failed run is the one worth diagnosing - keep the calls made until it failed
+        call_metrics_recorder.write_report(db_path=dataframe_handler.db_path)
 
     logger.info("Dataframe augmentation completed")
+    return report
 
 if __name__ == "__main__":
     import asyncio
@@ -105,4 +528,4 @@ if __name__ == "__main__":
     asyncio.run(augment_dataframes(dataframe_handler=df_handler,
                                    skip_ai=True,
                                    skip_embeddings=False))
-    print("Augmentation Done!")
\ No newline at end of file
+    print("Augmentation Done!")
@@ -0,0 +1,313 @@
+import asyncio
+import enum
+import hashlib
+import json
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel
+
+from skellybot_analysis.ai.clients.call_metrics import CURRENT_STAGE_NAME
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_MANIFEST_FILENAME = "pipeline_manifest.json"
+
+ArtifactName = str
+Fingerprint = str
+Artifact = pd.DataFrame | np.ndarray  # `.csv` outputs are DataFrames, `.npy` outputs are numpy arrays
+
+
+def fingerprint_dataframe(df: pd.DataFrame) -> Fingerprint:
+    """Content hash of a DataFrame (column names + row values, index ignored)"""
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([str(column) for column in df.columns]).encode())
+    try:
+        hasher.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    except TypeError:
+        # unhashable cell values (lists, dicts, etc) - fall back to the serialized form
+        hasher.update(df.to_csv(index=False).encode())
+    return hasher.hexdigest()
+
+
+def fingerprint_array(array: np.ndarray) -> Fingerprint:
+    """Content hash of a numpy array (dtype + shape + values)"""
+    hasher = hashlib.sha256()
+    hasher.update(f"{array.dtype}{array.shape}".encode())
+    hasher.update(np.ascontiguousarray(array).tobytes())
+    return hasher.hexdigest()
+
+
+def fingerprint_artifact(artifact: Artifact) -> Fingerprint:
+    if isinstance(artifact, np.ndarray):
+        return fingerprint_array(artifact)
+    return fingerprint_dataframe(artifact)
+
+
+def fingerprint_values(*values: Any) -> Fingerprint:
+    """Hash of any JSON-serializable values (parameters, upstream fingerprints, etc)"""
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def save_artifact(artifact: Artifact, path: Path) -> None:
+    if path.suffix == ".npy":
+        np.save(path, artifact)
+    else:
+        artifact.to_csv(path, index=False)
+
+
+def load_artifact(path: Path) -> Artifact:
+    if path.suffix == ".npy":
+        return np.load(path)
+    return pd.read_csv(path)
+
+
+def empty_artifact(path: Path) -> Artifact:
+    if path.suffix == ".npy":
+        return np.empty((0, 0))
+    return pd.DataFrame()
+
+
+class IncompleteStageError(Exception):
+    """
+    Raised by a stage that produced (partial) `outputs` but did not finish all of its work, e.g. some LLM calls failed.
+    The outputs are saved and used downstream, but the stage is not recorded as complete, so it runs again next time.
+    """
+
+    def __init__(self, reason: str, outputs: dict[ArtifactName, Artifact]):
+        super().__init__(reason)
+        self.outputs = outputs
+
+
+class StageKind(enum.Enum):
+    IO = "io"  # `run` is a coroutine function, awaited on the event loop
+    CPU = "cpu"  # `run` is a plain (picklable, module level) function, executed in the process pool
+
+
+class PipelineStage(BaseModel):
+    """
+    One step of the augmentation pipeline.
+
+    `run` is called with the declared `inputs` as keyword arguments and must return a dict with an artifact for
+    every declared output. Bump `version` when the stage's code changes in a way that should invalidate old results.
+    `side_output_files` are files the stage writes itself (not artifacts) - the stage is re-run if any is missing.
+    """
+    name: str
+    inputs: list[ArtifactName]
+    outputs: dict[ArtifactName, str]  # artifact name -> filename (relative to the db_path)
+    run: Callable[..., Awaitable[dict[ArtifactName, Artifact]]] | Callable[..., dict[ArtifactName, Artifact]]
+    kind: StageKind = StageKind.IO
+    parameters: dict[str, Any] = {}
+    version: int = 1
+    enabled: bool = True  # disabled stages re-use whatever outputs are already on disk
+    side_output_files: list[str] = []  # filenames relative to the db_path
+
+    def fingerprint(self, input_fingerprints: dict[ArtifactName, Fingerprint]) -> Fingerprint:
+        return fingerprint_values(self.name,
+                                  self.version,
+                                  self.parameters,
+                                  sorted(input_fingerprints.items()))
+
+
+class StageRecord(BaseModel):
+    fingerprint: Fingerprint
+    output_fingerprints: dict[ArtifactName, Fingerprint]
+    completed_at: datetime
+
+
+class PipelineManifest(BaseModel):
+    """Record of the fingerprints of every stage that completed in a given db_path"""
+    stages: dict[str, StageRecord] = {}
+
+    @classmethod
+    def load(cls, db_path: str) -> "PipelineManifest":
+        manifest_path = Path(db_path) / PIPELINE_MANIFEST_FILENAME
+        if not manifest_path.exists():
+            return cls()
+        try:
+            return cls.model_validate_json(manifest_path.read_text(encoding="utf-8"))
+        except ValueError as e:
+            logger.warning(f"Could not read pipeline manifest {manifest_path} ({e}) - all stages will rerun")
+            return cls()
+
+    def save(self, db_path: str) -> None:
+        manifest_path = Path(db_path) / PIPELINE_MANIFEST_FILENAME
+        manifest_path.write_text(self.model_dump_json(indent=2), encoding="utf-8")
+
+
+class StageTiming(BaseModel):
+    stage_name: str
+    kind: StageKind
+    status: str  # "ran", "incomplete", "skipped" or "disabled"
+    started_at_seconds: float  # relative to the start of the pipeline run
+    duration_seconds: float
+
+
+class PipelineRunReport(BaseModel):
+    fingerprints: dict[ArtifactName, Fingerprint]
+    stage_timings: list[StageTiming]
+    wall_clock_seconds: float
+
+    @property
+    def serial_seconds(self) -> float:
+        """How long the run would have taken with every stage run back to back"""
+        return sum(timing.duration_seconds for timing in self.stage_timings)
+
+    @property
+    def as_formatted_text(self) -> str:
+        lines = [f"{'stage':<30} {'kind':<4} {'status':<10} {'start(s)':>9} {'duration(s)':>12}"]
+        for timing in sorted(self.stage_timings, key=lambda t: t.started_at_seconds):
+            lines.append(f"{timing.stage_name:<30} {timing.kind.value:<4} {timing.status:<10} "
+                         f"{timing.started_at_seconds:>9.2f} {timing.duration_seconds:>12.2f}")
+        saved = self.serial_seconds - self.wall_clock_seconds
+        lines.append(f"Wall clock: {self.wall_clock_seconds:.2f}s, serial: {self.serial_seconds:.2f}s "
+                     f"- overlapping stages saved {saved:.2f}s "
+                     f"({100 * saved / self.serial_seconds if self.serial_seconds else 0:.1f}%)")
+        return "\n".join(lines)
+
+
+def _run_cpu_stage(run: Callable[..., dict[ArtifactName, Artifact]],
+                   inputs: dict[ArtifactName, Artifact]) -> dict[ArtifactName, Artifact]:
+    return run(**inputs)
+
+
+class StagedPipeline(BaseModel):
+    """
+    Runs a graph of `PipelineStage`s, skipping every stage whose fingerprint (hash of its parameters and the content
+    of its inputs) matches the one recorded in the manifest.
+
+    Every stage starts as soon as the stages producing its inputs are done, so independent stages overlap:
+    IO stages run concurrently on the event loop, CPU stages run in a process pool.
+    Outputs of skipped stages are loaded from disk only if a downstream stage actually needs them.
+    """
+    db_path: str
+    stages: list[PipelineStage]
+    max_cpu_workers: int | None = None  # None -> one worker per core
+
+    def _producers(self, available: set[ArtifactName]) -> dict[ArtifactName, str]:
+        """Map each stage output to the stage that produces it, and check that `stages` is in dependency order"""
+        available = set(available)
+        producers: dict[ArtifactName, str] = {}
+        for stage in self.stages:
+            missing = [name for name in stage.inputs if name not in available]
+            if missing:
+                raise ValueError(f"Stage '{stage.name}' requires {missing}, which are not produced by an earlier stage")
+            available.update(stage.outputs.keys())
+            producers.update({name: stage.name for name in stage.outputs.keys()})
+        return producers
+
+    async def run(self,
+                  artifacts: dict[ArtifactName, Artifact],
+                  force_rerun: bool = False) -> PipelineRunReport:
+        """Run (or skip) every stage, returns the artifact fingerprints and per-stage timings"""
+        producers = self._producers(available=set(artifacts.keys()))
+
+        base_path = Path(self.db_path)
+        manifest = PipelineManifest.load(self.db_path)
+        loaded: dict[ArtifactName, Artifact] = dict(artifacts)
+        on_disk: dict[ArtifactName, Path] = {}
+        fingerprints: dict[ArtifactName, Fingerprint] = {name: fingerprint_artifact(artifact)
+                                                         for name, artifact in artifacts.items()}
+        timings: list[StageTiming] = []
+        run_start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+
+        def resolve(name: ArtifactName) -> Artifact:
+            if name not in loaded:
+                logger.debug(f"Loading cached artifact '{name}' from {on_disk[name].name}")
+                loaded[name] = load_artifact(on_disk[name])
+            return loaded[name]
+
+        async def run_stage(stage: PipelineStage, upstream: list[asyncio.Task], executor: ProcessPoolExecutor) -> None:
+            await asyncio.gather(*upstream)
+            CURRENT_STAGE_NAME.set(stage.name)  # each stage runs in its own task, so this only tags this stage's calls
+            stage_start = time.perf_counter()
+            output_paths = {name: base_path / filename for name, filename in stage.outputs.items()}
+
+            def record_timing(status: str) -> None:
+                timings.append(StageTiming(stage_name=stage.name,
+                                           kind=stage.kind,
+                                           status=status,
+                                           started_at_seconds=stage_start - run_start,
+                                           duration_seconds=time.perf_counter() - stage_start))
+
+            if not stage.enabled:
+                logger.info(f"Stage '{stage.name}' is disabled - re-using existing outputs (if any)")
+                for name, path in output_paths.items():
+                    if path.exists():
+                        loaded[name] = load_artifact(path)
+                    else:
+                        logger.warning(f"Disabled stage '{stage.name}' has no existing '{path.name}' - using empty output")
+                        loaded[name] = empty_artifact(path)
+                    fingerprints[name] = fingerprint_artifact(loaded[name])
+                record_timing("disabled")
+                return
+
+            stage_fingerprint = stage.fingerprint({name: fingerprints[name] for name in stage.inputs})
+            record = manifest.stages.get(stage.name)
+            if (not force_rerun
+                    and record is not None
+                    and record.fingerprint == stage_fingerprint
+                    and set(record.output_fingerprints.keys()) == set(output_paths.keys())
+                    and all(path.exists() for path in output_paths.values())
+                    and all((base_path / filename).exists() for filename in stage.side_output_files)):
+                logger.info(f"Stage '{stage.name}' is up to date - skipping")
+                for name, path in output_paths.items():
+                    loaded.pop(name, None)
+                    on_disk[name] = path
+                    fingerprints[name] = record.output_fingerprints[name]
+                record_timing("skipped")
+                return
+
+            logger.info(f"Running {stage.kind.value} stage '{stage.name}'")
+            inputs = {name: resolve(name) for name in stage.inputs}
+            complete = True
+            try:
+                if stage.kind == StageKind.CPU:
+                    outputs = await loop.run_in_executor(executor, _run_cpu_stage, stage.run, inputs)
+                else:
+                    outputs = await stage.run(**inputs)
+            except IncompleteStageError as e:
+                logger.warning(f"Stage '{stage.name}' did not complete ({e}) - saving its partial outputs, "
+                               f"it will run again next time")
+                outputs = e.outputs
+                complete = False
+            if set(outputs.keys()) != set(output_paths.keys()):
+                raise ValueError(f"Stage '{stage.name}' returned {sorted(outputs.keys())}, "
+                                 f"expected {sorted(output_paths.keys())}")
+
+            for name, artifact in outputs.items():
+                save_artifact(artifact, output_paths[name])
+                loaded[name] = artifact
+                fingerprints[name] = fingerprint_artifact(artifact)
+
+            if complete:
+                manifest.stages[stage.name] = StageRecord(
+                    fingerprint=stage_fingerprint,
+                    output_fingerprints={name: fingerprints[name] for name in outputs.keys()},
+                    completed_at=datetime.now(),
+                )
+            else:
+                manifest.stages.pop(stage.name, None)
+            manifest.save(self.db_path)
+            record_timing("ran" if complete else "incomplete")
+            logger.info(f"Stage '{stage.name}' completed in {time.perf_counter() - stage_start:.2f}s")
+
+        with ProcessPoolExecutor(max_workers=self.max_cpu_workers) as executor:
+            tasks: dict[str, asyncio.Task] = {}
+            for stage in self.stages:
+                upstream = [tasks[producers[name]] for name in stage.inputs if name in producers]
+                tasks[stage.name] = asyncio.create_task(run_stage(stage=stage, upstream=upstream, executor=executor))
+            await asyncio.gather(*tasks.values())
+
+        report = PipelineRunReport(fingerprints=fingerprints,
+                                   stage_timings=timings,
+                                   wall_clock_seconds=time.perf_counter() - run_start)
+        logger.info(f"Pipeline run complete:\n{report.as_formatted_text}")
+        return report
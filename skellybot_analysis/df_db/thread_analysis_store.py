@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+from pydantic import BaseModel, ValidationError
+
+from skellybot_analysis.data_models.analysis_models import AiThreadAnalysisModel
+from skellybot_analysis.data_models.server_models import ThreadId
+
+logger = logging.getLogger(__name__)
+
+THREAD_ANALYSES_LOG_FILENAME = "ai_thread_analyses.jsonl"
+THREAD_ANALYSIS_FAILURES_LOG_FILENAME = "ai_thread_analysis_failures.jsonl"
+
+
+class ThreadAnalysisFailureModel(BaseModel):
+    thread_id: ThreadId
+    base_text_hash: str
+    error_type: str
+    error_message: str
+    failed_at: datetime
+
+
+class ThreadAnalysisStore:
+    """
+    Append-only JSONL logs (in the db_path) of thread analyses and of failed analysis attempts, written as each
+    analysis finishes so an interrupted or partially failed run loses nothing that already completed.
+    When a thread appears more than once, the last line wins.
+    """
+
+    def __init__(self, db_path: str):
+        self.analyses_path = Path(db_path) / THREAD_ANALYSES_LOG_FILENAME
+        self.failures_path = Path(db_path) / THREAD_ANALYSIS_FAILURES_LOG_FILENAME
+        self._lock = threading.Lock()
+
+    def _append(self, path: Path, line: str) -> None:
+        with self._lock, open(path, "a", encoding="utf-8") as file:
+            file.write(line + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def append_analysis(self, analysis: AiThreadAnalysisModel) -> None:
+        self._append(self.analyses_path, analysis.model_dump_json())
+
+    def append_failure(self, thread_id: ThreadId, thread_text: str, error: BaseException) -> None:
+        failure = ThreadAnalysisFailureModel(thread_id=thread_id,
+                                             base_text_hash=AiThreadAnalysisModel.hash_text(thread_text),
+                                             error_type=type(error).__name__,
+                                             error_message=str(error),
+                                             failed_at=datetime.now())
+        self._append(self.failures_path, failure.model_dump_json())
+
+    @staticmethod
+    def _read_lines(path: Path, model_cls: type[BaseModel]) -> Iterator[BaseModel]:
+        if not path.exists():
+            return
+        with open(path, encoding="utf-8") as file:
+            for line_number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield model_cls.model_validate_json(line)
+                except ValidationError as e:
+                    # most likely a line cut off by a crash mid-write
+                    logger.warning(f"Skipping unreadable line {line_number} of {path.name}: {e.errors()[0]['msg']}")
+
+    def load_analyses(self) -> dict[ThreadId, AiThreadAnalysisModel]:
+        return {analysis.thread_id: analysis
+                for analysis in self._read_lines(self.analyses_path, AiThreadAnalysisModel)}
+
+    def load_failures(self) -> dict[ThreadId, ThreadAnalysisFailureModel]:
+        """The latest failure of every thread that has not been analyzed (from the same text) since"""
+        analyses = self.load_analyses()
+        failures = {failure.thread_id: failure
+                    for failure in self._read_lines(self.failures_path, ThreadAnalysisFailureModel)}
+        return {thread_id: failure for thread_id, failure in failures.items()
+                if thread_id not in analyses or analyses[thread_id].base_text_hash != failure.base_text_hash}
+
+    def compact(self) -> None:
+        """Rewrite both logs with one (the latest) line per thread, dropping resolved failures"""
+        analyses = self.load_analyses()
+        failures = self.load_failures()
+        with self._lock:
+            for path, models in ((self.analyses_path, analyses.values()), (self.failures_path, failures.values())):
+                if not path.exists():
+                    continue
+                temporary_path = path.with_suffix(path.suffix + ".tmp")
+                with open(temporary_path, "w", encoding="utf-8") as file:
+                    for model in models:
+                        file.write(model.model_dump_json() + "\n")
+                os.replace(temporary_path, path)
@@ -1,32 +1,16 @@
 from typing import List
 
-import tiktoken
+from skellybot_analysis.ai.tokenizer_service import get_tokenizer_service
 
 
 def chunk_string_by_max_tokens(input_string: str,
                                llm_model: str,
                                max_tokens: int,
                                overlap_ratio: float = 0.1) -> List[str]:
-    # Initialize the tokenizer
-    tokenizer = tiktoken.encoding_for_model(llm_model)
-    # Tokenize the input string
-    tokens = tokenizer.encode(input_string)
-    # Chunk the original string by the max token length, with an overlap ratio of 0.1 of the max token length
-    chunked_strings = []
-    if overlap_ratio < 0 or overlap_ratio >= 1:
-        raise ValueError("Overlap ratio must be in the range [0, 1).")
-
-    overlap_tokens = int(max_tokens * overlap_ratio)
-    if overlap_tokens == 0 and overlap_ratio != 0:
-        overlap_tokens = 1
-
-    start = 0
-    while start < len(tokens):
-        end = start + max_tokens
-        chunk = tokens[start:end]
-        chunked_strings.append(tokenizer.decode(chunk))
-        start += max_tokens - overlap_tokens
-    return chunked_strings
+    # Chunk the string by the max token length, consecutive chunks overlap by `overlap_ratio` of the max token length
+    return get_tokenizer_service(llm_model).chunk(text=input_string,
+                                                  max_tokens=max_tokens,
+                                                  overlap_ratio=overlap_ratio)
 
 
 if __name__ == "__main__":
@@ -35,4 +19,4 @@ if __name__ == "__main__":
         llm_model="gpt-4o-mini",
         max_tokens=4,
         overlap_ratio=0.1
-    ))
\ No newline at end of file
+    ))
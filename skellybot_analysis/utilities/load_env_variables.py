@@ -13,6 +13,7 @@ TARGET_SERVER_ID = int(os.getenv('TARGET_SERVER_ID'))
 OUTPUT_DIRECTORY = os.getenv('OUTPUT_DIRECTORY')
 STUDENT_IDENTIFIERS_CSV_PATH = os.getenv('STUDENT_IDENTIFIERS_CSV_PATH')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')  # optional, only needed to route LLM calls to Anthropic
 
 OUTPUT_DIRECTORY = OUTPUT_DIRECTORY.replace("~", str(Path.home()))
 
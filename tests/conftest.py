@@ -0,0 +1,13 @@
+import os
+import tempfile
+
+# `load_env_variables` requires these at import time - placeholders, so the tests never touch a real server or API
+for _name, _value in {"DISCORD_DEV_BOT_TOKEN": "test-token",
+                      "DISCORD_DEV_BOT_ID": "1",
+                      "DISCORD_BOT_ID": "2",
+                      "PROF_USER_ID": "3",
+                      "TARGET_SERVER_ID": "4",
+                      "OUTPUT_DIRECTORY": tempfile.mkdtemp(prefix="skellybot_analysis_tests_"),
+                      "STUDENT_IDENTIFIERS_CSV_PATH": "student_identifiers.csv",
+                      "OPENAI_API_KEY": "test-key"}.items():
+    os.environ[_name] = _value
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from skellybot_analysis.df_db.df_augmentation.arrow_augmentation import AugmentationEngine
+from skellybot_analysis.df_db.df_augmentation.dataframe_augmentation import _augment_messages_stage, \
+    _augment_threads_stage, _augment_users_stage, _cumulative_counts_stage
+from skellybot_analysis.df_db.conversation_couplets import NO_HUMAN_MESSAGE_ID
+from skellybot_analysis.utilities.load_env_variables import PROF_USER_ID
+
+BOT_USER_ID = 2
+STUDENT_IDS = [10, 11, 12, 13]
+WORDS = ["fox", "mammal", "cerebellum", "basal", "ganglia", "cortex", "red", "the", "of", "and"]
+
+
+@pytest.fixture(scope="module")
+def server_data() -> dict[str, pd.DataFrame]:
+    """Messages from students, the professor and the bot, with timestamp ties, empty messages and unanswered ones"""
+    rng = np.random.default_rng(42)
+    message_count = 400
+    author_ids = rng.choice(STUDENT_IDS + [PROF_USER_ID, BOT_USER_ID], size=message_count)
+    contents = [" ".join(rng.choice(WORDS, size=rng.integers(0, 30))) for _ in range(message_count)]
+    timestamps = pd.Timestamp("2025-01-01") + pd.to_timedelta(rng.integers(0, message_count // 4, message_count),
+                                                              unit="min")
+    messages = pd.DataFrame({"message_id": np.arange(1000, 1000 + message_count),
+                             "author_id": author_ids,
+                             "thread_id": rng.integers(500, 520, size=message_count),
+                             "timestamp": timestamps.astype(str),
+                             "content": contents,
+                             "full_content": contents,
+                             "bot_message": author_ids == BOT_USER_ID})
+
+    answered = messages[~messages["bot_message"]].sample(frac=0.7, random_state=42)
+    texts = [f"{content}\n\n{' '.join(rng.choice(WORDS, size=rng.integers(1, 20)))}"
+             for content in answered["full_content"]]
+    couplets = pd.DataFrame({"human_message_id": [*answered["message_id"], NO_HUMAN_MESSAGE_ID],
+                             "text": [*texts, "orphaned bot chain"],
+                             "bot_start": [*(len(content) + 2 for content in answered["full_content"]), 0],
+                             "bot_end": [*(len(text) for text in texts), len("orphaned bot chain")]})
+    threads = pd.DataFrame({"thread_id": np.arange(500, 522),  # two threads without messages
+                            "thread_name": [f"thread {index}" for index in range(22)]})
+    users = pd.DataFrame({"user_id": [*STUDENT_IDS, PROF_USER_ID, BOT_USER_ID, 99],  # 99 never posted
+                          "is_bot": [False] * 5 + [True, False]})
+    return {"messages": messages, "couplets": couplets, "threads": threads, "users": users}
+
+
+def _augment(server_data: dict[str, pd.DataFrame], engine: AugmentationEngine) -> dict[str, pd.DataFrame]:
+    outputs = _augment_messages_stage(messages=server_data["messages"], couplets=server_data["couplets"], engine=engine)
+    human_messages = outputs["human_messages"]
+    outputs.update(_augment_threads_stage(threads=server_data["threads"], human_messages=human_messages, engine=engine))
+    outputs.update(_augment_users_stage(users=server_data["users"], human_messages=human_messages, engine=engine))
+    outputs.update(_cumulative_counts_stage(human_messages=human_messages, engine=engine))
+    return outputs
+
+
+@pytest.mark.parametrize("output_name", ["augmented_messages", "human_messages", "augmented_threads",
+                                         "augmented_users", "cumulative_counts"])
+def test_arrow_engine_matches_pandas(server_data, output_name):
+    pandas_output = _augment(server_data, AugmentationEngine.PANDAS)[output_name]
+    arrow_output = _augment(server_data, AugmentationEngine.ARROW)[output_name]
+    pd.testing.assert_frame_equal(arrow_output.reset_index(drop=True), pandas_output.reset_index(drop=True))
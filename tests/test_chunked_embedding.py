@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from skellybot_analysis.ai.embeddings_stuff import chunked_embedding
+from skellybot_analysis.ai.embeddings_stuff.chunked_embedding import ChunkedTexts, PoolingMethod
+
+
+@pytest.fixture
+def chunked_texts(monkeypatch) -> ChunkedTexts:
+    # chunks of at most 3 words (1 token per word), so the test doesn't need a tokenizer
+    def chunk_by_words(text: str, embedding_model: str) -> tuple[list[str], list[int]]:
+        words = text.split()
+        chunks = [words[start:start + 3] for start in range(0, len(words), 3)]
+        return [" ".join(chunk) for chunk in chunks], [len(chunk) for chunk in chunks]
+
+    monkeypatch.setattr(chunked_embedding, "chunk_text_for_embedding", chunk_by_words)
+    return ChunkedTexts(["a b", "a b c d", "a b c d e f g"], embedding_model="test")
+
+
+def test_chunks_are_flattened_in_text_order(chunked_texts):
+    assert chunked_texts.chunk_counts == [1, 2, 3]
+    assert chunked_texts.chunks == ["a b", "a b c", "d", "a b c", "d e f", "g"]
+    assert chunked_texts.chunk_token_counts == [2, 3, 1, 3, 3, 1]
+
+
+def test_mean_pooling(chunked_texts):
+    chunk_embeddings = np.arange(12, dtype=np.float32).reshape(6, 2)
+    pooled = chunked_texts.pool(chunk_embeddings, pooling=PoolingMethod.MEAN)
+    np.testing.assert_allclose(pooled, [chunk_embeddings[0],
+                                        chunk_embeddings[1:3].mean(axis=0),
+                                        chunk_embeddings[3:6].mean(axis=0)])
+
+
+def test_length_weighted_pooling(chunked_texts):
+    chunk_embeddings = np.arange(12, dtype=np.float32).reshape(6, 2)
+    pooled = chunked_texts.pool(chunk_embeddings, pooling=PoolingMethod.LENGTH_WEIGHTED)
+    np.testing.assert_allclose(pooled, [chunk_embeddings[0],
+                                        (3 * chunk_embeddings[1] + chunk_embeddings[2]) / 4,
+                                        (3 * chunk_embeddings[3] + 3 * chunk_embeddings[4] + chunk_embeddings[5]) / 7])
+
+
+def test_pool_rejects_the_wrong_number_of_chunk_embeddings(chunked_texts):
+    with pytest.raises(ValueError):
+        chunked_texts.pool(np.zeros((5, 2), dtype=np.float32))
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from skellybot_analysis.ai.embeddings_stuff.embedding_index import EmbeddingIndex, NeighborIndexKind, \
+    cosine_top_k, normalize_rows
+
+CONTENT_TYPES = ["message", "thread_analysis", "tag"]
+
+
+@pytest.fixture(scope="module")
+def vectors() -> np.ndarray:
+    rng = np.random.default_rng(42)
+    centers = rng.normal(size=(20, 64))
+    return (centers[rng.integers(0, 20, size=3000)] + 0.3 * rng.normal(size=(3000, 64))).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def items(vectors) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({"embedding_index": np.arange(len(vectors)),
+                         "content_type": rng.choice(CONTENT_TYPES, size=len(vectors)),
+                         "channel_id": rng.choice([1, 2, None], size=len(vectors)),
+                         "embedding_method": "test"})
+
+
+def _brute_force_top_k(queries: np.ndarray, corpus: np.ndarray, k: int) -> np.ndarray:
+    similarities = normalize_rows(queries) @ normalize_rows(corpus).T
+    return np.argsort(-similarities, axis=1, kind="stable")[:, :k]
+
+
+def test_cosine_top_k_matches_brute_force(vectors):
+    queries = vectors[:50]
+    rows, similarities = cosine_top_k(queries, vectors, k=10)
+    np.testing.assert_array_equal(rows, _brute_force_top_k(queries, vectors, k=10))
+    assert np.all(np.diff(similarities, axis=1) <= 0)  # most similar first
+
+
+def test_cosine_top_k_excludes_the_query_rows(vectors):
+    rows, _ = cosine_top_k(vectors[:50], vectors, k=5, exclude_indices=np.arange(50))
+    assert not np.any(rows == np.arange(50)[:, None])
+
+
+def test_exact_search_with_filters(vectors, items):
+    index = EmbeddingIndex(vectors=vectors, items=items, kind=NeighborIndexKind.EXACT)
+    rows, _ = index.search(vectors[:20], k=10, content_types=["tag"], channel_ids=[1])
+    matching = np.flatnonzero((items["content_type"] == "tag").to_numpy() & (items["channel_id"] == 1).to_numpy())
+    expected = matching[_brute_force_top_k(vectors[:20], vectors[matching], k=10)]
+    np.testing.assert_array_equal(rows, expected)
+
+
+def test_approximate_search_recall_against_exact(vectors, items):
+    pytest.importorskip("pynndescent")
+    exact = EmbeddingIndex(vectors=vectors, items=items, kind=NeighborIndexKind.EXACT)
+    approximate = EmbeddingIndex(vectors=vectors, items=items, kind=NeighborIndexKind.APPROXIMATE)
+    queries = vectors[::30]
+    for filters in [{}, {"content_types": ["thread_analysis"]}]:
+        exact_rows, _ = exact.search(queries, k=10, **filters)
+        approximate_rows, _ = approximate.search(queries, k=10, **filters)
+        recall = np.mean([np.intersect1d(exact_row, approximate_row).size / 10
+                          for exact_row, approximate_row in zip(exact_rows, approximate_rows)])
+        assert recall >= 0.9
+        if filters:
+            assert set(items["content_type"].to_numpy()[approximate_rows.ravel()]) == {"thread_analysis"}
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from skellybot_analysis.ai.embeddings_stuff.embedding_quantization import EmbeddingStorageDtype, \
+    dequantize_embeddings, embedding_storage_report, quantize_embeddings, storage_dtype_of
+
+
+@pytest.fixture(scope="module")
+def embeddings() -> np.ndarray:
+    """Clustered vectors, like the embeddings of messages about a handful of topics"""
+    rng = np.random.default_rng(42)
+    centers = rng.normal(size=(20, 128))
+    return (centers[rng.integers(0, 20, size=2000)] + 0.3 * rng.normal(size=(2000, 128))).astype(np.float32)
+
+
+@pytest.mark.parametrize("storage_dtype, max_error", [(EmbeddingStorageDtype.FLOAT32, 0.0),
+                                                      (EmbeddingStorageDtype.FLOAT16, 1e-3),
+                                                      (EmbeddingStorageDtype.INT8, 2e-2)])
+def test_quantization_round_trip(embeddings, storage_dtype, max_error):
+    stored = quantize_embeddings(embeddings, storage_dtype)
+    assert storage_dtype_of(stored) == storage_dtype
+    restored = dequantize_embeddings(stored)
+    assert restored.dtype == np.float32 and restored.shape == embeddings.shape
+    assert np.abs(restored - embeddings).mean() <= max_error
+
+
+@pytest.mark.parametrize("storage_dtype, min_recall, size_ratio", [(EmbeddingStorageDtype.FLOAT32, 1.0, 1.0),
+                                                                   (EmbeddingStorageDtype.FLOAT16, 0.99, 0.5),
+                                                                   (EmbeddingStorageDtype.INT8, 0.95, 0.26)])
+def test_storage_report_recall_and_size(embeddings, storage_dtype, min_recall, size_ratio):
+    report = embedding_storage_report(embeddings, storage_dtype, k=10, sample_size=300)
+    assert report.k == 10
+    assert report.recall_at_k >= min_recall
+    assert report.size_ratio == pytest.approx(size_ratio, abs=0.01)
+
@@ -0,0 +1,54 @@
+import asyncio
+
+import anthropic
+import httpx
+import pytest
+
+from skellybot_analysis.ai.clients.llm_router import LlmRouter
+from skellybot_analysis.ai.clients.retry_policy import CircuitBreaker, ErrorClass, RetryEngine, RetryPolicy, \
+    classify_error
+from skellybot_analysis.ai.clients.structured_output import StructuredOutputProvider
+from skellybot_analysis.data_models.prompt_models import TextAnalysisPromptModel
+
+REQUEST = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+NETWORK_ERRORS = [anthropic.APIConnectionError(request=REQUEST), anthropic.APITimeoutError(request=REQUEST)]
+
+
+class OfflineProvider(StructuredOutputProvider):
+    """Raises `error` on every attempt (or succeeds if it's `None`), retried by a zero-delay retry engine"""
+
+    def __init__(self, provider_name: str, error: Exception | None):
+        super().__init__(llm_model="offline", max_input_tokens=1000)
+        self.provider_name = provider_name
+        self.error = error
+        self.attempts = 0
+        self.retry_engine = RetryEngine(name=provider_name,
+                                        policies={ErrorClass.NETWORK: RetryPolicy(max_attempts=3,
+                                                                                   base_delay_seconds=0.0)},
+                                        circuit_breaker=CircuitBreaker(name=provider_name))
+
+    async def make_structured_request(self, system_prompt, prompt_model, user_input=None, estimated_tokens=None):
+        async def attempt():
+            self.attempts += 1
+            if self.error is not None:
+                raise self.error
+            return prompt_model.model_construct()
+
+        return await self.retry_engine.run(attempt, description="offline request")
+
+
+@pytest.mark.parametrize("error", NETWORK_ERRORS, ids=lambda error: type(error).__name__)
+def test_anthropic_connection_errors_are_network_errors(error):
+    assert classify_error(error) == ErrorClass.NETWORK
+
+
+@pytest.mark.parametrize("error", NETWORK_ERRORS, ids=lambda error: type(error).__name__)
+def test_network_errors_are_retried_then_failed_over(error):
+    failing = OfflineProvider(provider_name="anthropic", error=error)
+    working = OfflineProvider(provider_name="fallback", error=None)
+    router = LlmRouter(providers=[failing, working], weights=[100.0, 1.0])  # the failing provider is tried first
+
+    asyncio.run(router.make_structured_request(system_prompt="offline check", prompt_model=TextAnalysisPromptModel))
+
+    assert failing.attempts == 3
+    assert working.attempts == 1
@@ -0,0 +1,32 @@
+import asyncio
+from pathlib import Path
+
+import pandas as pd
+
+from skellybot_analysis.df_db.df_augmentation.pipeline_stages import PipelineStage, StagedPipeline
+
+
+def test_stage_reruns_when_a_side_output_file_is_missing(tmp_path):
+    runs = []
+
+    async def write_index(numbers: pd.DataFrame) -> dict[str, pd.DataFrame]:
+        runs.append(len(numbers))
+        (tmp_path / "index").mkdir(exist_ok=True)
+        (tmp_path / "index" / "info.json").write_text("{}")
+        return {"summary": numbers.describe()}
+
+    pipeline = StagedPipeline(db_path=str(tmp_path),
+                              stages=[PipelineStage(name="index",
+                                                    inputs=["numbers"],
+                                                    outputs={"summary": "summary.csv"},
+                                                    run=write_index,
+                                                    side_output_files=["index/info.json"])])
+    artifacts = {"numbers": pd.DataFrame({"value": [1, 2, 3]})}
+
+    asyncio.run(pipeline.run(artifacts=artifacts))
+    asyncio.run(pipeline.run(artifacts=artifacts))
+    assert len(runs) == 1  # up to date
+
+    Path(tmp_path / "index" / "info.json").unlink()
+    asyncio.run(pipeline.run(artifacts=artifacts))
+    assert len(runs) == 2
@@ -0,0 +1,19 @@
+import asyncio
+
+from skellybot_analysis.ai.clients.rate_limiter import AdaptiveRateLimiter
+
+
+def test_limiter_works_across_event_loops():
+    limiter = AdaptiveRateLimiter(name="test", requests_per_minute=10_000, tokens_per_minute=1_000_000, max_in_flight=1)
+
+    async def run_queued_requests():
+        async def request():
+            async with limiter.limit(10):
+                await asyncio.sleep(0.01)  # keeps the only slot busy, so the other requests wait on the condition
+
+        await asyncio.gather(*[request() for _ in range(3)])
+
+    asyncio.run(run_queued_requests())
+    asyncio.run(run_queued_requests())  # a fresh loop, like a second `asyncio.run` in a notebook
+    assert limiter.total_requests == 6
+    assert limiter.in_flight == 0
@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from pydantic import BaseModel, ValidationError
+
+from skellybot_analysis.ai.clients.llm_response_cache import LlmResponseCache
+from skellybot_analysis.ai.clients.structured_output import OllamaStructuredOutputProvider
+
+
+class GreetingPromptModel(BaseModel):
+    greeting: str
+
+
+class FakeOllamaClient:
+    """Answers every chat request with the next of `responses`"""
+
+    def __init__(self, responses: list[str]):
+        self.responses = list(responses)
+        self.requests = 0
+
+    async def chat(self, **kwargs):
+        self.requests += 1
+        return SimpleNamespace(message=SimpleNamespace(content=self.responses.pop(0)),
+                               done_reason="stop", prompt_eval_count=10, eval_count=5)
+
+
+def _provider(tmp_path, responses: list[str]) -> OllamaStructuredOutputProvider:
+    provider = OllamaStructuredOutputProvider(response_cache=LlmResponseCache(db_path=str(tmp_path / "cache.sqlite")))
+    provider.client = FakeOllamaClient(responses)
+    return provider
+
+
+def _request(provider: OllamaStructuredOutputProvider) -> GreetingPromptModel:
+    return asyncio.run(provider.make_structured_request(system_prompt="Say hello", prompt_model=GreetingPromptModel))
+
+
+def test_invalid_responses_are_not_cached(tmp_path):
+    provider = _provider(tmp_path, ['{"wrong_field": "hello"}', '{"greeting": "hello"}'])
+    with pytest.raises(ValidationError):
+        _request(provider)
+    assert _request(provider).greeting == "hello"  # a fresh request, not the cached invalid response
+    assert _request(provider).greeting == "hello"  # cached
+    assert provider.client.requests == 2
+
+
+def test_invalid_cached_responses_are_dropped(tmp_path):
+    provider = _provider(tmp_path, ['{"greeting": "hello"}'])
+    cache_key = provider.response_cache.make_key(llm_model=provider.name,
+                                                 system_prompt="Say hello",
+                                                 response_schema=GreetingPromptModel.model_json_schema())
+    provider.response_cache.put(cache_key, llm_model=provider.name, response='{"wrong_field": "hello"}')
+    assert _request(provider).greeting == "hello"
+    assert provider.client.requests == 1
+    assert provider.response_cache.get(cache_key) == '{"greeting": "hello"}'